@@ -0,0 +1,105 @@
+'''
+Batch level data augmentation.
+
+Runs as a tf.data map after .batch(), so every transform is one vectorized op over the whole batch
+instead of a graph of small per sample ops. Every sample gets its own random transform:
+-   Flips and rot90: the symmetries of the square, as an optional transpose + up/down + left/right flip.
+    The same transform is applied to the image and the labels (target, weight / compact label with the NaN mask).
+-   Gain and noise jitter of the SAR backscatter channels: coherence channels and labels are left untouched.
+'''
+from dataclasses import dataclass
+import tensorflow as tf
+
+SAR_CHANNELS = 4 # co-event (and pre-event) VV, VH. Same channels as the speckle filter
+
+def _select(condition:tf.Tensor, a:tf.Tensor, b:tf.Tensor) -> tf.Tensor:
+    # Per sample choice between a and b
+    condition = tf.reshape(condition, [-1] + [1] * (len(a.shape) - 1))
+    return tf.where(condition, a, b)
+
+@dataclass(frozen=True)
+class BatchAugmentation:
+    '''
+    tf.data map function (image, *labels) --> (image, *labels) of batched (or single) samples.
+
+    Usage:
+        augment = BatchAugmentation(flip=True, rot90=True, noise_std=0.1, format='HWC')
+        train_ds = train_ds.batch(BATCH_SIZE).map(augment, num_parallel_calls=tf.data.AUTOTUNE)
+    '''
+    flip: bool = True
+    rot90: bool = True
+    gain_std: float = 0.0   # Multiplicative jitter 1 + N(0, gain_std) per sample and SAR channel
+    noise_std: float = 0.0  # Additive zero mean noise with a std of noise_std per SAR pixel
+    format: str = 'HWC'
+
+    def __call__(self, image:tf.Tensor, *labels:tf.Tensor) -> tuple:
+        batched = len(labels[0].shape) == 3
+        if not batched:
+            image, labels = image[tf.newaxis], [label[tf.newaxis] for label in labels]
+
+        image, labels = self.geometric(image, labels)
+        image = self.radiometric(image)
+
+        if not batched:
+            image, labels = image[0], [label[0] for label in labels]
+        return (image, *labels)
+
+    def geometric(self, image:tf.Tensor, labels:list) -> tuple:
+        if not self.flip and not self.rot90:
+            return image, labels
+
+        batch = tf.shape(image)[0]
+        # Spatial axes: (B, H, W, C), (B, C, H, W) and (B, H, W) labels
+        image_axis = 2 if self.format == 'CHW' else 1
+        tensors = [(image, image_axis)] + [(label, 1) for label in labels]
+
+        def transpose(x, axis):
+            perm = list(range(len(x.shape)))
+            perm[axis], perm[axis + 1] = perm[axis + 1], perm[axis]
+            return tf.transpose(x, perm)
+
+        def flip(x, axis, flipped):
+            # Gathering rows / columns with per sample (B, H) indices is much cheaper than selecting between
+            # the flipped and the original batch
+            size = tf.shape(x)[axis]
+            forward = tf.range(size)
+            index = tf.where(flipped[:, tf.newaxis], forward[::-1], forward)
+            return tf.gather(x, index, axis=axis, batch_dims=1)
+
+        coin = lambda: tf.random.uniform([batch]) < 0.5
+        no = tf.zeros([batch], dtype=tf.bool)
+        # Transposing non square patches would change the shape, they only get the 180 degree rotation
+        square = image.shape[image_axis] == image.shape[image_axis + 1]
+        transposed = coin() if self.rot90 and square else no
+        flip_up = coin() if self.flip or self.rot90 else no
+        # Rotations are the transforms with an even number of transposes + flips, flips add the mirrored ones
+        flip_left = tf.math.logical_xor(tf.math.logical_xor(transposed, flip_up), coin() if self.flip else no)
+
+        if self.rot90 and square:
+            tensors = [(_select(transposed, transpose(x, axis), x), axis) for x, axis in tensors]
+        tensors = [(flip(flip(x, axis, flip_up), axis + 1, flip_left), axis) for x, axis in tensors]
+
+        return tensors[0][0], [x for x, _ in tensors[1:]]
+
+    def radiometric(self, image:tf.Tensor) -> tf.Tensor:
+        if not self.gain_std and not self.noise_std:
+            return image
+
+        channel_axis = 1 if self.format == 'CHW' else 3
+        channels = image.shape[channel_axis]
+        sar = min(SAR_CHANNELS, channels)
+        # Only the SAR channels are jittered
+        sar_mask = tf.reshape(tf.range(channels) < sar, [1, -1, 1, 1] if self.format == 'CHW' else [1, 1, 1, -1])
+
+        jittered = tf.cast(image, tf.float32)
+        if self.gain_std:
+            gain_shape = [tf.shape(image)[0], channels, 1, 1] if self.format == 'CHW' else [tf.shape(image)[0], 1, 1, channels]
+            gain = 1.0 + tf.random.normal(gain_shape, stddev=self.gain_std)
+            jittered = jittered * tf.where(sar_mask, gain, 1.0)
+        if self.noise_std:
+            # Uniform noise, a third of the cost of sampling a normal distribution for the same std
+            bound = self.noise_std * 3**0.5
+            noise = tf.random.uniform(tf.shape(image), -bound, bound)
+            jittered = jittered + tf.where(sar_mask, noise, 0.0)
+
+        return tf.cast(jittered, image.dtype)
@@ -0,0 +1,135 @@
+'''
+Content-addressed on-disk cache for preprocessing outputs.
+
+NaN imputation and the speckle filter only depend on the input files and the stage parameters,
+yet they are recomputed for every sample, every epoch and every evaluation run.
+
+Entries are keyed on
+    sha256( content hash of every input file + stage parameters )
+so changing e.g. the filter kernel size only misses the entries made with the old kernel.
+Content hashes are memoized per (path, size, mtime) in a small SQLite table so a file is only hashed once.
+
+The cache is capped in size, least recently used entries are evicted first.
+'''
+from dataclasses import dataclass, field
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from typing import Callable, Dict, List
+
+import numpy as np
+
+@dataclass
+class PreprocessCache:
+    '''
+    Usage:
+        cache = PreprocessCache("/tmp/preprocess-cache", max_bytes=20 * 2**30)
+        arrays = cache.fetch(paths, {'stage': 'speckle', 'size': 7}, lambda: {'img': expensive(paths)})
+    '''
+    root: str
+    max_bytes: int = 20 * 2**30
+    size: int = field(init=False)
+    lock: threading.Lock = field(init=False, repr=False)
+    hashes: sqlite3.Connection = field(init=False, repr=False)
+
+    def __post_init__(self):
+        os.makedirs(self.root, exist_ok=True)
+        self.lock = threading.Lock()
+        # tf.data calls read_sample from several threads
+        self.hashes = sqlite3.connect(f'{self.root}/hashes.sqlite', check_same_thread=False)
+        self.hashes.execute('CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, digest TEXT)')
+        self.size = sum(os.path.getsize(path) for path in self.__entries())
+
+    def __entries(self) -> List[str]:
+        return [
+            f'{dir}/{file}' for dir, _, files in os.walk(self.root) for file in files if file.endswith('.npz')
+        ]
+
+    def content_hash(self, path:str) -> str:
+        """sha1 of the file content, only recomputed when the file size or mtime changed.
+        """
+        stat = os.stat(path)
+        with self.lock:
+            row = self.hashes.execute('SELECT size, mtime, digest FROM hashes WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                digest.update(block)
+        digest = digest.hexdigest()
+
+        with self.lock, self.hashes:
+            self.hashes.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)', (path, stat.st_size, stat.st_mtime_ns, digest))
+        return digest
+
+    def key(self, paths:List[str], params:dict) -> str:
+        key = hashlib.sha256()
+        for path in paths:
+            key.update(self.content_hash(path).encode())
+        key.update(json.dumps(params, sort_keys=True).encode())
+        return key.hexdigest()
+
+    def __path(self, key:str) -> str:
+        return f'{self.root}/{key[:2]}/{key}.npz'
+
+    def get(self, key:str) -> Dict[str, np.ndarray]:
+        path = self.__path(key)
+        try:
+            with np.load(path) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+
+        # Bump mtime so eviction sees this entry as recently used
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass # Evicted by another process in the meantime
+        return arrays
+
+    def put(self, key:str, arrays:Dict[str, np.ndarray]):
+        path = self.__path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write + rename so concurrent readers never see a partial entry
+        tmp = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, path)
+
+        with self.lock:
+            self.size += os.path.getsize(path)
+            if self.size > self.max_bytes:
+                self.__evict()
+
+    def __evict(self):
+        # Oldest (least recently used) first, down to 90% of the cap to avoid evicting on every put
+        entries = sorted(self.__entries(), key=lambda path: os.stat(path).st_mtime)
+        for path in entries:
+            if self.size <= 0.9 * self.max_bytes:
+                break
+            size = os.path.getsize(path)
+            os.remove(path)
+            self.size -= size
+
+    def fetch(self, paths:List[str], params:dict, compute:Callable[[], Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+        """Returns the cached arrays for (paths, params), computing and storing them on a miss.
+
+        Args:
+            paths (list): Input files of the stage. Their content is part of the key.
+            params (dict): Stage parameters (JSON serializable). Part of the key.
+            compute (callable): Returns the {name: array} outputs of the stage.
+
+        Returns:
+            dict: {name: array}
+        """
+        key = self.key(paths, params)
+        arrays = self.get(key)
+        if arrays is None:
+            arrays = compute()
+            self.put(key, arrays)
+        return arrays
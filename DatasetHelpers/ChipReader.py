@@ -0,0 +1,112 @@
+'''
+Reusable multi-band chip reader shared by every loader.
+
+Loaders used to grow their arrays with repeated np.append (quadratic copying) and leave rasterio handles open.
+ChipReader reads all the bands of a chip straight into a preallocated float32 buffer with rasterio's out= argument,
+and remaps labels with a vectorized lookup table.
+'''
+from dataclasses import dataclass, field
+from typing import List
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+CHIP_SIZE = 512
+IGNORE_LABEL = 255 # Labels outside of the remapping, and NaN masked pixels of compact labels
+
+@dataclass
+class ChipReader:
+    '''
+    Usage:
+        reader = ChipReader({-1: 0, 0: 0, 1: 1})
+        img = reader.read(['..._S1Weak.tif', '..._pre_event_grd.tif'])   # (4, 512, 512) float32
+        tgt = reader.read_label('..._S2IndexLabelWeak.tif')              # (1, 512, 512) int16, remapped
+        patch = reader.read(paths, window=Window(col, row, 128, 128))     # (4, 128, 128), only the window is decoded
+    '''
+    label_remapping: dict = None
+    chip_size: int = CHIP_SIZE
+    lut: np.ndarray = field(init=False, repr=False)
+    lut_offset: int = field(init=False, repr=False)
+
+    def __post_init__(self):
+        if not self.label_remapping:
+            # Labels are kept as they are
+            self.lut, self.lut_offset = None, 0
+            return
+
+        # Labels are offset by the smallest label to index the lookup table
+        keys = self.label_remapping.keys()
+        self.lut_offset = min(keys)
+        self.lut = np.array(
+            [self.label_remapping.get(k, k) for k in range(self.lut_offset, max(keys) + 1)], dtype=np.int16
+        )
+
+    def count_channels(self, paths:List[str]) -> int:
+        channels = 0
+        for path in paths:
+            with rasterio.open(path) as src:
+                channels += src.count
+        return channels
+
+    def shape(self, window:Window=None) -> tuple:
+        return (self.chip_size, self.chip_size) if window is None else (window.height, window.width)
+
+    def read(self, paths:List[str], out:np.ndarray=None, window:Window=None) -> np.ndarray:
+        """Reads every band of every file of a chip into one (C, H, W) float32 buffer.
+
+        Args:
+            paths (list): Files of the chip, their bands are stacked in order.
+            out (np.ndarray, optional): Preallocated (C, H, W) buffer (or view of a larger one) to read into.
+            window (Window, optional): Only read this window of the chip. Defaults to the whole chip.
+
+        Returns:
+            np.ndarray: out
+        """
+        if out is None:
+            out = np.empty((self.count_channels(paths), *self.shape(window)), dtype=np.float32)
+
+        c = 0
+        for path in paths:
+            with rasterio.open(path) as src:
+                src.read(out=out[c:c+src.count], window=window)
+                c += src.count
+        return out
+
+    def read_label(self, path:str, out:np.ndarray=None, remap:bool=True, window:Window=None) -> np.ndarray:
+        """Reads a label chip (or a window of it) into a (1, H, W) int16 buffer, remapped with the lookup table.
+        """
+        if out is None:
+            out = np.empty((1, *self.shape(window)), dtype=np.int16)
+
+        with rasterio.open(path) as src:
+            src.read(out=out, window=window)
+
+        if remap:
+            self.remap(out, out=out)
+        return out
+
+    def remap(self, labels:np.ndarray, out:np.ndarray=None) -> np.ndarray:
+        """Vectorized label remapping. Values outside of the range of the mapping (e.g. corrupt labels) become IGNORE_LABEL.
+        """
+        if self.lut is None:
+            if out is None:
+                return np.array(labels, dtype=np.int16)
+            out[...] = labels
+            return out
+        index = labels - self.lut_offset
+        unknown = (index < 0) | (index >= len(self.lut))
+        out = np.take(self.lut, index, mode='clip', out=out)
+        out[unknown] = IGNORE_LABEL
+        return out
+
+    def read_many(self, chips:List[List[str]], out:np.ndarray=None) -> np.ndarray:
+        """Reads N chips into one (N, C, H, W) float32 buffer.
+        """
+        if out is None:
+            channels = self.count_channels(chips[0]) if len(chips) > 0 else 0
+            out = np.empty((len(chips), channels, self.chip_size, self.chip_size), dtype=np.float32)
+
+        for i, paths in enumerate(chips):
+            self.read(paths, out=out[i])
+        return out
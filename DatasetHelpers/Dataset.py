@@ -7,13 +7,19 @@ from matplotlib import pyplot as plt
 import numpy as np
 from sklearn.model_selection import train_test_split
 import tensorflow as tf
-import rasterio
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 import cv2 as cv
 import sys
 
 sys.path.append(os.path.abspath("/workspaces/Thesis/DatasetHelpers/"))
-from Preprocessing import lee_filter
+from Preprocessing import SPECKLE_FILTERS, plane_variance
+from Manifest import ChipManifest
+from PackedStore import PackedStore, SPLITS
+from TFRecords import read_tfrecords
+from Cache import PreprocessCache
+from GraphReader import read_packed_split
+from ChipReader import ChipReader, CHIP_SIZE, IGNORE_LABEL
+from rasterio.windows import Window
 
 label_remapping = {
     -1: 0,
@@ -21,6 +27,16 @@ label_remapping = {
     1: 1,
 }
 
+#! Hardcode this for now
+#! Please please please figure out how to change this later. yucky
+CLASS_W = {0: 0.6212519560516805, 1: 2.5618224079902174} 
+
+LEE_SIZE = 7 # Speckle filter kernel size
+
+def remapping(ignore_invalid=False) -> dict:
+    # label_remapping, or with the invalid pixels kept apart as IGNORE_LABEL
+    return {**label_remapping, -1: IGNORE_LABEL} if ignore_invalid else label_remapping
+
 @dataclass
 class Dataset:
     '''
@@ -53,18 +69,25 @@ class Dataset:
         elif self.scenario == 2: self.channels = 6
         else: self.channels = None
     
-    def generate_batches(self, batch_count:int, which_ds:str="train") -> dict:
+    def generate_batches(self, batch_count:int=None, which_ds:str="train", ram_budget_gb:float=None, chip_bytes=None) -> dict:
         """Writes batch information under the self.batches attribute of this class.
 
         Batch information is stored as a dictionary that points to a list of data and label image paths under keys 'x' and 'y' 
 
         Args:
-            batch_count (int): Number of batches to split training into
+            batch_count (int, optional): Number of batches to split training into. Needed without ram_budget_gb
             which_ds (str): Which dataset split to use. "train" "hand" "holdout"
+            ram_budget_gb (float, optional): Instead of batch_count, fill every batch with chips until their footprint reaches this budget.
+            chip_bytes (int or np.ndarray, optional): Memory footprint of one chip, or of every chip of the split, needed with ram_budget_gb.
 
         Returns:
             dict: self.batches 
         """
+        if ram_budget_gb is None and batch_count is None:
+            raise ValueError("Pass either a batch_count or a ram_budget_gb to split the dataset into batches")
+        if ram_budget_gb is not None and chip_bytes is None:
+            raise ValueError("ram_budget_gb needs the chip_bytes footprint of the chips")
+
         self.batches = {}
         ds_x = self.x_train
         ds_y = self.y_train
@@ -76,9 +99,13 @@ class Dataset:
             ds_x = self.x_holdout
             ds_y = self.y_holdout
         
-        it = len(ds_x)/batch_count  # 1000/4 = 250
-        batch_idx = [int(i*it) for i in range(batch_count)] # [0, 250, 500, 750]
-        batch_idx.append(len(ds_x)) # [0, 250, 500, 750, 1000]
+        if ram_budget_gb is not None:
+            batch_idx = budget_boundaries(np.broadcast_to(chip_bytes, len(ds_x)), ram_budget_gb * 2**30)
+            batch_count = len(batch_idx) - 1
+        else:
+            it = len(ds_x)/batch_count  # 1000/4 = 250
+            batch_idx = [int(i*it) for i in range(batch_count)] # [0, 250, 500, 750]
+            batch_idx.append(len(ds_x)) # [0, 250, 500, 750, 1000]
         for i in range(batch_count):
             self.batches[i] = {}
             self.batches[i]['x'] = ds_x[ batch_idx[i]:batch_idx[i+1] ]
@@ -86,22 +113,78 @@ class Dataset:
 
         return self.batches        
 
-def convert_to_tfds(ds:Dataset, channel_size:int, format:str='HWC', baseline=False) -> Tuple[tf.data.Dataset, tf.data.Dataset, tf.data.Dataset, tf.data.Dataset]:
+def budget_boundaries(chip_bytes:np.ndarray, budget:float) -> list:
+    """Boundaries [0, ..., N] of consecutive batches of chips, each as large as possible while its total footprint fits the budget.
+    """
+    if len(chip_bytes) and np.max(chip_bytes) > budget:
+        raise ValueError(f"A single chip needs {np.max(chip_bytes) / 2**30:.3f} GiB, more than the {budget / 2**30:.3f} GiB budget")
+
+    boundaries = [0]
+    total = 0
+    for i, size in enumerate(chip_bytes):
+        if total + size > budget:
+            boundaries.append(i)
+            total = 0
+        total += size
+    if boundaries[-1] != len(chip_bytes) or len(boundaries) == 1:
+        boundaries.append(len(chip_bytes))
+    return boundaries
+
+def convert_to_tfds(ds:Dataset, channel_size:int, format:str='HWC', baseline=False, packed:PackedStore=None, tfrecord_dir:str=None, cache:PreprocessCache=None, graph=False, speckle_filter:str='lee', class_weights:dict=None, compact=False, image_dtype:tf.DType=tf.float32, patch_size:int=None, patches_per_chip:int=4, ignore_invalid=False, band_variance:dict=None) -> Tuple[tf.data.Dataset, tf.data.Dataset, tf.data.Dataset, tf.data.Dataset]:
     '''
     Returns the created datasets as multiple tf.data.Dataset classes.
+    If a PackedStore is given, samples are sliced from its memory-mapped arrays instead of decoding the GeoTIFFs.
+    If a PreprocessCache is given, NaN imputation and the speckle filter are only computed once per chip.
+    speckle_filter picks the filter of the SAR channels: "lee", "refined_lee" or "multitemporal".
+    If a tfrecord_dir is given (written by preprocess.py or DatasetHelpers/TFRecords.py), the already preprocessed shards are read instead.
+    The splits are then the ones fixed at export time and ds is ignored.
+    If graph is set, the packed store is read and preprocessed with TensorFlow ops only (DatasetHelpers/GraphReader.py)
+    instead of read_sample. The splits are then the ones fixed at packing time and ds is ignored. It only has the Lee filter.
+    class_weights are the per class weights of the weight map. Defaults to CLASS_W.
+    If compact is set, elements are (image, uint8 label) without a weight map, NaN masked pixels are labelled IGNORE_LABEL.
+    Map apply_class_weights over the (batched) dataset to get the weights on graph, or use the Models/Losses.py losses
+    to apply them on the device. image_dtype (e.g. tf.float16) is the image dtype of compact elements, models upcast it.
+    If patch_size is set, the training split is made of patches_per_chip random patch_size x patch_size patches of every
+    chip, shuffled across chips, and only their windows are read. The other splits keep the whole chips.
+    The Lee filter of a patch needs the variance of its whole chip: band_variance is { image path : per band variance },
+    from ChipManifest.band_variance.
+    If ignore_invalid is set (compact only), invalid (-1) pixels are labelled IGNORE_LABEL instead of non-water, e.g. for evaluation.
     Returns:
         --  train_ds:     tf.data.Dataset
         --  val_ds  :     tf.data.Dataset
         --  test_ds (holdout) :     tf.data.Dataset
         --  hand_ds : tf.data.Dataset
     '''
+    class_weights = class_weights or CLASS_W
+
+    if patch_size and (tfrecord_dir is not None or graph):
+        raise ValueError("Patches are read with read_sample only, not from TFRecords or the graph reader")
+
+    if ignore_invalid and not compact:
+        raise ValueError("Invalid pixels are only kept apart (IGNORE_LABEL) in compact labels")
+    if ignore_invalid and tfrecord_dir is not None:
+        raise ValueError("TFRecord labels are remapped at export time, invalid pixels cannot be ignored")
+
+    if tfrecord_dir is not None:
+        return tuple( read_tfrecords(tfrecord_dir, split, channel_size, format, class_weights=class_weights, compact=compact, image_dtype=image_dtype, baseline=baseline, speckle_filter=speckle_filter) for split in SPLITS )
+
+    if graph:
+        if packed is None:
+            raise ValueError("The graph reader decodes from a packed store, packed must be given")
+        if speckle_filter != 'lee':
+            raise ValueError(f"The graph reader only implements the lee speckle filter, not {speckle_filter}")
+        return tuple( 
+            read_packed_split(packed.root, split, channel_size, format, baseline=baseline, label_remapping=remapping(ignore_invalid), class_weights=class_weights, lee_size=LEE_SIZE, compact=compact, image_dtype=image_dtype) 
+            for split in SPLITS 
+        )
+
     # Samples will be converted to a list of string paths where the last string is the test label path
     train_samples = []
     val_samples = []
     test_samples = []
     hand_samples = []
     
-    tf_read_sample = construct_read_sample_function(channel_size, format=format, baseline=baseline)
+    tf_read_sample = construct_read_sample_function(channel_size, format=format, baseline=baseline, packed=packed, cache=cache, speckle_filter=speckle_filter, class_weights=class_weights, compact=compact, image_dtype=image_dtype, ignore_invalid=ignore_invalid)
 
     for x, y in zip(ds.x_train, ds.y_train): train_samples.append((*x, *y))
     for x, y in zip(ds.x_val, ds.y_val): val_samples.append((*x, *y))
@@ -111,7 +194,13 @@ def convert_to_tfds(ds:Dataset, channel_size:int, format:str='HWC', baseline=Fal
     train_samples, val_samples, test_samples, hand_samples = np.asarray(train_samples), np.asarray(val_samples), np.asarray(test_samples), np.asarray(hand_samples)
 
     train_ds = tf.data.Dataset.from_tensor_slices(train_samples)
-    train_ds = train_ds.map(tf_read_sample, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    if patch_size:
+        # Consecutive patches come from different chips
+        tf_read_patch = construct_read_sample_function(channel_size, format=format, baseline=baseline, packed=packed, speckle_filter=speckle_filter, class_weights=class_weights, compact=compact, image_dtype=image_dtype, patch_size=patch_size, band_variance=band_variance)
+        train_ds = train_ds.repeat(patches_per_chip).shuffle(len(train_samples) * patches_per_chip)
+        train_ds = train_ds.map(tf_read_patch, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    else:
+        train_ds = train_ds.map(tf_read_sample, num_parallel_calls=tf.data.experimental.AUTOTUNE)
     train_ds = train_ds.map(load_sample, num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
     val_ds = tf.data.Dataset.from_tensor_slices(val_samples)
@@ -128,7 +217,85 @@ def convert_to_tfds(ds:Dataset, channel_size:int, format:str='HWC', baseline=Fal
 
     return train_ds, val_ds, test_ds, hand_ds
 
-def construct_read_sample_function(channel_size:int, format:str = "HWC", baseline=False):
+@dataclass
+class PipelineOptions:
+    '''
+    Options of build_pipeline. Left to None / 'auto', they are picked from the size of the split.
+    '''
+    batch_size: int = 1
+    cache: str = 'auto'         # 'memory', 'none', a directory to cache to files, or 'auto': memory if the split fits in the RAM budget
+    ram_budget_gb: float = 8.0  # RAM for the memory cache and the shuffle buffer
+    shuffle_buffer: int = None  # Elements. None: the whole split if it is cached in memory, else a tenth of it within the RAM budget. 0 disables it
+    threads: int = None         # Size of a private threadpool for the pipeline. None: the shared tf.data threadpool
+    deterministic: bool = True  # False lets the parallel maps / interleaves return elements out of order, to avoid stalls
+    prefetch: int = tf.data.AUTOTUNE # Batches
+
+def element_bytes(ds:tf.data.Dataset) -> int:
+    """Bytes of one element of ds, from its (static) element_spec.
+    """
+    return sum( int(np.prod(spec.shape)) * spec.dtype.size for spec in tf.nest.flatten(ds.element_spec) )
+
+def build_pipeline(ds:tf.data.Dataset, options:PipelineOptions, name:str = 'train', training:bool = True, maps:list = None) -> tf.data.Dataset:
+    """Caches, shuffles, batches and prefetches one split returned by convert_to_tfds.
+
+    maps are tf.data map functions applied per batch after .batch() (augmentation, class weights, ...),
+    they run after the cache so random transforms are drawn again every epoch.
+    Validation / test splits (training=False) are not shuffled.
+
+    Args:
+        ds (tf.data.Dataset): Unbatched split.
+        options (PipelineOptions): Pipeline options.
+        name (str, optional): Name of the split, also the file name of a file cache. Defaults to 'train'.
+            File caches are not invalidated, the directory has to be cleared when the data or preprocessing changes.
+        training (bool, optional): Shuffle the split. Defaults to True.
+        maps (list, optional): Map functions over batches. Defaults to none.
+    """
+    maps = maps or []
+    count = int(ds.cardinality())
+    size = count * element_bytes(ds) if count >= 0 else None
+    budget = int(options.ram_budget_gb * 2**30)
+
+    cache = options.cache
+    if cache == 'auto':
+        cache = 'memory' if size is not None and size <= budget else 'none'
+
+    if cache == 'memory':
+        ds = ds.cache()
+    elif cache != 'none':
+        os.makedirs(cache, exist_ok=True)
+        ds = ds.cache(os.path.join(cache, name))
+
+    shuffle_buffer = 0
+    if training:
+        shuffle_buffer = options.shuffle_buffer
+        if shuffle_buffer is None and count >= 0:
+            if cache == 'memory':
+                # Shuffling an in memory cache only holds references to the cached elements
+                shuffle_buffer = count
+            else:
+                # Every epoch waits for the buffer to fill: a tenth of the split, at least 10 batches, within the budget
+                fits = budget // max(element_bytes(ds), 1)
+                shuffle_buffer = min(count, fits, max(options.batch_size * 10, count // 10))
+        elif shuffle_buffer is None:
+            shuffle_buffer = options.batch_size * 10
+    if shuffle_buffer > 1:
+        ds = ds.shuffle(shuffle_buffer)
+
+    ds = ds.batch(options.batch_size)
+    for map_function in maps:
+        ds = ds.map(map_function, num_parallel_calls=tf.data.AUTOTUNE, deterministic=options.deterministic)
+    ds = ds.prefetch(options.prefetch)
+
+    # Applies to every stage of the split, including the readers of convert_to_tfds
+    pipeline_options = tf.data.Options()
+    pipeline_options.deterministic = options.deterministic
+    if options.threads:
+        pipeline_options.threading.private_threadpool_size = options.threads
+
+    print(f"{name}: {count} elements ({'?' if size is None else f'{size / 2**30:.2f}'} GiB), cache: {cache}, shuffle buffer: {shuffle_buffer}, batch: {options.batch_size}")
+    return ds.with_options(pipeline_options)
+
+def construct_read_sample_function(channel_size:int, format:str = "HWC", baseline=False, packed:PackedStore=None, cache:PreprocessCache=None, speckle_filter:str = "lee", class_weights:dict = None, compact=False, image_dtype:tf.DType = tf.float32, patch_size:int = None, numpy=False, ignore_invalid=False, band_variance:dict = None):
     '''
     This function takes in options to adjust the dataset reading functions to accomodate different datasets.
 
@@ -138,8 +305,28 @@ def construct_read_sample_function(channel_size:int, format:str = "HWC", baselin
     @parmams:
         - channel_size = Channel size of the dataset (3 for rgb)
         - format : image dimension order. "HWC" or "CHW"
+        - packed : Optional PackedStore to read samples from instead of the GeoTIFFs
+        - cache : Optional PreprocessCache for the NaN imputation + speckle filter outputs
+        - speckle_filter : "lee", "refined_lee" or "multitemporal" (DatasetHelpers/Preprocessing.py)
+        - class_weights : { class : weight } of the weight map. Defaults to CLASS_W
+        - compact : Return (img, uint8 label) with NaN masked pixels labelled IGNORE_LABEL instead of the
+                    float32 target + weight maps. The weights are then applied on graph (apply_class_weights)
+        - image_dtype : Image dtype of compact samples, e.g. tf.float16 to halve the image memory
+        - patch_size : Read a random patch_size x patch_size window of every chip instead of the whole chip.
+                       Only the window (+ the speckle filter halo) is decoded. The cache is not used for patches
+        - numpy : Return the plain numpy read_sample function instead of the tf.function wrapper.
+                  It takes the list of (byte string) paths and returns (img, masked tgt, weights).
+                  With patch_size, it also takes the (row, col) offset of the patch
+        - ignore_invalid : Label invalid (-1) pixels IGNORE_LABEL instead of non-water. Compact only
+        - band_variance : { image path : (bands,) variance } of ChipManifest.band_variance. The Lee filter of a patch
+                          weights with the variance of the whole chip, this avoids decoding the chip for it
     '''
-    
+    if patch_size and not baseline and speckle_filter == 'lee' and band_variance is None:
+        raise ValueError("Lee filtered patches need the variance of their chips, pass band_variance (ChipManifest.band_variance)")
+
+    reader = ChipReader(remapping(ignore_invalid))
+    class_weights = class_weights or CLASS_W
+
     def apply_transpose(x:np.float32):
         # Assume x is read directly from rasterio.open. Which means it would be in CHW format
         if format == "CHW":
@@ -147,46 +334,23 @@ def construct_read_sample_function(channel_size:int, format:str = "HWC", baselin
         elif format == "HWC":
             return np.transpose(x, axes=(0,2,3,1))
     
-    def read_sample(data_path:str) -> tuple:
-        # Used by tf_read_sample to show tensorflow how to load our data in its own automatic batching process.
-        #! Hardcode this for now
-        #! Please please please figure out how to change this later. yucky
-        CLASS_W = {0: 0.6212519560516805, 1: 2.5618224079902174} 
-        path = data_path.numpy() # 0:-1 --> training paths
-        img = []
-        tgt = list()
-
-        for train_path in path[0:-1]:
-            # Train paths include all images paths relating to this scene
-            train_path = train_path.decode('utf-8')
-            
-            with rasterio.open(train_path) as src:
-                tmp_img = src.read()
-                
-                # First image/"channel" to be appended to the list
-                if img == []: 
-                    img.append(tmp_img)
-                    img = np.asarray(img) # --> (1, 2, 512, 512)
-                
-                # Subsequent channels will be np.appended to perserve shape
-                else:
-                    tmp_img = np.expand_dims(tmp_img, axis=0)
-                    img = np.append(img, tmp_img, axis=1) # --> (1, 2+, 512, 512)
+    def read_image(image_paths:list, tgt_path:str) -> np.ndarray:
+        if packed is not None and tgt_path in packed:
+            # Slicing the memory map is free, the copy is the working buffer of the pipeline below
+            img, _ = packed.read(tgt_path)
+            return np.array(img)[np.newaxis] # --> (1, C, 512, 512)
 
-
-        tgt_path = path[-1].decode('utf-8')
-        with rasterio.open(tgt_path) as src:
-            tgt = src.read()
-            
-            for old_val, new_val in label_remapping.items():
-                tgt[tgt == old_val] = new_val
+        # All bands are read straight into one preallocated float32 buffer
+        img = reader.read(image_paths)[np.newaxis] # --> (1, C, 512, 512)
 
         ## DEBUG TRAINING DATA
         # fig1, (ax1, ax2) = plt.subplots(nrows=1, ncols=2)
         # ax1.imshow(img[0,:,:,0], cmap='Greys')
         # ax2.imshow(img[0,:,:,1], cmap='Greys')
         # fig1.savefig(f"Results/Debug/{tgt_path.split('/')[-1][:-3]}_training.png")
-        
+        return img
+
+    def preprocess_image(img:np.ndarray, variance:np.ndarray = None) -> dict:
         ## PREPROCESSING PIPLINE
 
         ##  ## MASKING
@@ -202,15 +366,75 @@ def construct_read_sample_function(channel_size:int, format:str = "HWC", baselin
             ##  ## BORDER NOISE CORRECTION
 
             ##  ## SPECKLE FILTER
-            if img.shape[1] == 2:
-                img[0, :, :, :] = lee_filter(img[0, :, :, :])
-            
-            if img.shape[1] > 2:
-                img[0, 0:4, :, :] = lee_filter(img[0, 0:4, :, :])
+            # SAR backscatter channels only: co-event (and pre-event) VV, VH
+            # The multitemporal filter takes the co + pre stack jointly
+            # variance: chip wide variance of the Lee filter when img is a window of the chip
+            # One chip per call and tf.data already maps in parallel: the filter runs in the calling thread
+            options = {} if variance is None else {'variance': variance}
+            SPECKLE_FILTERS[speckle_filter](img[:, 0:4, :, :], size=LEE_SIZE, out=img[:, 0:4, :, :], workers=1, **options)
 
 
             ##  ## RADIOMETRIC TERRAIN NORMALIZATION
 
+        return {'img': img, 'nans': nans}
+
+    # Everything that changes the output of preprocess_image must be part of the cache key
+    stage_params = {'stage': 'preprocess_image', 'baseline': baseline, 'speckle_filter': speckle_filter, 'size': LEE_SIZE}
+
+    def read_sample(data_path:str) -> tuple:
+        # Used by tf_read_sample to show tensorflow how to load our data in its own automatic batching process.
+        path = data_path.numpy() if tf.is_tensor(data_path) else data_path # 0:-1 --> training paths
+        image_paths = [train_path.decode('utf-8') for train_path in path[0:-1]]
+        tgt_path = path[-1].decode('utf-8')
+
+        if cache is not None:
+            # On a hit neither the image files are decoded nor the filters run
+            preprocessed = cache.fetch(image_paths, stage_params, lambda: preprocess_image(read_image(image_paths, tgt_path)))
+        else:
+            preprocessed = preprocess_image(read_image(image_paths, tgt_path))
+        img, nans = preprocessed['img'], preprocessed['nans']
+
+        if packed is not None and tgt_path in packed:
+            _, tgt = packed.read(tgt_path)
+            tgt = reader.remap(tgt) # Copies out of the read-only map
+        else:
+            tgt = reader.read_label(tgt_path)
+
+        return package_sample(img, tgt, nans)
+
+    def speckle_variance(image_paths:list) -> np.ndarray:
+        # The Lee filter weights with the variance of the whole chip: the (1, C) variance of the SAR channels
+        if baseline or speckle_filter != 'lee':
+            return None
+        return np.concatenate([ band_variance[path] for path in image_paths ])[np.newaxis, 0:4]
+
+    def read_patch(data_path:str, offset:tuple) -> tuple:
+        # Same as read_sample for a patch_size x patch_size window at offset (row, col) of the chip
+        path = data_path.numpy() if tf.is_tensor(data_path) else data_path
+        image_paths = [train_path.decode('utf-8') for train_path in path[0:-1]]
+        tgt_path = path[-1].decode('utf-8')
+        row, col = (int(x) for x in (offset.numpy() if tf.is_tensor(offset) else offset))
+
+        # The speckle filter of the border pixels needs a halo around the patch. At the chip border the halo is
+        # clipped and the filter reflects, exactly like on the full chip, so patches equal crops of read_sample.
+        halo = 0 if baseline else LEE_SIZE // 2
+        top, left = max(row - halo, 0), max(col - halo, 0)
+        bottom, right = min(row + patch_size + halo, CHIP_SIZE), min(col + patch_size + halo, CHIP_SIZE)
+
+        if packed is not None and tgt_path in packed:
+            # Only the pages of the window are touched
+            img, tgt = packed.read(tgt_path)
+            img = np.array(img[:, top:bottom, left:right])[np.newaxis]
+            tgt = reader.remap(tgt[:, row:row+patch_size, col:col+patch_size])
+        else:
+            img = reader.read(image_paths, window=Window(left, top, right - left, bottom - top))[np.newaxis]
+            tgt = reader.read_label(tgt_path, window=Window(col, row, patch_size, patch_size))
+
+        preprocessed = preprocess_image(img, speckle_variance(image_paths))
+        rows, cols = slice(row - top, row - top + patch_size), slice(col - left, col - left + patch_size)
+        return package_sample(preprocessed['img'][:, :, rows, cols], tgt, preprocessed['nans'][rows, cols])
+
+    def package_sample(img:np.ndarray, tgt:np.ndarray, nans:np.ndarray) -> tuple:
         tgt_masked = np.ma.masked_array(tgt, mask=nans)
         
 
@@ -237,16 +461,33 @@ def construct_read_sample_function(channel_size:int, format:str = "HWC", baselin
 
         tgt_masked = tgt_masked[0,:,:] # Remove channels
 
+        # Remove batch
+        img = img[0,:,:,:]
+
+        if compact:
+            # The NaN mask travels inside the label, 1 byte per pixel instead of the float32 target + weight maps
+            return (img.astype(image_dtype.as_numpy_dtype), np.ma.filled(tgt_masked, IGNORE_LABEL).astype(np.uint8))
+
         ## Add the weighting
         weights = np.ones(tgt_masked.shape, dtype=np.float32)
-        for k,v in CLASS_W.items():
+        for k,v in class_weights.items():
             weights[ tgt_masked == k] = v
 
-        # Remove batch
-        img = img[0,:,:,:]
+        # Labels outside of the remapping (IGNORE_LABEL) are not a class: target 0 with a weight of 0
+        ignored = np.ma.getdata(tgt_masked) == IGNORE_LABEL
+        if ignored.any():
+            weights[ignored] = 0
+            tgt_masked = np.ma.masked_array(np.where(ignored, 0, np.ma.getdata(tgt_masked)), mask=np.ma.getmaskarray(tgt_masked))
 
         return (img, tgt_masked, weights)
 
+    @tf.function
+    def tf_read_compact_sample(data_path:str) -> dict:
+        [img, tgt] = tf.py_function( read_sample, [data_path], [image_dtype, tf.uint8])
+        img.set_shape((512, 512, channel_size) if format == "HWC" else (channel_size, 512, 512))
+        tgt.set_shape((512, 512))
+        return {'image': img, 'target': tgt}
+
     @tf.function
     def tf_read_sample(data_path:str) -> dict:
         [img, tgt, weight] = tf.py_function( read_sample, [data_path], [tf.float32, tf.float32, tf.float32])
@@ -263,6 +504,31 @@ def construct_read_sample_function(channel_size:int, format:str = "HWC", baselin
 
         return {'image': img, 'target': tgt, 'weight': weight}
     
+    @tf.function
+    def tf_read_patch(data_path:str) -> dict:
+        # A new random window on every read, the shuffled patch list spreads them over the chips
+        offset = tf.random.uniform([2], 0, CHIP_SIZE - patch_size + 1, dtype=tf.int32)
+        if compact:
+            [img, tgt] = tf.py_function( read_patch, [data_path, offset], [image_dtype, tf.uint8])
+            sample = {'image': img, 'target': tgt}
+        else:
+            [img, tgt, weight] = tf.py_function( read_patch, [data_path, offset], [tf.float32, tf.float32, tf.float32])
+            weight.set_shape((patch_size, patch_size))
+            sample = {'image': img, 'target': tgt, 'weight': weight}
+
+        img.set_shape((patch_size, patch_size, channel_size) if format == "HWC" else (channel_size, patch_size, patch_size))
+        tgt.set_shape((patch_size, patch_size))
+        return sample
+
+    if numpy:
+        return read_patch if patch_size else read_sample
+
+    if patch_size:
+        return tf_read_patch
+
+    if compact:
+        return tf_read_compact_sample
+
     return tf_read_sample
 
     # @tf.function
@@ -281,6 +547,10 @@ def load_sample(sample: dict) -> tuple:
 #   target = tf.image.resize(sample['target'], (512, 512))
 #   weight = tf.image.resize(sample['weight'], (512, 512))
 
+  if 'weight' not in sample:
+      # Compact dtypes, upcasting is left to the model
+      return sample['image'], sample['target']
+
   # cast to proper data types
   image = tf.cast(sample['image'], tf.float32)
   target = tf.cast(sample['target'], tf.float32) # Get rid of channel dimension
@@ -288,6 +558,142 @@ def load_sample(sample: dict) -> tuple:
   return image, target, weight
 
 
+FILE_SUFFIXES = {
+    's1_co' : '_S1Weak.tif',        # <-- Why is this weak? I thought weak was supposed to mean thresholding on some basis to generate labels
+    's1_pre' : '_pre_event_grd.tif',
+    'coh_co': '_co_event_coh.tif',
+    'coh_pre': '_pre_event_coh.tif',
+    's2_weak': '_S2IndexLabelWeak.tif',
+
+    'hand_coh_co': '_co_event_coh_HandLabeled.tif',
+    'hand_coh_pre': '_pre_event_coh_HandLabeled.tif',
+    'hand_s1_co': '_S1Hand.tif',
+    'hand_s1_pre': '_pre_event_grd_HandLabeled.tif',
+    'hand_labels': '_LabelHand.tif',
+}
+
+def apply_class_weights(class_weights:dict = None):
+    """Returns a tf.data map function (image, compact label) --> (image, target, weight).
+
+    Builds the weight map on graph from the uint8 label, for single samples or whole batches.
+    NaN masked pixels (IGNORE_LABEL) are given a weight of 0 so they are ignored by the loss.
+    """
+    class_weights = class_weights or CLASS_W
+    weight_lookup = tf.constant([class_weights[k] for k in sorted(class_weights.keys())], dtype=tf.float32)
+
+    def apply(image, label):
+        ignore = tf.equal(label, IGNORE_LABEL)
+        target = tf.where(ignore, tf.zeros_like(label), label)
+        weight = tf.where(ignore, 0.0, tf.gather(weight_lookup, tf.cast(target, tf.int32)))
+        return image, tf.cast(target, tf.float32), weight
+
+    return apply
+
+def compute_class_weights(ds:Dataset, manifest:ChipManifest = None) -> dict:
+    """Balanced class weights n_pixels / (n_classes * n_class_pixels) of the training labels, after the label remapping.
+
+    This is how CLASS_W was computed. The water fraction is taken from the manifest statistics when every
+    training label is indexed in it, otherwise the labels are read.
+    """
+    label_paths = [y[0] for y in ds.y_train]
+    water = manifest.water_fraction(label_paths) if manifest is not None else None
+
+    if water is None:
+        reader = ChipReader(label_remapping)
+        counts = np.zeros(2, dtype=np.int64)
+        for path in label_paths:
+            counts += np.bincount(reader.read_label(path).ravel(), minlength=2)[:2]
+        water = float(counts[1] / counts.sum())
+
+    return {0: 0.5 / (1 - water), 1: 0.5 / water}
+
+def get_class_weights(FLAGS:flags.FLAGS, ds:Dataset) -> dict:
+    """Class weights from the --class_weights flag: a weight per class, "balanced" to compute them from
+    the training labels, or not set for the empirical CLASS_W.
+    """
+    class_weights = FLAGS.get_flag_value('class_weights', None)
+    if class_weights is None:
+        return CLASS_W
+
+    if class_weights == ['balanced']:
+        if not FLAGS.get_flag_value('manifest', None):
+            return compute_class_weights(ds)
+        manifest = ChipManifest(FLAGS.manifest)
+        try:
+            return compute_class_weights(ds, manifest)
+        finally:
+            manifest.close()
+
+    return { k: float(w) for k, w in enumerate(class_weights) }
+
+def compute_band_variance(ds:Dataset, manifest:ChipManifest = None) -> dict:
+    """{ image path : (bands,) variance } of the training images with NaN as 0, for the Lee filter of patches.
+
+    The variances are taken from the manifest statistics of the indexed files, the other files are read once here.
+    """
+    image_paths = sorted({ path for x in ds.x_train for path in x })
+    variance = manifest.band_variance(image_paths) if manifest is not None else {}
+
+    reader = ChipReader(label_remapping)
+    for path in image_paths:
+        if path not in variance:
+            variance[path] = plane_variance(np.nan_to_num(reader.read([path]), nan=0.0)[np.newaxis])[0]
+    return variance
+
+def get_band_variance(FLAGS:flags.FLAGS, ds:Dataset) -> dict:
+    """compute_band_variance, from the --manifest statistics if the flag is defined and set.
+    """
+    if not FLAGS.get_flag_value('manifest', None):
+        return compute_band_variance(ds)
+    manifest = ChipManifest(FLAGS.manifest)
+    try:
+        return compute_band_variance(ds, manifest)
+    finally:
+        manifest.close()
+
+def compute_label_fractions(ds:Dataset, manifest:ChipManifest = None) -> dict:
+    """{ label path : (water_fraction, invalid_fraction) } of the training labels, before the label remapping.
+
+    The fractions are taken from the manifest statistics of the indexed labels, the other labels are read once here.
+    """
+    label_paths = [y[0] for y in ds.y_train]
+    fractions = manifest.label_fractions(label_paths) if manifest is not None else {}
+
+    reader = ChipReader(label_remapping)
+    for path in label_paths:
+        if path not in fractions:
+            label = reader.read_label(path, remap=False)
+            fractions[path] = (float(np.mean(label == 1)), float(np.mean(label == -1)))
+    return fractions
+
+def get_label_fractions(FLAGS:flags.FLAGS, ds:Dataset) -> dict:
+    """compute_label_fractions, from the --manifest statistics if the flag is defined and set.
+    """
+    if not FLAGS.get_flag_value('manifest', None):
+        return compute_label_fractions(ds)
+    manifest = ChipManifest(FLAGS.manifest)
+    try:
+        return compute_label_fractions(ds, manifest)
+    finally:
+        manifest.close()
+
+def get_file_dirs(FLAGS:flags.FLAGS) -> dict:
+    '''
+    Maps every dataset folder name to the directory given in the path flags.
+    '''
+    return {
+        's1_co' :FLAGS.s1_co,
+        's1_pre' : FLAGS.s1_pre,
+        'coh_co': FLAGS.coh_co,
+        'coh_pre': FLAGS.coh_pre,
+        's2_weak': FLAGS.s2_weak,
+        'hand_coh_co': FLAGS.hand_coh_co,
+        'hand_coh_pre': FLAGS.hand_coh_pre,
+        'hand_s1_co': FLAGS.hand_s1_co,
+        'hand_s1_pre': FLAGS.hand_s1_pre,
+        'hand_labels': FLAGS.hand_labels,
+    }
+
 def create_dataset(FLAGS:flags.FLAGS) -> Dataset:
     '''
     Looks through dataset folders to ensure that it creates a dataset where the same scene instances are available in ALL training scenarios.
@@ -296,6 +702,10 @@ def create_dataset(FLAGS:flags.FLAGS) -> Dataset:
         -- Dataset: DatasetHelpers.Dataset
 
     In order to be usable with tensorflow NN models, Dataset.convert_to_tfds must be called.
+
+    If a --manifest flag is defined and set, the splits are built from the chip manifest (DatasetHelpers.Manifest)
+    which is only refreshed for folders that changed since the last run.
+    The manifest also allows dropping empty / invalid chips with --max_nan_fraction, --max_invalid_fraction and --drop_all_zero.
     '''
 
     holdout_region = "Sri-Lanka"
@@ -306,34 +716,9 @@ def create_dataset(FLAGS:flags.FLAGS) -> Dataset:
     x_hand = []
     y_hand = []
 
-    file_suffixes = {
-        's1_co' : '_S1Weak.tif',        # <-- Why is this weak? I thought weak was supposed to mean thresholding on some basis to generate labels
-        's1_pre' : '_pre_event_grd.tif',
-        'coh_co': '_co_event_coh.tif',
-        'coh_pre': '_pre_event_coh.tif',
-        's2_weak': '_S2IndexLabelWeak.tif',
-
-        'hand_coh_co': '_co_event_coh_HandLabeled.tif',
-        'hand_coh_pre': '_pre_event_coh_HandLabeled.tif',
-        'hand_s1_co': '_S1Hand.tif',
-        'hand_s1_pre': '_pre_event_grd_HandLabeled.tif',
-        'hand_labels': '_LabelHand.tif',
-    }
+    file_suffixes = FILE_SUFFIXES
+    file_dir = get_file_dirs(FLAGS)
 
-    file_dir = {
-        's1_co' :FLAGS.s1_co,
-        's1_pre' : FLAGS.s1_pre,
-        'coh_co': FLAGS.coh_co,
-        'coh_pre': FLAGS.coh_pre,
-        's2_weak': FLAGS.s2_weak,
-        'hand_coh_co': FLAGS.hand_coh_co,
-        'hand_coh_pre': FLAGS.hand_coh_pre,
-        'hand_s1_co': FLAGS.hand_s1_co,
-        'hand_s1_pre': FLAGS.hand_s1_pre,
-        'hand_labels': FLAGS.hand_labels,
-    }
-
-    files = index_dataset(FLAGS)
     suffixes = []
     hand_suffixes = []
     label_dir, label_suffix = file_dir['s2_weak'], file_suffixes['s2_weak']
@@ -364,6 +749,53 @@ def create_dataset(FLAGS:flags.FLAGS) -> Dataset:
         hand_suffixes = [file_suffixes['hand_' + scene_type] for scene_type in usable_data]
         hand_dirs = [file_dir['hand_' + scene_type] for scene_type in usable_data]
 
+    manifest_path = FLAGS.get_flag_value('manifest', None)
+    if manifest_path:
+        # Build the splits from the manifest instead of listing every folder again
+        manifest = ChipManifest(manifest_path)
+        manifest.update(file_dir)
+        # Empty / invalid chip pruning. Only the folders used by this scenario are screened
+        thresholds = {
+            'max_nan_fraction': FLAGS.get_flag_value('max_nan_fraction', 1.0),
+            'max_invalid_fraction': FLAGS.get_flag_value('max_invalid_fraction', 1.0),
+            'drop_all_zero': FLAGS.get_flag_value('drop_all_zero', False),
+        }
+        main_chips = manifest.complete_chips(
+            ['coh_co', 'coh_pre', 's2_weak', 's1_co', 's1_pre'], 
+            screened=usable_data + ['s2_weak'], 
+            **thresholds
+        )
+        hand_chips = manifest.complete_chips(
+            ['hand_coh_co', 'hand_coh_pre', 'hand_labels', 'hand_s1_co', 'hand_s1_pre'], 
+            screened=['hand_' + scene_type for scene_type in usable_data] + ['hand_labels'], 
+            **thresholds
+        )
+        manifest.close()
+
+        for k, chip in main_chips.items():
+            if chip['region']==holdout_region:
+                x_holdout.append([ chip[scene_type] for scene_type in usable_data ])
+                y_holdout.append([ chip['s2_weak'] ])
+            else:
+                x_train.append([ chip[scene_type] for scene_type in usable_data ])
+                y_train.append([ chip['s2_weak'] ])
+
+        for k, chip in hand_chips.items():
+            x_hand.append([ chip['hand_' + scene_type] for scene_type in usable_data ])
+            y_hand.append([ chip['hand_labels'] ])
+
+        return Dataset( 
+            FLAGS.scenario, 
+            np.array(x_train), 
+            np.array(y_train), 
+            np.array(x_holdout), 
+            np.array(y_holdout), 
+            np.array(x_hand), 
+            np.array(y_hand) 
+        )
+
+    files = index_dataset(FLAGS)
+
     # Main + holdout dataset
     for k in files['coh_co'].keys():
         # Ensure existence in each indexed directory
@@ -416,18 +848,7 @@ def index_dataset(FLAGS:flags.FLAGS):
         'hand_labels':  defaultdict(lambda: False),
     }   
 
-    file_dir = {
-        's1_co' :FLAGS.s1_co,
-        's1_pre' : FLAGS.s1_pre,
-        'coh_co': FLAGS.coh_co,
-        'coh_pre': FLAGS.coh_pre,
-        's2_weak': FLAGS.s2_weak,
-        'hand_coh_co': FLAGS.hand_coh_co,
-        'hand_coh_pre': FLAGS.hand_coh_pre,
-        'hand_s1_co': FLAGS.hand_s1_co,
-        'hand_s1_pre': FLAGS.hand_s1_pre,
-        'hand_labels': FLAGS.hand_labels,
-    }
+    file_dir = get_file_dirs(FLAGS)
 
     is_tif = lambda x: True if x[-4:]==".tif" else False    
     
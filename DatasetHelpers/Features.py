@@ -0,0 +1,125 @@
+'''
+Per pixel features of the pixel classifiers (XGBoost).
+
+A pixel's own band values carry no spatial context. PixelFeatures stacks local context features of every chip,
+computed as whole plane float32 box filters written straight into the output planes (no per pixel windows):
+-   raw         the input channels
+-   mean<k>     local mean of every SAR channel over a k x k window, e.g. mean3, mean7
+-   var<k>      local variance of every SAR channel over a k x k window
+-   vv_vh       VV / VH ratio of the co-event (and pre-event) acquisition
+-   co_pre      co-event / pre-event ratio of VV and VH (scenarios 2 and 3)
+The backscatter is in dB, so the ratios are differences. NaN pixels are left out of the local statistics,
+a feature is NaN (missing for xgboost) only where it has no valid input.
+'''
+from dataclasses import dataclass
+import re
+import threading
+
+import cv2 as cv
+import numpy as np
+
+SAR_CHANNELS = 4 # co-event (and pre-event) VV, VH
+FEATURE_PATTERN = re.compile(r'^(raw|vv_vh|co_pre|(mean|var)(\d+))$')
+
+_scratch = threading.local()
+
+def _buffers(shape:tuple) -> tuple:
+    # Reused (H, W) float32 scratch planes of the calling thread
+    if getattr(_scratch, 'shape', None) != shape:
+        _scratch.shape = shape
+        _scratch.planes = [np.empty(shape, dtype=np.float32) for _ in range(4)]
+    return _scratch.planes
+
+def _local_statistics(src:np.ndarray, size:int, mean:np.ndarray=None, var:np.ndarray=None):
+    """NaN aware local mean and / or variance of one (H, W) plane over a size x size window, into mean / var.
+    """
+    filled, count, sums, squares = _buffers(src.shape)
+    valid = ~np.isnan(src)
+    np.copyto(filled, src)
+    filled[~valid] = 0
+    # Ratios of normalized box filters: the normalization cancels out
+    cv.boxFilter(valid.astype(np.float32), cv.CV_32F, (size, size), dst=count, borderType=cv.BORDER_REFLECT_101)
+    cv.boxFilter(filled, cv.CV_32F, (size, size), dst=sums, borderType=cv.BORDER_REFLECT_101)
+    count[count < 1e-6] = np.nan # No valid pixel in the window
+    np.divide(sums, count, out=sums)
+
+    if var is not None:
+        np.multiply(filled, filled, out=filled)
+        cv.boxFilter(filled, cv.CV_32F, (size, size), dst=squares, borderType=cv.BORDER_REFLECT_101)
+        np.divide(squares, count, out=squares)
+        np.subtract(squares, np.multiply(sums, sums, out=var), out=var)
+        np.maximum(var, 0, out=var) # Rounding of flat windows
+    if mean is not None:
+        np.copyto(mean, sums)
+
+@dataclass(frozen=True)
+class PixelFeatures:
+    '''
+    (C, H, W) chip --> (F, H, W) float32 features.
+
+    Usage:
+        features = PixelFeatures(('raw', 'mean7', 'var7', 'vv_vh', 'co_pre'))
+        out = features(chip)                # (F, 512, 512)
+        features.names_for(4)               # Column name of every feature
+    '''
+    names: tuple = ('raw',)
+
+    def __post_init__(self):
+        for name in self.names:
+            match = FEATURE_PATTERN.match(name)
+            if match is None:
+                raise ValueError(f"Unknown feature {name}, expected raw, mean<k>, var<k>, vv_vh or co_pre")
+            if match.group(3) is not None and int(match.group(3)) < 2:
+                raise ValueError(f"Window of {name} must be at least 2 pixels")
+
+    def names_for(self, channels:int) -> list:
+        """Names of the output planes for an input of this many channels. Raises a ValueError if a feature needs more channels.
+        """
+        sar = min(SAR_CHANNELS, channels)
+        acquisitions = ['co'] if sar < 4 else ['co', 'pre']
+        columns = []
+        for name in self.names:
+            if name == 'raw':
+                columns += [f'band{c}' for c in range(channels)]
+            elif name == 'vv_vh':
+                columns += [f'{acquisition}_vv_vh' for acquisition in acquisitions]
+            elif name == 'co_pre':
+                if sar < 4:
+                    raise ValueError("co_pre needs the pre-event channels (scenario 2 or 3)")
+                columns += ['vv_co_pre', 'vh_co_pre']
+            else:
+                columns += [f'{name}_band{c}' for c in range(sar)]
+        return columns
+
+    def channels(self, channels:int) -> int:
+        return len(self.names_for(channels))
+
+    def __call__(self, data:np.ndarray, out:np.ndarray=None) -> np.ndarray:
+        data = np.asarray(data, dtype=np.float32)
+        channels = len(data)
+        sar = min(SAR_CHANNELS, channels)
+        if out is None:
+            out = np.empty((self.channels(channels), *data.shape[1:]), dtype=np.float32)
+
+        f = 0
+        for name in self.names:
+            if name == 'raw':
+                out[f:f+channels] = data
+                f += channels
+            elif name == 'vv_vh':
+                for vv in range(0, sar, 2):
+                    np.subtract(data[vv], data[vv + 1], out=out[f])
+                    f += 1
+            elif name == 'co_pre':
+                for co in range(2):
+                    np.subtract(data[co], data[co + 2], out=out[f])
+                    f += 1
+            else:
+                size = int(FEATURE_PATTERN.match(name).group(3))
+                for c in range(sar):
+                    if name.startswith('mean'):
+                        _local_statistics(data[c], size, mean=out[f])
+                    else:
+                        _local_statistics(data[c], size, var=out[f])
+                    f += 1
+        return out
@@ -0,0 +1,129 @@
+'''
+Graph-native sample reader.
+
+tf_read_sample wraps read_sample in tf.py_function, which pins decoding, NaN handling, the Lee filter
+and the weight map to the Python interpreter. This reader does the same pipeline with TensorFlow ops only
+    -   decode straight from the packed store (DatasetHelpers/PackedStore.py) with FixedLengthRecordDataset
+    -   NaN imputation with tf.where
+    -   Lee filter as a depthwise box convolution
+    -   label remapping with a lookup, labels outside of it are IGNORE_LABEL like ChipReader.remap
+so tf.data can run it with num_parallel_calls and apply its graph optimizations.
+
+Its output matches the numpy path up to float32 rounding, tests/graph_reader_equivalence.py checks it.
+'''
+import json
+
+import numpy as np
+import tensorflow as tf
+
+CHIP_SIZE = 512
+IGNORE_LABEL = 255 # Same as ChipReader.IGNORE_LABEL
+
+def _npy_header_bytes(filename:str) -> int:
+    # Raw data of a .npy file starts right after its header
+    with open(filename, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            np.lib.format.read_array_header_1_0(f)
+        else:
+            np.lib.format.read_array_header_2_0(f)
+        return f.tell()
+
+def tf_box_filter(img:tf.Tensor, size:int) -> tf.Tensor:
+    """Mean over a size x size window for every channel of a (1, H, W, C) tensor.
+
+    Borders are reflected without repeating the edge, same as cv.filter2D's default BORDER_REFLECT_101.
+    """
+    pad = size // 2
+    channels = img.shape[-1]
+    kernel = tf.ones((size, size, channels, 1), dtype=img.dtype) / (size**2)
+    img = tf.pad(img, [[0, 0], [pad, pad], [pad, pad], [0, 0]], mode='REFLECT')
+    return tf.nn.depthwise_conv2d(img, kernel, strides=[1, 1, 1, 1], padding='VALID')
+
+def tf_lee_filter(img:tf.Tensor, size:int = 7) -> tf.Tensor:
+    """TensorFlow version of Preprocessing.lee_filter. Applied per channel of a (1, H, W, C) tensor.
+    """
+    EPSILON = 1e-9
+    patch_means = tf_box_filter(img, size)
+    patch_means_sqr = tf_box_filter(img**2, size)
+    patch_var = patch_means_sqr - patch_means**2
+
+    img_var = tf.reduce_mean(img**2, axis=[1, 2], keepdims=True) - tf.reduce_mean(img, axis=[1, 2], keepdims=True)**2
+    patch_weights = patch_var / (patch_var + img_var + EPSILON)
+    return patch_means + patch_weights * (img - patch_means)
+
+def read_packed_split(packed_dir:str, split:str, channel_size:int, format:str = 'HWC', baseline=False, label_remapping:dict = None, class_weights:dict = None, lee_size:int = 7, num_parallel_calls:int = tf.data.AUTOTUNE, compact:bool = False, image_dtype:tf.DType = tf.float32) -> tf.data.Dataset:
+    """Reads one split of a packed store and preprocesses it on graph.
+
+    Elements match the output of convert_to_tfds: (image, target, weight) as float32.
+    The split is the one fixed when the store was packed.
+
+    Args:
+        packed_dir (str): Directory written by PackedStore.pack_dataset
+        split (str): "train" "val" "holdout" "hand"
+        channel_size (int): Expected channel size, checked against the packed data
+        format (str, optional): "HWC" or "CHW". Defaults to 'HWC'.
+        baseline (bool, optional): Skip the speckle filter. Defaults to False.
+        label_remapping (dict, optional): { old label : new label }. Defaults to -1 --> 0.
+        class_weights (dict, optional): { class : weight }. Defaults to uniform weights.
+        lee_size (int, optional): Lee filter kernel size. Defaults to 7.
+        num_parallel_calls (int, optional): Parallelism of the preprocessing map. Defaults to AUTOTUNE.
+        compact (bool, optional): Return (image, uint8 label) with NaN masked pixels labelled 255 instead of (image, target, weight).
+        image_dtype (tf.DType, optional): Image dtype of compact elements. Defaults to float32.
+    """
+    with open(f'{packed_dir}/index.json') as f:
+        index = json.load(f)['splits'][split]
+    channels = index['channels']
+    if channels != channel_size:
+        raise ValueError(f'{packed_dir} was packed with {channels} channels, expected {channel_size}')
+
+    label_remapping = label_remapping or {-1: 0, 0: 0, 1: 1}
+    class_weights = class_weights or {0: 1.0, 1: 1.0}
+
+    # Labels are offset by the smallest label to index the lookup tables
+    label_offset = min(label_remapping.keys())
+    remap_lookup = tf.constant(
+        [label_remapping.get(k, k) for k in range(label_offset, max(label_remapping.keys()) + 1)], dtype=tf.int32
+    )
+    weight_lookup = tf.constant([class_weights[k] for k in sorted(class_weights.keys())], dtype=tf.float32)
+
+    x_file, y_file = f'{packed_dir}/{split}_x.npy', f'{packed_dir}/{split}_y.npy'
+    x_ds = tf.data.FixedLengthRecordDataset(x_file, record_bytes=4 * channels * CHIP_SIZE**2, header_bytes=_npy_header_bytes(x_file))
+    y_ds = tf.data.FixedLengthRecordDataset(y_file, record_bytes=CHIP_SIZE**2, header_bytes=_npy_header_bytes(y_file))
+
+    def preprocess(x_record, y_record):
+        img = tf.reshape(tf.io.decode_raw(x_record, tf.float32), (channels, CHIP_SIZE, CHIP_SIZE))
+        img = tf.transpose(img, (1, 2, 0))[tf.newaxis] # --> (1, H, W, C)
+        tgt = tf.reshape(tf.io.decode_raw(y_record, tf.int8), (CHIP_SIZE, CHIP_SIZE))
+
+        ##  ## MASKING + NAN IMPUTATION
+        is_nan = tf.math.is_nan(img)
+        nans = tf.reduce_any(is_nan[0], axis=-1)
+        img = tf.where(is_nan, tf.zeros_like(img), img)
+
+        ##  ## SPECKLE FILTER
+        if not baseline:
+            if channels == 2:
+                img = tf_lee_filter(img, lee_size)
+            else:
+                img = tf.concat([tf_lee_filter(img[..., 0:4], lee_size), img[..., 4:]], axis=-1)
+
+        if format == "CHW":
+            img = tf.transpose(img, (0, 3, 1, 2))
+
+        index = tf.cast(tgt, tf.int32) - label_offset
+        known = (index >= 0) & (index < remap_lookup.shape[0])
+        tgt = tf.where(known, tf.gather(remap_lookup, tf.clip_by_value(index, 0, remap_lookup.shape[0] - 1)), IGNORE_LABEL)
+        if compact:
+            # Same layout as read_sample(compact=True), weights are applied later by apply_class_weights
+            return tf.cast(img[0], image_dtype), tf.where(nans, tf.constant(IGNORE_LABEL, tf.uint8), tf.cast(tgt, tf.uint8))
+
+        # NaN masked pixels keep a weight of 1, labels outside of the remapping are target 0 with a weight of 0, same as read_sample
+        ignored = tf.equal(tgt, IGNORE_LABEL)
+        tgt = tf.where(ignored, 0, tgt)
+        weight = tf.where(ignored, 0.0, tf.where(nans, 1.0, tf.gather(weight_lookup, tgt)))
+
+        return img[0], tf.cast(tgt, tf.float32), weight
+
+    ds = tf.data.Dataset.zip((x_ds, y_ds)).apply(tf.data.experimental.assert_cardinality(len(index['y'])))
+    return ds.map(preprocess, num_parallel_calls=num_parallel_calls)
@@ -0,0 +1,314 @@
+'''
+Persistent manifest of every chip in the dataset folders.
+
+Listing ten (network mounted) folders and checking every key on every run is slow.
+The manifest keeps one row per (source folder, chip) in an SQLite database, and is only
+refreshed for folders / files whose mtime changed since the last run.
+
+Chip ids follow the same convention as Dataset.index_dataset
+Bolivia_18962_co_event_coh.tif => Bolivia_18962
+
+Each row also keeps validity statistics computed when the file is indexed, so that empty
+chips (all zero / all NaN, see Dataset-Stats.count_valid_data) can be pruned before any decoding,
+and the per band variance the Lee filter of a patch needs without decoding the whole chip.
+'''
+from dataclasses import dataclass, field
+import json
+import os
+import sqlite3
+from typing import Dict, List
+
+from absl import app, flags
+import numpy as np
+import rasterio
+
+from Preprocessing import plane_variance
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS chips (
+    source  TEXT NOT NULL,      -- Flag name of the folder. 's1_co', 'hand_labels', ...
+    chip    TEXT NOT NULL,      -- Bolivia_18962
+    region  TEXT NOT NULL,      -- Bolivia
+    id      TEXT NOT NULL,      -- 18962
+    path    TEXT NOT NULL,
+    size    INTEGER NOT NULL,
+    mtime   REAL NOT NULL,
+    bands   INTEGER,
+    dtype   TEXT,
+    nan_fraction     REAL,     -- Fraction of pixels that are NaN in any band
+    all_zero         INTEGER,  -- 1 if every non NaN value is zero
+    invalid_fraction REAL,     -- Labels only. Fraction of pixels labelled -1
+    water_fraction   REAL,     -- Labels only. Fraction of pixels labelled 1
+    band_variance    TEXT,     -- Images only. JSON list of the variance of every band, NaN as 0 (Preprocessing.plane_variance)
+    PRIMARY KEY (source, chip)
+);
+CREATE INDEX IF NOT EXISTS chips_by_chip ON chips (chip);
+
+CREATE TABLE IF NOT EXISTS directories (
+    source  TEXT PRIMARY KEY,
+    path    TEXT NOT NULL,
+    mtime   REAL NOT NULL
+);
+'''
+
+LABEL_SOURCES = ['s2_weak', 'hand_labels']
+STAT_COLUMNS = {
+    'nan_fraction': 'REAL',
+    'all_zero': 'INTEGER',
+    'invalid_fraction': 'REAL',
+    'water_fraction': 'REAL',
+    'band_variance': 'TEXT',
+}
+# Rows indexed before one of their statistics existed, they are read again on the next update
+STALE = f"all_zero IS NULL OR (band_variance IS NULL AND source NOT IN ({', '.join(repr(s) for s in LABEL_SOURCES)}))"
+
+is_tif = lambda x: True if x[-4:]==".tif" else False
+
+def chip_statistics(data:np.ndarray, is_label:bool) -> tuple:
+    """Computes the validity statistics stored in the manifest for one chip.
+
+    Args:
+        data (np.ndarray): Chip as read by rasterio. (C, H, W)
+        is_label (bool): Whether the chip is a label chip. Labels are not NaN / zero checked but count -1 and 1 pixels.
+            An all zero label is a valid chip without water.
+
+    Returns:
+        tuple: (nan_fraction, all_zero, invalid_fraction, water_fraction, band_variance)
+    """
+    if is_label:
+        return 0.0, 0, float(np.mean(data == -1)), float(np.mean(data == 1)), None
+
+    nans = np.isnan(data)
+    nan_fraction = float(np.mean(nans.any(axis=0)))
+    all_zero = int( not np.any(data[~nans]) )
+    # Same float32 planes as the speckle filter sees after the NaN imputation
+    variance = plane_variance(np.nan_to_num(data.astype(np.float32), nan=0.0)[np.newaxis])[0]
+    return nan_fraction, all_zero, None, None, json.dumps(variance.tolist())
+
+@dataclass
+class ChipManifest:
+    '''
+    SQLite backed index of every chip available in the dataset folders.
+
+    Usage:
+        manifest = ChipManifest("Results/manifest.sqlite")
+        manifest.update(file_dirs)  # {'s1_co': '/path/to/s1_co', ...}
+        chips = manifest.complete_chips(['s1_co', 's2_weak'])
+    '''
+    db_path: str
+    connection: sqlite3.Connection = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.connection = sqlite3.connect(self.db_path)
+        self.connection.executescript(SCHEMA)
+
+        # Manifests created before the validity statistics existed get the columns added.
+        # Their rows have NULL statistics and are refreshed on the next update.
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(chips)')]
+        for column, type in STAT_COLUMNS.items():
+            if column not in columns:
+                self.connection.execute(f'ALTER TABLE chips ADD COLUMN {column} {type}')
+
+    def update(self, file_dirs:Dict[str, str], full:bool=False) -> int:
+        """Brings the manifest up to date with the folders in file_dirs.
+
+        Folders whose mtime did not change since the last update are not listed again.
+        Inside a changed folder, only files whose size or mtime changed are read again.
+        Reading the file is needed for the validity statistics, this is only paid once per file.
+
+        Args:
+            file_dirs (dict): Maps source name to folder path.
+            full (bool, optional): Rescan every folder even if its mtime did not change.
+                Needed to pick up files overwritten in place. Defaults to False.
+
+        Returns:
+            int: Number of chip rows (re)indexed.
+        """
+        updated = 0
+        with self.connection:
+            for source, folder in file_dirs.items():
+                folder_mtime = os.stat(folder).st_mtime
+                row = self.connection.execute(
+                    'SELECT path, mtime FROM directories WHERE source = ?', (source,)
+                ).fetchone()
+
+                stale = self.connection.execute(
+                    f'SELECT COUNT(*) FROM chips WHERE source = ? AND ({STALE})', (source,)
+                ).fetchone()[0]
+
+                if not full and not stale and row is not None and row[0] == folder and row[1] == folder_mtime:
+                    continue
+
+                updated += self.__update_folder(source, folder, moved = row is not None and row[0] != folder)
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO directories (source, path, mtime) VALUES (?, ?, ?)',
+                    (source, folder, folder_mtime)
+                )
+        return updated
+
+    def __update_folder(self, source:str, folder:str, moved:bool=False) -> int:
+        if moved:
+            self.connection.execute('DELETE FROM chips WHERE source = ?', (source,))
+
+        # Rows without statistics are treated as stale
+        known = {
+            chip: (size, mtime) if not stale else None for chip, size, mtime, stale in
+            self.connection.execute(f'SELECT chip, size, mtime, {STALE} FROM chips WHERE source = ?', (source,))
+        }
+
+        seen = set()
+        rows = []
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if not is_tif(entry.name):
+                    continue
+
+                name = entry.name.split('_')
+                region, id = name[0], name[1]
+                chip = region + '_' + id
+                seen.add(chip)
+
+                stat = entry.stat()
+                if known.get(chip) == (stat.st_size, stat.st_mtime):
+                    continue
+
+                path = folder + '/' + entry.name
+                with rasterio.open(path) as src:
+                    bands, dtype = src.count, src.dtypes[0]
+                    stats = chip_statistics(src.read(), source in LABEL_SOURCES)
+
+                rows.append( (source, chip, region, id, path, stat.st_size, stat.st_mtime, bands, dtype, *stats) )
+
+        self.connection.executemany(
+            '''INSERT OR REPLACE INTO chips
+            (source, chip, region, id, path, size, mtime, bands, dtype, nan_fraction, all_zero, invalid_fraction, water_fraction, band_variance)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            rows
+        )
+
+        gone = [(source, chip) for chip in known.keys() - seen]
+        self.connection.executemany('DELETE FROM chips WHERE source = ? AND chip = ?', gone)
+
+        return len(rows)
+
+    def complete_chips(self, sources:List[str], screened:List[str]=[], max_nan_fraction:float=1.0, max_invalid_fraction:float=1.0, drop_all_zero:bool=False) -> Dict[str, Dict[str, str]]:
+        """Finds every chip that exists in ALL of the given sources with a single query.
+
+        Chips can also be pruned on the validity statistics of the screened sources.
+        Only the sources that are actually used for training should be screened, a NaN coherence chip
+        should not remove the chip from scenario 1.
+
+        Kept chips are not down-weighted per chip: the pixels are. Compact labels give NaN pixels
+        (and with ignore_invalid the -1 labels) a weight of 0, and the sampled xgboost loader drops them, so a partly
+        valid chip already counts with its valid pixels only. A chip weight on top would count the same loss twice.
+
+        Args:
+            sources (list): Source names that must all contain the chip.
+            screened (list, optional): Subset of sources whose statistics are checked against the thresholds.
+            max_nan_fraction (float, optional): Chips with more NaN pixels than this are dropped. Defaults to 1.0.
+            max_invalid_fraction (float, optional): Chips with more -1 label pixels than this are dropped. Defaults to 1.0.
+            drop_all_zero (bool, optional): Drop chips that carry no signal at all. Defaults to False.
+
+        Returns:
+            dict: { chip : { 'region': region, source: path, ... } }, ordered by chip.
+        """
+        marks = ', '.join('?' * len(sources))
+        screened_marks = ', '.join('?' * len(screened))
+        query = f'''
+            SELECT chip, region, source, path FROM chips
+            WHERE source IN ({marks}) AND chip IN (
+                SELECT chip FROM chips WHERE source IN ({marks})
+                GROUP BY chip HAVING COUNT(*) = ? AND SUM(
+                    CASE WHEN source IN ({screened_marks}) AND (
+                        nan_fraction > ? OR invalid_fraction > ? OR (all_zero AND ?)
+                    ) THEN 1 ELSE 0 END
+                ) = 0
+            )
+            ORDER BY chip
+        '''
+        params = (*sources, *sources, len(sources), *screened, max_nan_fraction, max_invalid_fraction, int(drop_all_zero))
+        chips = {}
+        for chip, region, source, path in self.connection.execute(query, params):
+            chips.setdefault(chip, {'region': region})[source] = path
+
+        return chips
+
+    def water_fraction(self, label_paths:list) -> float:
+        """Fraction of water pixels over the given label chips, from the stored statistics.
+
+        Returns:
+            float: None if any of the chips is not indexed (or has no statistics yet)
+        """
+        self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS selected (path TEXT PRIMARY KEY)')
+        with self.connection:
+            self.connection.execute('DELETE FROM selected')
+            self.connection.executemany('INSERT OR IGNORE INTO selected VALUES (?)', [(path,) for path in label_paths])
+            found, water = self.connection.execute('''
+                SELECT COUNT(water_fraction), AVG(water_fraction) FROM chips WHERE path IN (SELECT path FROM selected)
+            ''').fetchone()
+            expected = self.connection.execute('SELECT COUNT(*) FROM selected').fetchone()[0]
+
+        return water if found == expected and found > 0 else None
+
+    def band_variance(self, paths:list) -> Dict[str, np.ndarray]:
+        """Variance of every band of the given image files, from the stored statistics.
+
+        Returns:
+            dict: { path : (bands,) float64 array }. Files that are not indexed (or have no statistics yet) are left out.
+        """
+        self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS selected (path TEXT PRIMARY KEY)')
+        with self.connection:
+            self.connection.execute('DELETE FROM selected')
+            self.connection.executemany('INSERT OR IGNORE INTO selected VALUES (?)', [(path,) for path in paths])
+            rows = self.connection.execute('''
+                SELECT path, band_variance FROM chips WHERE band_variance IS NOT NULL AND path IN (SELECT path FROM selected)
+            ''').fetchall()
+
+        return { path: np.array(json.loads(variance), dtype=np.float64) for path, variance in rows }
+
+    def label_fractions(self, label_paths:list) -> Dict[str, tuple]:
+        """Fraction of water (1) and invalid (-1) pixels of every given label chip, from the stored statistics.
+
+        Returns:
+            dict: { path : (water_fraction, invalid_fraction) }. Chips that are not indexed (or have no statistics yet) are left out.
+        """
+        self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS selected (path TEXT PRIMARY KEY)')
+        with self.connection:
+            self.connection.execute('DELETE FROM selected')
+            self.connection.executemany('INSERT OR IGNORE INTO selected VALUES (?)', [(path,) for path in label_paths])
+            rows = self.connection.execute('''
+                SELECT path, water_fraction, invalid_fraction FROM chips
+                WHERE water_fraction IS NOT NULL AND invalid_fraction IS NOT NULL AND path IN (SELECT path FROM selected)
+            ''').fetchall()
+
+        return { path: (water, invalid) for path, water, invalid in rows }
+
+    def close(self):
+        self.connection.close()
+
+def main(x):
+    from Dataset import get_file_dirs
+    FLAGS = flags.FLAGS
+    manifest = ChipManifest(FLAGS.manifest)
+    print(f'Indexed {manifest.update(get_file_dirs(FLAGS), full=FLAGS.full)} chips')
+
+    for source, count in manifest.connection.execute('SELECT source, COUNT(*) FROM chips GROUP BY source'):
+        print(f'{source}:\t{count}')
+    manifest.close()
+
+if __name__ == "__main__":
+    FLAGS = flags.FLAGS
+    flags.DEFINE_string('manifest', 'Results/manifest.sqlite', 'filepath of the chip manifest database')
+    flags.DEFINE_bool('full', False, 'Rescan every folder even if its mtime did not change')
+    flags.DEFINE_string('s1_co', '/workspaces/Thesis/10m_data/s1_co_event_grd', 'filepath of Sentinel-1 coevent data')
+    flags.DEFINE_string('s1_pre', '/workspaces/Thesis/10m_data/s1_pre_event_grd', 'filepath of Sentinel-1 prevent data')
+    flags.DEFINE_string('s2_weak', '/workspaces/Thesis/10m_data/s2_labels', 'filepath of S2-weak labelled data')
+    flags.DEFINE_string('coh_co', '/workspaces/Thesis/10m_data/coherence/co_event', 'filepath of coherence coevent data')
+    flags.DEFINE_string('coh_pre', '/workspaces/Thesis/10m_data/coherence/pre_event', 'filepath of coherence prevent data')
+
+    flags.DEFINE_string('hand_coh_co', '/workspaces/Thesis/10m_hand/coherence_10m/hand_labeled/co_event', '(h) filepath of coevent data')
+    flags.DEFINE_string('hand_coh_pre', '/workspaces/Thesis/10m_hand/coherence_10m/hand_labeled/pre_event', '(h) filepath of preevent data')
+    flags.DEFINE_string('hand_s1_co', '/workspaces/Thesis/10m_hand/HandLabeled/S1Hand', '(h) filepath of Sentinel-1 coevent data')
+    flags.DEFINE_string('hand_s1_pre', '/workspaces/Thesis/10m_hand/S1_Pre_Event_GRD_Hand_Labeled', '(h) filepath of Sentinel-1 prevent data')
+    flags.DEFINE_string('hand_labels', '/workspaces/Thesis/10m_hand/HandLabeled/LabelHand', 'filepath of hand labelled data')
+    app.run(main)
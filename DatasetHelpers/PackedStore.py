@@ -0,0 +1,126 @@
+'''
+Packs every split of a Dataset into contiguous memory-mapped arrays.
+
+Decoding 1-4 GeoTIFFs + a label for every sample on every epoch is expensive.
+The packer does that once and writes, per split,
+    {split}_x.npy   float32 (N, C, 512, 512)
+    {split}_y.npy   int8    (N, 1, 512, 512)    raw labels, -1 included
+and a sidecar index.json that maps each chip's label path to its (split, row).
+
+Readers open the arrays with np.load(mmap_mode='r') so that slicing a sample is zero-copy
+and every epoch after the first one is served from the page cache.
+'''
+from dataclasses import dataclass, field
+import json
+import os
+from typing import Tuple
+
+from absl import app, flags
+import numpy as np
+
+from ChipReader import ChipReader
+
+SPLITS = ['train', 'val', 'holdout', 'hand']
+CHIP_SIZE = 512
+
+def pack_dataset(ds, out_dir:str) -> dict:
+    """Writes every split of the dataset into out_dir.
+
+    Args:
+        ds (Dataset): Dataset created by DatasetHelpers.create_dataset()
+        out_dir (str): Directory to write the packed arrays and index to.
+
+    Returns:
+        dict: The written index.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    reader = ChipReader(chip_size=CHIP_SIZE)
+    index = {'scenario': ds.scenario, 'splits': {}}
+
+    for split in SPLITS:
+        x_paths, y_paths = getattr(ds, f'x_{split}'), getattr(ds, f'y_{split}')
+        channels = reader.count_channels(x_paths[0]) if len(x_paths) > 0 else 0
+
+        x = np.lib.format.open_memmap(f'{out_dir}/{split}_x.npy', mode='w+', dtype=np.float32, shape=(len(x_paths), channels, CHIP_SIZE, CHIP_SIZE))
+        y = np.lib.format.open_memmap(f'{out_dir}/{split}_y.npy', mode='w+', dtype=np.int8, shape=(len(y_paths), 1, CHIP_SIZE, CHIP_SIZE))
+
+        for row, (scenes, targets) in enumerate(zip(x_paths, y_paths)):
+            # Read straight into the mapped rows, no intermediate arrays
+            reader.read(scenes, out=x[row])
+            y[row] = reader.read_label(targets[0], remap=False)
+
+        x.flush()
+        y.flush()
+        del x, y
+
+        index['splits'][split] = {
+            'channels': channels,
+            'x': [list(scenes) for scenes in x_paths],
+            'y': [list(targets) for targets in y_paths],
+        }
+        print(f'Packed {split}: {len(x_paths)} chips')
+
+    with open(f'{out_dir}/index.json', 'w') as f:
+        json.dump(index, f)
+
+    return index
+
+@dataclass
+class PackedStore:
+    '''
+    Read-only view over a directory written by pack_dataset().
+
+    Samples are looked up by their label path so that the store keeps working when the
+    train / val split of a Dataset is reshuffled on a later run.
+    '''
+    root: str
+    scenario: int = field(init=False)
+    x: dict = field(init=False, repr=False)
+    y: dict = field(init=False, repr=False)
+    rows: dict = field(init=False, repr=False)
+
+    def __post_init__(self):
+        with open(f'{self.root}/index.json') as f:
+            index = json.load(f)
+
+        self.scenario = index['scenario']
+        self.x, self.y, self.rows = {}, {}, {}
+        for split, info in index['splits'].items():
+            self.x[split] = np.load(f'{self.root}/{split}_x.npy', mmap_mode='r')
+            self.y[split] = np.load(f'{self.root}/{split}_y.npy', mmap_mode='r')
+            for row, targets in enumerate(info['y']):
+                self.rows[targets[0]] = (split, row)
+
+    def __contains__(self, label_path:str) -> bool:
+        return label_path in self.rows
+
+    def read(self, label_path:str) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns read-only (C, 512, 512) image and (1, 512, 512) raw label views of a chip. No data is copied.
+        """
+        split, row = self.rows[label_path]
+        return self.x[split][row], self.y[split][row]
+
+def main(x):
+    from Dataset import create_dataset
+    FLAGS = flags.FLAGS
+    ds = create_dataset(FLAGS)
+    pack_dataset(ds, FLAGS.packed_dir)
+
+if __name__ == "__main__":
+    FLAGS = flags.FLAGS
+    flags.DEFINE_integer("scenario", 1, "Training data scenario. \n\t 1: Only co_event \n\t 2: coevent & preevent \n\t 3: coevent & preevent & coherence")
+    flags.DEFINE_string('packed_dir', None, 'Directory to write the packed dataset to')
+    flags.DEFINE_string('manifest', None, 'filepath of the chip manifest database. If set, the dataset is built from it instead of listing every folder')
+    flags.DEFINE_string('s1_co', '/workspaces/Thesis/10m_data/s1_co_event_grd', 'filepath of Sentinel-1 coevent data')
+    flags.DEFINE_string('s1_pre', '/workspaces/Thesis/10m_data/s1_pre_event_grd', 'filepath of Sentinel-1 prevent data')
+    flags.DEFINE_string('s2_weak', '/workspaces/Thesis/10m_data/s2_labels', 'filepath of S2-weak labelled data')
+    flags.DEFINE_string('coh_co', '/workspaces/Thesis/10m_data/coherence/co_event', 'filepath of coherence coevent data')
+    flags.DEFINE_string('coh_pre', '/workspaces/Thesis/10m_data/coherence/pre_event', 'filepath of coherence prevent data')
+
+    flags.DEFINE_string('hand_coh_co', '/workspaces/Thesis/10m_hand/coherence_10m/hand_labeled/co_event', '(h) filepath of coevent data')
+    flags.DEFINE_string('hand_coh_pre', '/workspaces/Thesis/10m_hand/coherence_10m/hand_labeled/pre_event', '(h) filepath of preevent data')
+    flags.DEFINE_string('hand_s1_co', '/workspaces/Thesis/10m_hand/HandLabeled/S1Hand', '(h) filepath of Sentinel-1 coevent data')
+    flags.DEFINE_string('hand_s1_pre', '/workspaces/Thesis/10m_hand/S1_Pre_Event_GRD_Hand_Labeled', '(h) filepath of Sentinel-1 prevent data')
+    flags.DEFINE_string('hand_labels', '/workspaces/Thesis/10m_hand/HandLabeled/LabelHand', 'filepath of hand labelled data')
+    flags.mark_flag_as_required('packed_dir')
+    app.run(main)
@@ -4,12 +4,20 @@ Functions defined for the preprocessing pipeline are defined here
 Looking to implement
 
 -   Border noise corrections
--   Mono and Bitemporal Speckle filters (Lee, Refined Lee)
+
+Speckle filters (SPECKLE_FILTERS), batched over (N, C, H, W) float32 stacks
+
+-   Lee                 lee_filter_batch
+-   Refined Lee         refined_lee_filter_batch
+-   Multi-temporal      multitemporal_filter, co-event + pre-event jointly
 
 '''
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
+from functools import lru_cache
 import os
+import threading
 from typing import Tuple
 from absl import app, flags
 
@@ -53,6 +61,329 @@ def lee_filter(image:np.ndarray, size:int = 7) -> np.ndarray:
 
     return filtered
 
+_scratch = threading.local()
+_pool = None
+_pool_lock = threading.Lock()
+
+def _plane_pool() -> ThreadPoolExecutor:
+    # One pool for the whole process, created on first use: its threads keep their scratch buffers between calls
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix='speckle_filter')
+    return _pool
+
+def _lee_filter_plane(src:np.ndarray, dst:np.ndarray, size:int, img_var:float = None):
+    """Lee filter of one (H, W) float32 plane into dst. Scratch buffers are reused per thread.
+    img_var overrides the variance of the plane, e.g. the variance of the whole chip when src is a window of it.
+    """
+    EPSILON = 1e-9
+    if getattr(_scratch, 'shape', None) != src.shape:
+        _scratch.shape = src.shape
+        _scratch.means = np.empty(src.shape, dtype=np.float32)
+        _scratch.sqr = np.empty(src.shape, dtype=np.float32)
+        _scratch.means_sqr = np.empty(src.shape, dtype=np.float32)
+    means, sqr, means_sqr = _scratch.means, _scratch.sqr, _scratch.means_sqr
+
+    # Normalized box filter == filter2D with the averaging kernel, both reflect the border (BORDER_REFLECT_101)
+    cv.boxFilter(src, cv.CV_32F, (size, size), dst=means, borderType=cv.BORDER_REFLECT_101)
+    np.multiply(src, src, out=sqr)
+    cv.boxFilter(sqr, cv.CV_32F, (size, size), dst=means_sqr, borderType=cv.BORDER_REFLECT_101)
+
+    if img_var is None:
+        img_var = np.mean(sqr, dtype=np.float64) - np.mean(src, dtype=np.float64)**2
+
+    # patch_var --> means_sqr, patch_weights --> sqr
+    np.subtract(means_sqr, np.multiply(means, means, out=sqr), out=means_sqr)
+    np.divide(means_sqr, np.add(means_sqr, np.float32(img_var + EPSILON), out=sqr), out=sqr)
+
+    # filtered = patch_means + patch_weights * (image - patch_means)
+    np.subtract(src, means, out=dst)
+    np.multiply(sqr, dst, out=dst)
+    np.add(means, dst, out=dst)
+
+def _map_planes(filter_plane, images:np.ndarray, out:np.ndarray, workers:int, size:int, plane_args:np.ndarray = None) -> np.ndarray:
+    """Runs filter_plane(src, dst, size) over every (H, W) plane of an (N, C, H, W) stack on the shared thread pool,
+    split in at most workers chunks. workers=1 runs in the calling thread, e.g. inside the parallel tf.data maps.
+    If plane_args (N, C) is given, plane_args[n, c] is passed as 4th argument.
+    """
+    images = np.ascontiguousarray(images, dtype=np.float32)
+    if out is None:
+        out = np.empty(images.shape, dtype=np.float32)
+
+    planes = [ (n, c) for n in range(images.shape[0]) for c in range(images.shape[1]) ]
+    def run(plane):
+        n, c = plane
+        # When filtering in place, the source plane is copied before dst overwrites it
+        src = images[n, c].copy() if np.may_share_memory(images, out) else images[n, c]
+        filter_plane(src, out[n, c], size, *(() if plane_args is None else (plane_args[n, c],)))
+
+    def run_chunk(chunk):
+        for plane in chunk:
+            run(plane)
+
+    workers = min(workers or os.cpu_count(), len(planes))
+    if workers <= 1:
+        run_chunk(planes)
+    else:
+        for _ in _plane_pool().map(run_chunk, [ planes[w::workers] for w in range(workers) ]):
+            pass
+
+    return out
+
+def plane_variance(images:np.ndarray) -> np.ndarray:
+    """(N, C) float64 variance of every plane of an (N, C, H, W) stack, as computed by lee_filter_batch.
+    """
+    images = np.asarray(images, dtype=np.float32)
+    return np.mean(images * images, axis=(2, 3), dtype=np.float64) - np.mean(images, axis=(2, 3), dtype=np.float64)**2
+
+def lee_filter_batch(images:np.ndarray, size:int = 7, out:np.ndarray = None, workers:int = None, variance:np.ndarray = None) -> np.ndarray:
+    """Batched float32 lee_filter. It is applied per channel of every chip.
+
+    Same filter as lee_filter, but the planes of the whole stack are spread over a thread pool
+    (OpenCV and numpy release the GIL) and every intermediate stays float32 in reused buffers.
+
+    Args:
+        images (np.array): Unfiltered (N, C, H, W) stack. Example size: (16,2,512,512)
+        size (int, optional): Kernel size (N by N). Should be odd in order to have a 'center'. Defaults to 7.
+        out (np.array, optional): float32 (N, C, H, W) output buffer. Can be images itself when it is float32.
+        workers (int, optional): Threads of the shared pool. Defaults to the cpu count, 1 runs in the calling thread.
+        variance (np.array, optional): (N, C) image variance of every plane (plane_variance), instead of computing it
+            from images. Windows of a chip filtered with the variance of the whole chip equal crops of the filtered chip.
+
+    Returns:
+        np.ndarray: Filtered float32 stack
+    """
+    return _map_planes(_lee_filter_plane, images, out, workers, size, plane_args=variance)
+
+@lru_cache(maxsize=None)
+def _directional_kernels(size:int) -> tuple:
+    """The 8 edge aligned half windows of the refined Lee filter, as normalized (size, size) kernels.
+
+    Ordered as pairs of opposite halves, one pair per edge orientation:
+        left / right, top / bottom, upper left / lower right triangle, upper right / lower left triangle
+    Every half includes the center line of the window. _refined_lee_filter_plane only filters with the triangles,
+    the rectangular halves are box sums.
+    """
+    i, j = np.mgrid[0:size, 0:size]
+    center = size // 2
+    halves = [
+        j <= center, j >= center,
+        i <= center, i >= center,
+        i + j <= size - 1, i + j >= size - 1,
+        j >= i, j <= i,
+    ]
+    return tuple( half.astype(np.float32) / np.count_nonzero(half) for half in halves )
+
+def _grid_mean_of_5_smallest(x:np.ndarray, step:int, H:int, W:int, out:np.ndarray, columns:np.ndarray, work:np.ndarray) -> np.ndarray:
+    """Element wise mean of the 5 smallest of the 3x3 grid x[dy:dy+H, dx:dx+W], dy, dx in (0, step, 2*step), into out.
+
+    The grid cells are shifted views of the same plane, so every vertical triple is sorted once (lo <= mid <= hi)
+    and shared by the 3 pixels whose grid uses it. Once the 3 triples of a pixel are also sorted across, rows and
+    columns of its grid are sorted and the 4 largest are max(hi), median(hi), max(mid) and the largest of
+    min(hi), max(lo), median(mid). The 5 smallest sum to sum(lo) + sum(mid) + min(hi) - max(mid) - that largest.
+
+    Args:
+        x (np.array): (H + 2*step, W + 2*step) plane
+        columns (np.array): (4, H, W + 2*step) scratch
+        work (np.array): (3, H, W) scratch
+    """
+    lo, mid, hi, tmp = columns
+    t0, t1, t2 = ( x[dy:dy+H] for dy in (0, step, 2*step) )
+    np.minimum(t0, t1, out=lo)
+    np.maximum(t0, t1, out=hi)
+    np.minimum(hi, t2, out=mid)
+    np.maximum(hi, t2, out=hi)
+    np.maximum(lo, mid, out=tmp)
+    np.minimum(lo, mid, out=lo)
+    mid, lo_mid = tmp, mid
+    np.add(lo, mid, out=lo_mid)
+
+    def across(a):
+        return [ a[:, dx:dx+W] for dx in (0, step, 2*step) ]
+    lo, mid, hi, lo_mid = across(lo), across(mid), across(hi), across(lo_mid)
+    min_hi, a, b = work
+
+    np.add(lo_mid[0], lo_mid[1], out=out)
+    out += lo_mid[2]
+    np.minimum(np.minimum(hi[0], hi[1], out=min_hi), hi[2], out=min_hi)
+    out += min_hi
+    np.maximum(np.maximum(mid[0], mid[1], out=a), mid[2], out=a)
+    out -= a
+
+    # median(mid) = max(min(m0, m1), min(max(m0, m1), m2))
+    np.minimum(mid[0], mid[1], out=a)
+    np.minimum(np.maximum(mid[0], mid[1], out=b), mid[2], out=b)
+    np.maximum(a, b, out=a)
+    np.maximum(min_hi, a, out=a)
+    np.maximum(np.maximum(lo[0], lo[1], out=b), lo[2], out=b)
+    np.maximum(a, b, out=a)
+    out -= a
+    out *= np.float32(1 / 5)
+    return out
+
+def _refined_lee_filter_plane(src:np.ndarray, dst:np.ndarray, size:int):
+    """Refined Lee filter of one (H, W) float32 plane into dst. Scratch buffers are reused per thread.
+
+    The plane is padded by half a window (BORDER_REFLECT_101, like the box filters), then the sub windows of every pixel
+    are shifted views of one box filter, and its half window is gathered from 6 shared planes: the left and top halves
+    are box sums, the right and bottom halves the same box sums half a window further, the 4 triangles are filtered.
+    """
+    EPSILON = 1e-9
+    H, W = src.shape
+    half = size // 2
+    # 3x3 grid of sub windows tiling the window, e.g. 3x3 sub windows 2 pixels apart for a 7x7 window
+    sub = (size // 3) | 1
+    step = (size - sub) // 2
+    Hp, Wp = H + 2*half, W + 2*half
+    if getattr(_scratch, 'refined_shape', None) != (H, W, size):
+        _scratch.refined_shape = (H, W, size)
+        _scratch.padded = np.empty((2, Hp, Wp), dtype=np.float32)
+        _scratch.sub = np.empty((3, Hp, Wp), dtype=np.float32)
+        _scratch.halves = np.empty((2, 6, Hp, Wp), dtype=np.float32)
+        _scratch.columns = np.empty((4, H, W + 2*step), dtype=np.float32)
+        _scratch.work = np.empty((5, H, W), dtype=np.float32)
+        _scratch.flags = np.empty((3, H, W), dtype=np.uint8)
+        _scratch.index = np.empty((H, W), dtype=np.intp)
+        # Flat index of every pixel in a padded plane
+        _scratch.base = (np.arange(H)[:, None] + half) * Wp + (np.arange(W) + half)
+    padded, sqr = _scratch.padded
+    sub_means, sub_cv, tmp = _scratch.sub
+    noise, gradient, largest, dist_a, dist_b = _scratch.work
+    direction, side, steeper = _scratch.flags
+
+    cv.copyMakeBorder(src, half, half, half, half, cv.BORDER_REFLECT_101, dst=padded)
+    np.multiply(padded, padded, out=sqr)
+
+    # Squared coefficient of variation of the sub windows
+    cv.boxFilter(padded, cv.CV_32F, (sub, sub), dst=sub_means, borderType=cv.BORDER_REFLECT_101)
+    cv.boxFilter(sqr, cv.CV_32F, (sub, sub), dst=sub_cv, borderType=cv.BORDER_REFLECT_101)
+    np.subtract(sub_cv, np.multiply(sub_means, sub_means, out=tmp), out=sub_cv)
+    tmp += EPSILON
+    np.divide(sub_cv, tmp, out=sub_cv)
+
+    # Noise level: mean of the 5 most homogeneous sub windows
+    o = half - step # Padded offset of the upper left sub window
+    _grid_mean_of_5_smallest(sub_cv[o:o+H+2*step, o:o+W+2*step], step, H, W, noise, _scratch.columns, _scratch.work[1:4])
+
+    # Edge orientation = largest gradient between opposite sub windows
+    # left-right, top-bottom, upper left-lower right, upper right-lower left.
+    # Side of the edge the center pixel belongs to = sub window closest to the center
+    means = [ sub_means[o+dy:o+dy+H, o+dx:o+dx+W] for dy in (0, step, 2*step) for dx in (0, step, 2*step) ]
+    center = means[4]
+    opposite = [ (3, 5), (1, 7), (0, 8), (2, 6) ]
+    largest.fill(-1)
+    direction.fill(0)
+    for k, (a, b) in enumerate(opposite):
+        cv.absdiff(means[a], means[b], dst=gradient)
+        np.greater(gradient, largest, out=steeper.view(bool))
+        np.maximum(largest, gradient, out=largest)
+
+        cv.absdiff(means[a], center, dst=dist_a)
+        cv.absdiff(means[b], center, dst=dist_b)
+        np.less(dist_b, dist_a, out=side.view(bool))
+        # direction = 2k + side where steeper, as uint8 arithmetic (a masked copy is several times slower)
+        side += np.uint8(2*k)
+        side -= direction
+        side *= steeper
+        direction += side
+
+    # Half window means of the plane and of its square, ordered as _directional_kernels
+    # left, top, upper left, lower right, upper right, lower left
+    for halves, x in zip(_scratch.halves, (padded, sqr)):
+        cv.boxFilter(x, cv.CV_32F, (half + 1, size), dst=halves[0], anchor=(half, half), borderType=cv.BORDER_REFLECT_101)
+        cv.boxFilter(x, cv.CV_32F, (size, half + 1), dst=halves[1], anchor=(half, half), borderType=cv.BORDER_REFLECT_101)
+        for d, kernel in enumerate(_directional_kernels(size)[4:]):
+            cv.filter2D(x, cv.CV_32F, kernel, dst=halves[2 + d], borderType=cv.BORDER_REFLECT_101)
+
+    # Gather the selected half of every pixel with flat indices into the (6, Hp, Wp) stacks
+    # right = left half a window to the right, bottom = top half a window lower
+    plane = Hp * Wp
+    offsets = np.array([0, half, plane, plane + half * Wp, 2*plane, 3*plane, 4*plane, 5*plane], dtype=np.intp)
+    index = np.take(offsets, direction, out=_scratch.index)
+    index += _scratch.base
+    dir_means, dir_var, weights = gradient, largest, dist_a
+    np.take(_scratch.halves[0], index, out=dir_means)
+    np.take(_scratch.halves[1], index, out=dir_var)
+
+    # Multiplicative speckle model: var(x) = (var(y) - mean(y)**2 * noise) / (1 + noise), weight = var(x) / var(y)
+    np.multiply(dir_means, dir_means, out=weights)
+    dir_var -= weights
+    weights *= noise
+    np.subtract(dir_var, weights, out=weights)
+    noise += 1
+    weights /= noise
+    dir_var += EPSILON
+    weights /= dir_var
+    np.clip(weights, 0, 1, out=weights)
+    np.subtract(src, dir_means, out=dst)
+    dst *= weights
+    dst += dir_means
+
+def refined_lee_filter_batch(images:np.ndarray, size:int = 7, out:np.ndarray = None, workers:int = None) -> np.ndarray:
+    """Refined Lee filter (Lee 1981). It is applied per channel of every chip.
+
+    Instead of the full window, every pixel is averaged over the half window on its side of the
+    strongest local edge, which keeps edges (e.g. shore lines) sharp while still smoothing speckle.
+        -   The window is tiled by a 3x3 grid of sub windows.
+        -   The edge orientation is the one with the largest gradient between opposite sub windows,
+            the side is the sub window closest to the center.
+        -   The noise level is estimated per pixel from the 5 most homogeneous sub windows.
+
+    Args:
+        images (np.array): Unfiltered (N, C, H, W) stack.
+        size (int, optional): Window size (N by N). Should be odd. Defaults to 7.
+        out (np.array, optional): float32 (N, C, H, W) output buffer. Can be images itself when it is float32.
+        workers (int, optional): Threads. Defaults to the cpu count, 1 runs in the calling thread.
+
+    Returns:
+        np.ndarray: Filtered float32 stack
+    """
+    return _map_planes(_refined_lee_filter_plane, images, out, workers, size)
+
+def _box_filter_plane(src:np.ndarray, dst:np.ndarray, size:int):
+    cv.boxFilter(src, cv.CV_32F, (size, size), dst=dst, borderType=cv.BORDER_REFLECT_101)
+
+def multitemporal_filter(images:np.ndarray, size:int = 7, out:np.ndarray = None, workers:int = None) -> np.ndarray:
+    """Multi-temporal speckle filter (Quegan & Yu 2001). The channels of every chip are filtered jointly.
+
+    Made for the co-event + pre-event stack: speckle is uncorrelated between acquisitions,
+    so every channel is smoothed with the local ratios of all the others, in a single pass
+        J_k = E[I_k] / C * sum_i ( I_i / E[I_i] )
+    where E[.] is the local mean over a size x size window and C the number of channels.
+    Pixels with a local mean of zero (e.g. imputed NaNs) keep their own value.
+
+    Args:
+        images (np.array): Unfiltered (N, C, H, W) stack. Example size: (16,4,512,512) co VV, co VH, pre VV, pre VH
+        size (int, optional): Kernel size (N by N). Should be odd in order to have a 'center'. Defaults to 7.
+        out (np.array, optional): float32 (N, C, H, W) output buffer. Can be images itself when it is float32.
+        workers (int, optional): Threads of the local means. Defaults to the cpu count, 1 runs in the calling thread.
+
+    Returns:
+        np.ndarray: Filtered float32 stack
+    """
+    EPSILON = 1e-9
+    images = np.ascontiguousarray(images, dtype=np.float32)
+    if out is not None and np.may_share_memory(images, out):
+        images = images.copy()
+    means = _map_planes(_box_filter_plane, images, None, workers, size)
+
+    valid = np.abs(means) > EPSILON
+    ratios = np.divide(images, means, out=np.ones_like(images), where=valid)
+    ratio_mean = ratios.mean(axis=1, keepdims=True) # Over the channels of every chip
+
+    if out is None:
+        out = np.empty(images.shape, dtype=np.float32)
+    np.multiply(means, ratio_mean, out=out)
+    np.copyto(out, images, where=~valid)
+    return out
+
+SPECKLE_FILTERS = {
+    'lee': lee_filter_batch,
+    'refined_lee': refined_lee_filter_batch,
+    'multitemporal': multitemporal_filter,
+}
+
 # def lee_filter(img, size:int=7):
 #     img_mean = uniform_filter(img, (size, size))
 #     img_sqr_mean = uniform_filter(img**2, (size, size))
@@ -71,6 +402,7 @@ def debug_mean_filter(image:np.ndarray, size:int=10) -> np.ndarray:
 
 def _test():
     from Dataset import create_dataset
+    from Cache import PreprocessCache
     FLAGS = flags.FLAGS
     flags.DEFINE_bool("debug", False, "Set logging level to debug")
     flags.DEFINE_integer("scenario", 1, "Training data scenario. \n\t 1: Only co_event \n\t 2: coevent & preevent \n\t 3: coevent & preevent & coherence")
@@ -87,8 +419,10 @@ def _test():
     flags.DEFINE_string('hand_s1_co', '/workspaces/Thesis/10m_hand/HandLabeled/S1Hand', '(h) filepath of Sentinel-1 coevent data')
     flags.DEFINE_string('hand_s1_pre', '/workspaces/Thesis/10m_hand/S1_Pre_Event_GRD_Hand_Labeled', '(h) filepath of Sentinel-1 prevent data')
     flags.DEFINE_string('hand_labels', '/workspaces/Thesis/10m_hand/HandLabeled/LabelHand', 'filepath of hand labelled data')
+    flags.DEFINE_string('cache_dir', None, 'Directory of the preprocessing cache. Repeated runs skip the speckle filter')
 
     ds = create_dataset(FLAGS)
+    cache = PreprocessCache(FLAGS.cache_dir) if FLAGS.cache_dir else None
 
     # Generate a whole bunch of lee filtered images
     random_index = np.random.randint( low=0, high=ds.x_train.shape[0]-1, size=(30) )
@@ -109,7 +443,10 @@ def _test():
 
             
             # Apply pipeline
-            filtered = lee_filter(img, size=9)
+            if cache is not None:
+                filtered = cache.fetch([original_co_path], {'stage': 'lee_filter', 'size': 9}, lambda: {'img': lee_filter(img, size=9)})['img']
+            else:
+                filtered = lee_filter(img, size=9)
 
             fig, axes = plt.subplots(1, 2)
 
@@ -0,0 +1,224 @@
+'''
+Sharded TFRecord export of the preprocessed samples.
+
+Every element of convert_to_tfds goes through tf.py_function, which serializes on the GIL.
+The exporter runs read_sample once per chip and writes its outputs
+    image   float32 (C, 512, 512)   after NaN imputation + speckle filter
+    label   uint8   (512, 512)      after the label remapping
+    mask    uint8   (512, 512)      1 where any input channel was NaN, 2 where the label is outside of the remapping (weight 0)
+into GZIP compressed shards {split}-00000-of-00008.tfrecord.gz.
+
+read_tfrecords() interleaves over the shards with parallel calls and only uses TensorFlow ops,
+so reading scales with the CPU cores instead of a single interpreter.
+'''
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import multiprocessing
+import os
+import time
+
+from absl import app, flags
+import numpy as np
+import tensorflow as tf
+
+CHIP_SIZE = 512
+
+FEATURES = {
+    'image': tf.io.FixedLenFeature([], tf.string),
+    'label': tf.io.FixedLenFeature([], tf.string),
+    'mask': tf.io.FixedLenFeature([], tf.string),
+    'channels': tf.io.FixedLenFeature([], tf.int64),
+}
+
+def _bytes_feature(value:bytes) -> tf.train.Feature:
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+def _int64_feature(value:int) -> tf.train.Feature:
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+def serialize_sample(img:np.ndarray, tgt:np.ndarray, mask:np.ndarray) -> bytes:
+    """Serializes one preprocessed sample. img is (C, H, W), tgt and mask are (H, W)
+    """
+    example = tf.train.Example(features=tf.train.Features(feature={
+        'image': _bytes_feature(np.ascontiguousarray(img, dtype=np.float32).tobytes()),
+        'label': _bytes_feature(np.ascontiguousarray(tgt, dtype=np.uint8).tobytes()),
+        'mask': _bytes_feature(np.ascontiguousarray(mask, dtype=np.uint8).tobytes()),
+        'channels': _int64_feature(img.shape[0]),
+    }))
+    return example.SerializeToString()
+
+_read_sample = None
+
+def _init_worker(channel_size:int, baseline:bool, packed_dir:str, speckle_filter:str):
+    # Every process builds its own read_sample, memory maps can not be shared with the parent
+    global _read_sample
+    from Dataset import construct_read_sample_function
+    from PackedStore import PackedStore
+    packed = PackedStore(packed_dir) if packed_dir else None
+    # CHW so the serialized image does not depend on the training format
+    _read_sample = construct_read_sample_function(channel_size, format="CHW", baseline=baseline, packed=packed, speckle_filter=speckle_filter, numpy=True)
+
+def _write_shard(filename:str, samples:list) -> int:
+    # Written under a temporary name and renamed once complete, so an interrupted run never leaves a partial shard behind
+    tmp = f'{filename}.tmp'
+    with tf.io.TFRecordWriter(tmp, options='GZIP') as writer:
+        for paths in samples:
+            img, tgt, weights = _read_sample([p.encode('utf-8') for p in paths])
+            mask = np.ma.getmaskarray(tgt).astype(np.uint8)
+            mask[weights == 0] = 2 # With the default (positive) class weights, only labels outside of the remapping weigh 0
+            writer.write(serialize_sample(img, np.ma.getdata(tgt), mask))
+    os.replace(tmp, filename)
+    return len(samples)
+
+def export_tfrecords(ds, channel_size:int, out_dir:str, shards:int=8, baseline=False, packed=None, workers:int=None, speckle_filter:str='lee'):
+    """Runs the read_sample pipeline over every split of the dataset and writes the sharded TFRecords.
+
+    Shards are written by a pool of processes. The shard plan is saved first (plan.json) and finished shards are
+    skipped, so an interrupted export resumes where it stopped when it is run again with the same out_dir.
+    The train / val split is then the one of the first run.
+
+    Args:
+        ds (Dataset): Dataset created by DatasetHelpers.create_dataset()
+        channel_size (int): Channel size of the dataset
+        out_dir (str): Directory to write the shards to.
+        shards (int, optional): Shards per split. Defaults to 8.
+        baseline (bool, optional): Skip the preprocessing pipeline, same as convert_to_tfds. Defaults to False.
+        packed (PackedStore, optional): Read the chips from a packed store instead of the GeoTIFFs.
+        workers (int, optional): Processes writing shards. Defaults to the cpu count.
+        speckle_filter (str, optional): "lee", "refined_lee" or "multitemporal". Defaults to 'lee'.
+    """
+    from PackedStore import SPLITS
+
+    os.makedirs(out_dir, exist_ok=True)
+    settings = {'channels': channel_size, 'baseline': baseline, 'speckle_filter': speckle_filter}
+
+    if os.path.exists(f'{out_dir}/plan.json'):
+        with open(f'{out_dir}/plan.json') as f:
+            plan = json.load(f)
+        if plan['settings'] != settings:
+            raise ValueError(f'{out_dir} was started with {plan["settings"]}, not {settings}. Use another directory')
+    else:
+        plan = {'settings': settings, 'splits': {}, 'shards': {}}
+        for split in SPLITS:
+            samples = [ (*x, *y) for x, y in zip(getattr(ds, f'x_{split}'), getattr(ds, f'y_{split}')) ]
+            split_shards = max(1, min(shards, len(samples)))
+            for i in range(split_shards):
+                plan['shards'][f'{split}-{i:05d}-of-{split_shards:05d}.tfrecord.gz'] = [list(paths) for paths in samples[i::split_shards]]
+            plan['splits'][split] = len(samples)
+
+        with open(f'{out_dir}/plan.json', 'w') as f:
+            json.dump(plan, f)
+
+    jobs = { name: samples for name, samples in plan['shards'].items() if not os.path.exists(f'{out_dir}/{name}') }
+    total = sum(len(samples) for samples in jobs.values())
+    print(f'{len(plan["shards"]) - len(jobs)}/{len(plan["shards"])} shards already written, {total} chips left')
+
+    if len(jobs) > 0:
+        context = multiprocessing.get_context('spawn') # TensorFlow is not fork safe
+        initargs = (channel_size, baseline, packed.root if packed is not None else None, speckle_filter)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker, initargs=initargs) as pool:
+            futures = [ pool.submit(_write_shard, f'{out_dir}/{name}', samples) for name, samples in jobs.items() ]
+
+            done, t1 = 0, time.time()
+            for future in as_completed(futures):
+                done += future.result()
+                elapsed = time.time() - t1
+                print(f'{done}/{total} chips \t {done / elapsed:.2f} chips/s \t {elapsed:.0f} s')
+
+    info = {**settings, 'splits': plan['splits']}
+    with open(f'{out_dir}/info.json', 'w') as f:
+        json.dump(info, f)
+
+    print(f'Exported {info["splits"]} samples to {out_dir}')
+
+def read_tfrecords(tfrecord_dir:str, split:str, channel_size:int, format:str='HWC', class_weights:dict=None, cycle_length:int=None, num_parallel_calls:int=tf.data.AUTOTUNE, deterministic:bool=None, compact:bool=False, image_dtype:tf.DType=tf.float32, baseline:bool=False, speckle_filter:str='lee') -> tf.data.Dataset:
+    """Reads one split of an exported TFRecord directory.
+
+    Elements match the output of convert_to_tfds: (image, target, weight) as float32.
+    The weight map is built on graph from the label. Like read_sample, NaN masked pixels keep a weight of 1.
+
+    Args:
+        tfrecord_dir (str): Directory written by export_tfrecords
+        split (str): "train" "val" "holdout" "hand"
+        channel_size (int): Expected channel size, checked against the exported data
+        format (str, optional): "HWC" or "CHW". Defaults to 'HWC'.
+        class_weights (dict, optional): { class : weight }. Defaults to uniform weights.
+        cycle_length (int, optional): Shards read concurrently. Defaults to AUTOTUNE.
+        num_parallel_calls (int, optional): Parallelism of the interleave and parse. Defaults to AUTOTUNE.
+        deterministic (bool, optional): Passed to interleave / map. Defaults to the tf.data options.
+        compact (bool, optional): Return (image, uint8 label) with masked pixels labelled 255 instead of (image, target, weight).
+        image_dtype (tf.DType, optional): Image dtype of compact elements. Defaults to float32.
+        baseline (bool, optional): Expected baseline setting, checked against the exported data. Defaults to False.
+        speckle_filter (str, optional): Expected speckle filter, checked against the exported data. Defaults to 'lee'.
+    """
+    with open(f'{tfrecord_dir}/info.json') as f:
+        info = json.load(f)
+    if info['channels'] != channel_size:
+        raise ValueError(f'{tfrecord_dir} was exported with {info["channels"]} channels, expected {channel_size}')
+    exported = {'baseline': info['baseline'], 'speckle_filter': info.get('speckle_filter', 'lee')} # Older exports only had the Lee filter
+    expected = {'baseline': baseline, 'speckle_filter': speckle_filter}
+    if exported != expected:
+        raise ValueError(f'{tfrecord_dir} was exported with {exported}, expected {expected}. Export it again or match the flags')
+
+    class_weights = class_weights or {0: 1.0, 1: 1.0}
+    weight_lookup = tf.constant([class_weights[k] for k in sorted(class_weights.keys())], dtype=tf.float32)
+
+    def parse(record):
+        sample = tf.io.parse_single_example(record, FEATURES)
+        img = tf.reshape(tf.io.decode_raw(sample['image'], tf.float32), (channel_size, CHIP_SIZE, CHIP_SIZE))
+        tgt = tf.reshape(tf.io.decode_raw(sample['label'], tf.uint8), (CHIP_SIZE, CHIP_SIZE))
+        mask = tf.reshape(tf.io.decode_raw(sample['mask'], tf.uint8), (CHIP_SIZE, CHIP_SIZE))
+
+        if format == "HWC":
+            img = tf.transpose(img, (1, 2, 0))
+
+        if compact:
+            # Same layout as read_sample(compact=True), weights are applied later by apply_class_weights
+            return tf.cast(img, image_dtype), tf.where(mask > 0, tf.constant(255, tf.uint8), tgt)
+
+        # NaN masked pixels keep a weight of 1, labels outside of the remapping get 0, same as read_sample
+        weight = tf.where(mask == 2, 0.0, tf.where(mask > 0, 1.0, tf.gather(weight_lookup, tf.cast(tgt, tf.int32))))
+        return img, tf.cast(tgt, tf.float32), weight
+
+    files = tf.data.Dataset.list_files(f'{tfrecord_dir}/{split}-*.tfrecord.gz', shuffle=False)
+    ds = files.interleave(
+        lambda filename: tf.data.TFRecordDataset(filename, compression_type='GZIP'),
+        cycle_length=cycle_length,
+        num_parallel_calls=num_parallel_calls,
+        deterministic=deterministic,
+    )
+    ds = ds.map(parse, num_parallel_calls=num_parallel_calls, deterministic=deterministic)
+    # The sample count is known from the export, it lets the input pipeline size its cache and shuffle buffer
+    return ds.apply(tf.data.experimental.assert_cardinality(info['splits'][split]))
+
+def main(x):
+    from Dataset import create_dataset
+    from PackedStore import PackedStore
+    FLAGS = flags.FLAGS
+    ds = create_dataset(FLAGS)
+    channels = {1: 2, 2: 4, 3: 6}[FLAGS.scenario]
+    packed = PackedStore(FLAGS.packed_dir) if FLAGS.packed_dir else None
+    export_tfrecords(ds, channels, FLAGS.tfrecord_dir, shards=FLAGS.shards, baseline=FLAGS.baseline, packed=packed, speckle_filter=FLAGS.speckle_filter)
+
+if __name__ == "__main__":
+    FLAGS = flags.FLAGS
+    flags.DEFINE_integer("scenario", 1, "Training data scenario. \n\t 1: Only co_event \n\t 2: coevent & preevent \n\t 3: coevent & preevent & coherence")
+    flags.DEFINE_string('tfrecord_dir', None, 'Directory to write the TFRecord shards to')
+    flags.DEFINE_integer('shards', 8, 'Shards per split')
+    flags.DEFINE_bool("baseline", False, "T/F for baseline. If true, it does not apply the new processing pipeline")
+    flags.DEFINE_enum('speckle_filter', 'lee', ['lee', 'refined_lee', 'multitemporal'], 'Speckle filter of the SAR channels')
+    flags.DEFINE_string('packed_dir', None, 'Directory written by DatasetHelpers/PackedStore.py. If set, chips are read from its memory-mapped arrays')
+    flags.DEFINE_string('manifest', None, 'filepath of the chip manifest database. If set, the dataset is built from it instead of listing every folder')
+    flags.DEFINE_string('s1_co', '/workspaces/Thesis/10m_data/s1_co_event_grd', 'filepath of Sentinel-1 coevent data')
+    flags.DEFINE_string('s1_pre', '/workspaces/Thesis/10m_data/s1_pre_event_grd', 'filepath of Sentinel-1 prevent data')
+    flags.DEFINE_string('s2_weak', '/workspaces/Thesis/10m_data/s2_labels', 'filepath of S2-weak labelled data')
+    flags.DEFINE_string('coh_co', '/workspaces/Thesis/10m_data/coherence/co_event', 'filepath of coherence coevent data')
+    flags.DEFINE_string('coh_pre', '/workspaces/Thesis/10m_data/coherence/pre_event', 'filepath of coherence prevent data')
+
+    flags.DEFINE_string('hand_coh_co', '/workspaces/Thesis/10m_hand/coherence_10m/hand_labeled/co_event', '(h) filepath of coevent data')
+    flags.DEFINE_string('hand_coh_pre', '/workspaces/Thesis/10m_hand/coherence_10m/hand_labeled/pre_event', '(h) filepath of preevent data')
+    flags.DEFINE_string('hand_s1_co', '/workspaces/Thesis/10m_hand/HandLabeled/S1Hand', '(h) filepath of Sentinel-1 coevent data')
+    flags.DEFINE_string('hand_s1_pre', '/workspaces/Thesis/10m_hand/S1_Pre_Event_GRD_Hand_Labeled', '(h) filepath of Sentinel-1 prevent data')
+    flags.DEFINE_string('hand_labels', '/workspaces/Thesis/10m_hand/HandLabeled/LabelHand', 'filepath of hand labelled data')
+    flags.mark_flag_as_required('tfrecord_dir')
+    app.run(main)
@@ -0,0 +1,77 @@
+'''
+Batched confusion matrix evaluation of the segmentation models.
+
+The evaluation split is batched and predicted with predict_on_batch, every batch is folded into an on device
+(N, N) [truth, prediction] confusion matrix with a single bincount. Only the matrix is kept, so the memory does
+not grow with the size of the split. Pixels labelled IGNORE_LABEL (or any label >= N) are left out: use compact
+labels with ignore_invalid to leave out the NaN masked and the invalid pixels.
+'''
+import numpy as np
+import tensorflow as tf
+
+CLASS_NAMES = ('Nonwater', 'Water')
+
+class ConfusionMatrix:
+    '''
+    Streaming (N, N) [truth, prediction] pixel confusion matrix.
+
+    Usage:
+        confusion = ConfusionMatrix(2)
+        confusion.update(labels, logits)    # labels (B, H, W), logits (B, H, W, N)
+        confusion.result()                  # (N, N) int64 numpy array
+    '''
+    def __init__(self, num_classes:int = 2):
+        self.num_classes = num_classes
+        self.matrix = tf.Variable(tf.zeros((num_classes, num_classes), dtype=tf.int64), trainable=False)
+
+    @tf.function(reduce_retracing=True)
+    def update(self, labels:tf.Tensor, logits:tf.Tensor):
+        n = self.num_classes
+        labels = tf.reshape(tf.cast(labels, tf.int64), [-1])
+        pred = tf.reshape(tf.argmax(logits, axis=-1), [-1])
+        # Ignored pixels go to the extra bin n*n, which is dropped
+        idx = tf.where(labels < n, labels * n + pred, n * n)
+        counts = tf.math.bincount(idx, minlength=n * n + 1, maxlength=n * n + 1, dtype=tf.int64)
+        self.matrix.assign_add(tf.reshape(counts[:n * n], (n, n)))
+
+    def result(self) -> np.ndarray:
+        return self.matrix.numpy()
+
+def evaluate_confusion(model, ds:tf.data.Dataset, num_classes:int = 2, batch_size:int = 8) -> np.ndarray:
+    """Confusion matrix of the model over an unbatched (image, label) dataset, e.g. the compact hand / holdout split.
+    Labels of IGNORE_LABEL are not counted.
+    """
+    confusion = ConfusionMatrix(num_classes)
+    for images, labels in ds.batch(batch_size).prefetch(tf.data.AUTOTUNE):
+        confusion.update(labels, model.predict_on_batch(images))
+    return confusion.result()
+
+def _divide(a, b):
+    return np.divide(a, b, out=np.full(np.shape(a), np.nan), where=b > 0)
+
+def scores(confusion:np.ndarray) -> dict:
+    """Per class IoU, precision, recall and F1 of a [truth, prediction] confusion matrix, and their mean IoU.
+    A score without any pixel to count is NaN.
+    """
+    confusion = np.asarray(confusion, dtype=np.float64)
+    tp = np.diag(confusion)
+    fp = confusion.sum(axis=0) - tp
+    fn = confusion.sum(axis=1) - tp
+    iou = _divide(tp, tp + fp + fn)
+    precision = _divide(tp, tp + fp)
+    recall = _divide(tp, tp + fn)
+    f1 = _divide(2 * precision * recall, precision + recall)
+
+    names = CLASS_NAMES if len(confusion) == len(CLASS_NAMES) else [f'Class {c}' for c in range(len(confusion))]
+    result = { name: {'IoU': iou[c], 'Precision': precision[c], 'Recall': recall[c], 'F1': f1[c]} for c, name in enumerate(names) }
+    result['mIoU'] = np.nanmean(iou) if not np.isnan(iou).all() else np.nan
+    return result
+
+def print_scores(confusion:np.ndarray):
+    confusion = np.asarray(confusion)
+    print(f'Confusion [truth, prediction]:\n{confusion}')
+    result = scores(confusion)
+    print(f"Total mIoU:\t\t {(100 * result.pop('mIoU')):.3f}")
+    for name, metrics in result.items():
+        for metric, value in metrics.items():
+            print(f'{name} {metric}:\t{(100 * value):.3f}')
@@ -0,0 +1,51 @@
+'''
+Loss and metric for compact labels.
+
+With compact dtypes the input pipeline only ships the image and a uint8 label where NaN masked pixels are
+IGNORE_LABEL, no float32 target / weight maps. The class weights and the upcast happen here, inside the
+train step on the device.
+'''
+import keras
+import tensorflow as tf
+
+IGNORE_LABEL = 255 # Same as DatasetHelpers.Dataset.IGNORE_LABEL
+
+def _split_ignored(y_true:tf.Tensor):
+    y_true = tf.cast(y_true, tf.int32)
+    ignore = tf.equal(y_true, IGNORE_LABEL)
+    return tf.where(ignore, tf.zeros_like(y_true), y_true), ignore
+
+@keras.saving.register_keras_serializable(package="Thesis")
+class MaskedWeightedCrossentropy(keras.losses.Loss):
+    '''
+    Sparse categorical crossentropy weighted per class, IGNORE_LABEL pixels have a weight of 0.
+
+    Same value as SparseCategoricalCrossentropy with the weight map of read_sample passed as sample weight,
+    except that NaN masked pixels are ignored instead of weighted 1.
+    '''
+    def __init__(self, class_weights:dict, from_logits:bool = False, name:str = "masked_weighted_crossentropy", **kwargs):
+        super().__init__(name=name, **kwargs)
+        self.class_weights = { int(k): float(v) for k, v in class_weights.items() }
+        self.from_logits = from_logits
+        self.weight_lookup = tf.constant([self.class_weights[k] for k in sorted(self.class_weights)], dtype=tf.float32)
+
+    def call(self, y_true, y_pred):
+        labels, ignore = _split_ignored(y_true)
+        weights = tf.where(ignore, 0.0, tf.gather(self.weight_lookup, labels))
+        crossentropy = keras.losses.sparse_categorical_crossentropy(labels, tf.cast(y_pred, tf.float32), from_logits=self.from_logits)
+        return crossentropy * weights
+
+    def get_config(self):
+        return {**super().get_config(), 'class_weights': self.class_weights, 'from_logits': self.from_logits}
+
+@keras.saving.register_keras_serializable(package="Thesis")
+class MaskedMeanIoU(keras.metrics.MeanIoU):
+    '''
+    MeanIoU that skips IGNORE_LABEL pixels.
+    '''
+    def update_state(self, y_true, y_pred, sample_weight=None):
+        labels, ignore = _split_ignored(y_true)
+        valid = tf.cast(tf.logical_not(ignore), self.dtype)
+        if sample_weight is not None:
+            valid = valid * tf.cast(sample_weight, self.dtype)
+        return super().update_state(labels, y_pred, sample_weight=valid)
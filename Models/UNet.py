@@ -177,6 +177,7 @@ def DecoderMiniBlock(prev_layer_input, skip_layer_input, n_filters=32):
 def UNetCompiled(input_size=(512, 512, 2), n_filters=32, n_classes=2):
 
     # Input size represent the size of 1 image (the size used for pre-processing) 
+    # Height and width can be None to train on smaller patches and predict on whole chips, they must be multiples of 16
     inputs = Input(input_size)
     
     # Data augmentation layers
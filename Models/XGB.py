@@ -1,49 +1,462 @@
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import resource
+import threading
 import time
+import zlib
 from matplotlib import pyplot as plt
 import numpy as np
 import rasterio
+import xgboost
 from xgboost import XGBClassifier
 from dataclasses import dataclass, field
 from absl import app, flags
 
-XGB_POS_WEIGHT = 6.7233518222
+from DatasetHelpers.ChipReader import ChipReader, IGNORE_LABEL
+from DatasetHelpers.Features import PixelFeatures
+
+XGB_POS_WEIGHT = 6.7233518222 # Non-water / water pixel ratio of the training labels
+CHANNELS = {1: 2, 2: 4, 4: 6} # Files per chip --> feature channels (scenarios 1, 2, 3)
+# Booster parameters that only change where and how fast the trees are fit, a checkpoint resumes under other values
+RUNTIME_PARAMS = ('nthread', 'device', 'verbosity')
+# Bytes per row (and per row and feature column) xgboost allocates while fitting on top of the bin index of the features:
+# float32 labels, quantile sketch, gradient pairs, predictions, row partitions. Measured with tests/xgb_row_overhead.py
+# (xgboost 3.2, hist, depth 6, 4M rows of 2 to 32 columns: 51.2, 56.1, 67.9 and 87.8 bytes per row)
+XGB_ROW_OVERHEAD = 48.6
+XGB_COLUMN_OVERHEAD = 1.2
+
+def rss_bytes() -> tuple:
+    """(current, peak) resident memory of this process. The peak is since the last reset_peak_rss().
+    """
+    try:
+        with open('/proc/self/status') as f:
+            status = dict(line.split(':', 1) for line in f)
+        return int(status['VmRSS'].split()[0]) * 1024, int(status['VmHWM'].split()[0]) * 1024
+    except (OSError, KeyError):
+        # No procfs: only the peak of the whole process is known
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return peak, peak
+
+def drop_ignored(x:np.ndarray, y:np.ndarray) -> tuple:
+    # Labels outside of the remapping (IGNORE_LABEL) are not a class, their rows are not trained on
+    kept = y[:, 0] != IGNORE_LABEL
+    return (x, y) if kept.all() else (x[kept], y[kept])
+
+def reset_peak_rss():
+    # Linux only, the peak then keeps growing from the start of the process
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+@dataclass(frozen=True)
+class PixelSampling:
+    '''
+    Class stratified pixel sampling of the training chips.
+
+    Every valid pixel of a chip is kept with the rate of its class. Invalid (-1) or unknown labels and pixels with a NaN feature are dropped.
+    The draw only depends on the seed and the chip name, so a chip is sampled the same in every batch split and every pass.
+
+    Usage:
+        sampling = PixelSampling.balanced()     # All water pixels, 1 / XGB_POS_WEIGHT of the others
+        rows = sampling.select(data, label, 'Ghana_103272_S2IndexLabelWeak.tif')
+    '''
+    rates: tuple = (1 / XGB_POS_WEIGHT, 1.0) # Keep rate of the non-water (0) and water (1) pixels
+    seed: int = 0
+
+    @classmethod
+    def balanced(cls, water_rate:float=1.0, seed:int=0) -> 'PixelSampling':
+        return cls(rates=(water_rate / XGB_POS_WEIGHT, water_rate), seed=seed)
+
+    def select(self, data:np.ndarray, label:np.ndarray, chip:str) -> np.ndarray:
+        """Sampled pixels of a chip.
+
+        Args:
+            data (np.ndarray): (C, H, W) features
+            label (np.ndarray): (1, H, W) raw labels: -1 invalid, 0 non-water, 1 water
+            chip (str): Name of the chip, seeds its draw
+
+        Returns:
+            np.ndarray: Sorted flat (H*W) indices of the kept pixels
+        """
+        label = label.reshape(-1)
+        valid = ((label == 0) | (label == 1)) & ~np.isnan(data.reshape(len(data), -1)).any(axis=0)
+        rate = np.asarray(self.rates, dtype=np.float32)[np.clip(label, 0, 1)]
+        rng = np.random.default_rng([self.seed, zlib.crc32(os.path.basename(chip).encode('utf-8'))])
+        return np.flatnonzero(valid & (rng.random(label.size, dtype=np.float32) < rate))
+
+class ChipBlockIterator(xgboost.DataIter):
+    '''
+    Streams the training set to XGBoost one block of chips at a time.
+
+    XGBoost walks over the blocks (several times) to sketch the feature quantiles and build the binned
+    histogram index of the whole training set, only one dense block is held in memory at once.
+
+    Arguments:
+    --  load        :   function block --> (x, y), e.g. Batched_XGBoost.__load_data
+    --  blocks      :   list of {'x': [FILENAMES], 'y': [FILENAMES]} blocks
+    --  cache_prefix:   Optional path prefix to page the binned data out to disk (external memory) instead of RAM
+    '''
+    def __init__(self, load, blocks:list, cache_prefix:str=None):
+        self.load = load
+        self.blocks = blocks
+        self.position = 0
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data) -> bool:
+        if self.position == len(self.blocks):
+            return False
+        t1 = time.time()
+        x, y = self.load(self.blocks[self.position])
+        input_data(data=x, label=y[:, 0])
+        print(f'Block {self.position} streamed in {time.time() - t1} seconds')
+        self.position += 1
+        return True
+
+    def reset(self):
+        self.position = 0
+
+class BatchCheckpoints:
+    '''
+    Per batch checkpoints of train_in_batches, in a directory:
+    -   batch_<idx>.json    booster after the last completed batch
+    -   manifest.json       completed batches, the chips of every batch and the training parameters
+
+    The train / val split of a Dataset is drawn again on every run, so a resumed run trains on the batches of the manifest.
+    Writes run on a background thread. The booster is written first and the manifest is swapped in atomically
+    after it, so a crash mid-write leaves the previous checkpoint valid.
+    '''
+    def __init__(self, directory:str, run:dict):
+        self.directory = directory
+        self.run = run  # { 'batches': chips of every batch, 'params': training parameters }
+        self.completed = []
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.directory, 'manifest.json')
+
+    def resume(self) -> tuple:
+        """Returns (batches, completed batches, booster bytes or None, sampled pixel counts) of the last checkpoint.
+        Without a checkpoint, the batches of this run are returned and nothing is completed.
+        """
+        if not os.path.exists(self.manifest_path):
+            print(f'No checkpoint in {self.directory}, training from scratch')
+            return self.run['batches'], [], None, {}
+
+        with open(self.manifest_path) as f:
+            manifest = json.load(f)
+        semantic = lambda params: { k: v for k, v in params.items() if k not in RUNTIME_PARAMS }
+        if semantic(manifest['params']) != semantic(self.run['params']):
+            raise ValueError(f'The checkpoint in {self.directory} was trained with other parameters, it cannot be resumed')
+
+        self.run = {**self.run, 'batches': manifest['batches']}
+        self.completed = manifest['completed']
+        with open(os.path.join(self.directory, manifest['checkpoint']), 'rb') as f:
+            model = bytearray(f.read())
+        print(f'Resuming after batches {self.completed} from {manifest["checkpoint"]}')
+        return manifest['batches'], self.completed, model, manifest['sampled']
+
+    def save(self, batch_idx, model:bytearray, sampled:dict):
+        # Serialized on the training thread, written in the background
+        self.wait()
+        self.completed = self.completed + [batch_idx]
+        manifest = {**self.run, 'completed': self.completed, 'checkpoint': f'batch_{batch_idx}.json', 'sampled': dict(sampled)}
+        self.pending = self.writer.submit(self.__write, manifest, model)
+
+    def wait(self):
+        if self.pending is not None:
+            self.pending.result() # Raises the errors of the write
+            self.pending = None
+
+    def close(self):
+        self.wait()
+        self.writer.shutdown()
+
+    def __write(self, manifest:dict, model:bytearray):
+        t1 = time.time()
+        checkpoint = os.path.join(self.directory, manifest['checkpoint'])
+        with open(checkpoint + '.tmp', 'wb') as f:
+            f.write(model)
+        os.replace(checkpoint + '.tmp', checkpoint)
+
+        previous = None
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                previous = json.load(f)['checkpoint']
+        with open(self.manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+        if previous is not None and previous != manifest['checkpoint']:
+            os.remove(os.path.join(self.directory, previous))
+        print(f'Checkpoint {manifest["checkpoint"]} written in {time.time() - t1} seconds')
 
 @dataclass
 class Batched_XGBoost:
     model: any = field(init=False)
+    packed: any = None  # Optional DatasetHelpers.PackedStore to slice chips from instead of decoding the TIFs
+    reader: ChipReader = field(default_factory=lambda: ChipReader({-1: 0, 0: 0, 1: 1}))
+    # Backend: 'cuda' / 'cuda:<ordinal>' or 'cpu'. Both use the hist tree method
+    device: str = 'cuda'
+    nthread: int = None     # CPU threads, None for all cores
+    max_bin: int = 256      # Histogram bins per feature. Fewer bins: faster histograms, coarser splits
+    max_depth: int = 6
+    num_boost_round: int = 100  # Same as the XGBClassifier default n_estimators
+    params: dict = field(default_factory=dict)  # Any other booster parameter, e.g. {'subsample': 0.5}
+    sampling: PixelSampling = None  # Optional pixel sampling of the training chips, every pixel is used if None
+    features: PixelFeatures = None  # Optional neighbourhood features of every pixel, the raw channels if None
+    workers: int = None             # Threads computing the features of the chips of a batch. Defaults to the cpu count
+    # { chip : (non-water, water, kept non-water, kept water) } pixel counts of the sampled chips
+    sampled: dict = field(default_factory=dict, init=False, repr=False)
+    metadata: dict = field(default_factory=dict, init=False) # Stored with the saved model
+    batch_timings: list = field(default_factory=list, init=False, repr=False) # Load / wait / fit seconds and peak RSS of every train_in_batches batch
+    memory_profile: str = None  # Optional JSON file of the measured bytes per chip, used by chip_bytes and updated by train_in_batches
+
+    def booster_params(self) -> dict:
+        params = {
+            'objective': 'binary:logistic',
+            'tree_method': 'hist',
+            'device': self.device,
+            'max_bin': self.max_bin,
+            'max_depth': self.max_depth,
+            **self.params,
+        }
+        if self.nthread is not None:
+            params['nthread'] = self.nthread
+        return params
+
+    def classifier(self) -> XGBClassifier:
+        # sklearn names of the booster parameters
+        params = self.booster_params()
+        params.pop('objective')
+        nthread = params.pop('nthread', None)
+        return XGBClassifier(n_estimators=self.num_boost_round, n_jobs=nthread, **params)
     
-    def train_in_batches(self, batches:dict, skip_missing_data=False):
+    def train_in_batches(self, batches:dict, skip_missing_data=False, checkpoint_dir:str=None, resume=False, prefetch=True):
         '''
-        This function trains xgboost models in batches in order to fit in the GPU's memory.
+        This function trains xgboost models in batches in order to fit in the device's memory.
         The files are only loaded in memory once they are needed for training.
         
         Arguments:
-        --  batches : a dictionary holding 'x' and 'y' keys that map to a list of training files names for every chip
+        --  batches         :   a dictionary holding 'x' and 'y' keys that map to a list of training files names for every chip
+        --  checkpoint_dir  :   Optional directory to checkpoint the model to after every batch (BatchCheckpoints)
+        --  resume          :   Continue from the checkpoint in checkpoint_dir with its batches, completed batches are not loaded again
+        --  prefetch        :   Load the next batch in a background thread while boosting on the current one.
+                                At most two batches are in memory: the one being fit and the one being loaded
 
         Returns:
         --  model   :   Trained XGBoost model using the xgboost library
         --?  hist    :   training info
         '''
         full_model = None
+        completed = []
+        checkpoints = None
+        if checkpoint_dir is not None:
+            checkpoints = BatchCheckpoints(checkpoint_dir, self.checkpoint_run(batches, skip_missing_data))
+        if checkpoints is not None and resume:
+            split, completed, raw_model, sampled = checkpoints.resume()
+            batches = { batch_idx: {'x': np.array(batch['x']), 'y': np.array(batch['y'])} for batch_idx, batch in split.items() }
+            if raw_model is not None:
+                full_model = self.classifier()
+                full_model.load_model(raw_model)
+                self.sampled.update({ scene: tuple(counts) for scene, counts in sampled.items() })
 
-        for batch_idx in batches.keys():
-            
-            batch_model = XGBClassifier(use_label_encoder=False, tree_method='gpu_hist')
+        pending = [ batch_idx for batch_idx in batches.keys() if str(batch_idx) not in completed ]
+        self.batch_timings = []
+        for batch_idx, (x, y), timing in self.__loaded_batches(batches, pending, skip_missing_data, prefetch):
+            batch_model = self.classifier()
             batch_model.verbosity = 0
             
-            t1 = time.time()
-            x, y = self.__load_data(batches[batch_idx], skip_missing_data)
-            print( f'Batch {batch_idx} finished loading in {time.time() - t1} seconds')
-            
             print("Starting training...")
             t1 = time.time()
             batch_model.fit(x, y, verbose=True, xgb_model=full_model)
-            print(f'Finished Training w/ batch {batch_idx} in {time.time() - t1} seconds')
+            timing['fit_s'] = time.time() - t1
+            print(f'Finished Training w/ batch {batch_idx} in {timing["fit_s"]} seconds')
             full_model = batch_model
+            del x, y # Frees the batch before the next one is waited for
+            self.batch_timings.append(timing)
+
+            if checkpoints is not None:
+                checkpoints.save(str(batch_idx), full_model.get_booster().save_raw('json'), self.sampled)
         
+        if self.batch_timings:
+            load = sum(timing['load_s'] for timing in self.batch_timings)
+            hidden = sum(timing['overlap_s'] for timing in self.batch_timings)
+            print(f'Loading took {load} seconds, {hidden} of them ({100 * hidden / max(load, 1e-9):.0f}%) overlapped with boosting')
+            if self.memory_profile is not None:
+                channels = CHANNELS[batches[pending[0]]['x'].shape[1]]
+                self.__record_chip_bytes(channels, max(timing['chip_bytes'] for timing in self.batch_timings))
+
+        if checkpoints is not None:
+            checkpoints.close()
         self.model =  full_model
 
+    def __loaded_batches(self, batches:dict, batch_ids:list, skip_missing_data=False, prefetch=True):
+        '''
+        Yields (batch_idx, (x, y), timing) of every batch in batch_ids.
+        With prefetch, batch i+1 is only requested once batch i is handed over, so it loads while batch i is being fit.
+
+        timing: load_s seconds spent loading the batch, wait_s seconds the training thread waited for it,
+                overlap_s = load_s - wait_s seconds of loading hidden behind the previous batch,
+                peak_rss_mb, chips and chip_bytes of its memory window (filled in once the window is closed)
+
+        The memory of batch i is measured from the moment it starts taking memory (before it is loaded, or with prefetch
+        once it is handed over, minus its arrays) until the next batch starts. The window holds its loading, its fit and,
+        with prefetch, the loading of batch i+1, so chips counts both batches.
+        '''
+        def load(batch_idx):
+            t1 = time.time()
+            data = self.__load_data(batches[batch_idx], skip_missing_data)
+            return data, time.time() - t1
+
+        window = None # (timing, base RSS) of the batch being measured
+        def next_window(timing=None, resident:int=0):
+            # Closes the memory window of the previous batch, opens the one of this batch
+            nonlocal window
+            current, peak = rss_bytes()
+            if window is not None:
+                closed, base = window
+                closed.update(peak_rss_mb=peak / 2**20, chip_bytes=max(peak - base, 0) / max(closed['chips'], 1))
+                print(f'Batch {closed["batch"]}: peak RSS {closed["peak_rss_mb"]:.0f} MB, {closed["chip_bytes"] / 2**20:.1f} MB per chip in memory')
+            reset_peak_rss()
+            window = None if timing is None else (timing, current - resident)
+
+        with ThreadPoolExecutor(max_workers=1) as loader:
+            future = None
+            for i, batch_idx in enumerate(batch_ids):
+                prefetched = prefetch and i + 1 < len(batch_ids)
+                # Chips in memory during the window: this batch and the one being prefetched
+                timing = {'batch': batch_idx, 'chips': len(batches[batch_idx]['y']) + (len(batches[batch_ids[i + 1]]['y']) if prefetched else 0)}
+                t1 = time.time()
+                if future is None:
+                    next_window(timing)
+                    data, load_s = load(batch_idx)
+                else:
+                    data, load_s = future.result()
+                    next_window(timing, resident=sum(array.nbytes for array in data))
+                wait_s = time.time() - t1
+
+                future = loader.submit(load, batch_ids[i + 1]) if prefetched else None
+                print(f'Batch {batch_idx} finished loading in {load_s} seconds, waited {wait_s} seconds for it')
+                timing.update(load_s=load_s, wait_s=wait_s, overlap_s=max(load_s - wait_s, 0.0))
+                yield batch_idx, data, timing
+                del data
+            next_window()
+
+    def chip_bytes(self, labels:np.ndarray, channels:int, fractions:dict=None) -> np.ndarray:
+        '''
+        Memory needed to train on every chip (labels: (N, 1) label paths, like Dataset.y_train), to size batches to a RAM budget.
+
+        It is estimated per kept pixel from the float32 features and int32 labels held by the loaded batch, about as much
+        again for reading them (GDAL block cache, read buffers: 20 of the 28 bytes per 6 column row in a fresh process),
+        the (QuantileDMatrix) bin index of the features and what xgboost allocates while fitting, XGB_ROW_OVERHEAD plus
+        XGB_COLUMN_OVERHEAD per column. xgboost does not keep a float copy of the features.
+        Sampled chips are estimated from their kept pixel counts when known, else from their label fractions
+        (fractions: { label path : (water_fraction, invalid_fraction) }, Dataset.get_label_fractions) and the sampling
+        rates, else with the largest sampling rate.
+        The bytes per chip measured by a previous train_in_batches (memory profile) are used instead where they are larger.
+        '''
+        pixels = self.reader.chip_size**2
+        columns = channels if self.features is None else self.features.channels(channels)
+        bin_bytes = 1 if self.max_bin <= 256 else 2
+        row_bytes = 2 * (4 * columns + 4) + bin_bytes * columns + XGB_ROW_OVERHEAD + XGB_COLUMN_OVERHEAD * columns
+        if self.sampling is None:
+            estimate = np.full(len(labels), pixels * row_bytes, dtype=np.float64)
+        else:
+            fractions = fractions or {}
+            def kept_rows(scene):
+                if scene in self.sampled:
+                    return sum(self.sampled[scene][2:])
+                if scene in fractions:
+                    water, invalid = fractions[scene]
+                    return pixels * (self.sampling.rates[0] * (1 - water - invalid) + self.sampling.rates[1] * water)
+                return pixels * max(self.sampling.rates)
+            estimate = np.array([ kept_rows(scenes[0]) for scenes in labels ], dtype=np.float64) * row_bytes
+
+        measured = self.__measured_chip_bytes(channels)
+        if measured is None:
+            return estimate
+        print(f'Using the measured {measured / 2**20:.1f} MB per chip of {self.memory_profile}, at least the estimate')
+        return np.maximum(estimate, measured)
+
+    def __profile_key(self, channels:int) -> str:
+        # Chips of the same configuration take the same memory
+        sampling = 'dense' if self.sampling is None else 'sampled-' + '-'.join(f'{rate:.4g}' for rate in self.sampling.rates)
+        features = 'raw' if self.features is None else '+'.join(self.features.names)
+        return f'{channels}ch-{self.reader.chip_size}px-{features}-{sampling}-{self.max_bin}bins'
+
+    def __measured_chip_bytes(self, channels:int):
+        if self.memory_profile is None or not os.path.exists(self.memory_profile):
+            return None
+        with open(self.memory_profile) as f:
+            return json.load(f).get(self.__profile_key(channels))
+
+    def __record_chip_bytes(self, channels:int, chip_bytes:float):
+        profile = {}
+        if os.path.exists(self.memory_profile):
+            with open(self.memory_profile) as f:
+                profile = json.load(f)
+        profile[self.__profile_key(channels)] = chip_bytes
+        os.makedirs(os.path.dirname(self.memory_profile) or '.', exist_ok=True)
+        with open(self.memory_profile, 'w') as f:
+            json.dump(profile, f, indent=2)
+
+    def checkpoint_run(self, batches:dict, skip_missing_data=False) -> dict:
+        # Everything a checkpoint depends on: the chips of every batch and the training parameters.
+        # The RUNTIME_PARAMS are recorded too but resume does not compare them
+        return {
+            'batches': { str(batch_idx): {'x': batch['x'].tolist(), 'y': batch['y'].tolist()} for batch_idx, batch in batches.items() },
+            'params': {
+                **self.booster_params(),
+                'num_boost_round': self.num_boost_round,
+                'sampling': None if self.sampling is None else {'rates': list(self.sampling.rates), 'seed': self.sampling.seed},
+                'features': None if self.features is None else list(self.features.names),
+                'skip_missing_data': skip_missing_data,
+            },
+        }
+
+    def train_streaming(self, batches:dict, skip_missing_data=False, cache_dir:str=None):
+        '''
+        Trains a single xgboost model over the whole training set, streaming the chips block by block.
+
+        Unlike train_in_batches, the trees are fit on the histograms of all the batches at once, so the model does not depend
+        on the batch count or order. The batches only bound the memory: one dense batch is loaded at a time
+        and the data is kept as the (1 byte per feature) quantized histogram index. The price is IO: building the DMatrix
+        passes over the iterator several times, and every pass reads and decodes all the chips again.
+        The models are not comparable with the ones of train_in_batches (the default of main.py).
+
+        Arguments:
+        --  batches     :   a dictionary holding 'x' and 'y' keys that map to a list of training files names for every chip
+        --  cache_dir   :   Optional directory to keep the histogram index on disk instead of in memory (external memory)
+        '''
+        load = lambda batch: self.__load_data(batch, skip_missing_data)
+        blocks = [batches[batch_idx] for batch_idx in batches.keys()]
+
+        t1 = time.time()
+        if cache_dir is None:
+            iterator = ChipBlockIterator(load, blocks)
+            dtrain = xgboost.QuantileDMatrix(iterator, max_bin=self.max_bin, nthread=self.nthread)
+        else:
+            os.makedirs(cache_dir, exist_ok=True)
+            iterator = ChipBlockIterator(load, blocks, cache_prefix=os.path.join(cache_dir, 'xgb'))
+            dtrain = xgboost.ExtMemQuantileDMatrix(iterator, max_bin=self.max_bin, nthread=self.nthread)
+        print(f'Histogram index of {dtrain.num_row()} pixels built in {time.time() - t1} seconds')
+
+        print("Starting training...")
+        t1 = time.time()
+        booster = xgboost.train(self.booster_params(), dtrain, num_boost_round=self.num_boost_round)
+        print(f'Finished Training in {time.time() - t1} seconds')
+
+        # Same XGBClassifier interface (predict, save_model) as the batched models
+        self.model = self.classifier()
+        self.model.load_model(bytearray(booster.save_raw()))
+
     def predict_in_batches(self, batches:dict):
         predictions = []
         truth = []
@@ -62,26 +475,108 @@ class Batched_XGBoost:
             print(f'Predictions: {len(predictions)}, Truth: {len(truth)}')
         return predictions, truth
 
+    def predict_streaming(self, split:dict, output_dir:str=None, workers:int=1) -> np.ndarray:
+        '''
+        Predicts a split chip by chip and accumulates the confusion matrix, nothing but the counts is kept across chips.
+
+        Arguments:
+        --  split       :   a dictionary holding 'x' and 'y' keys that map to a list of files names for every chip, like a batch
+        --  output_dir  :   Optional directory to write every chip's prediction to, as a uint8 raster with the profile of its label
+        --  workers     :   Chips predicted in parallel threads (reading and xgboost release the GIL)
+
+        Returns:
+        --  confusion   :   (2, 2) int64 pixel counts, confusion[truth, prediction], of the valid (0 / 1 labelled, no NaN input) pixels
+        '''
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+        booster = self.model.get_booster()
+
+        def predict_chip(chip):
+            scenes, (scene, *_) = chip
+            if self.packed is not None and scene in self.packed:
+                data, raw_label = self.packed.read(scene)
+            else:
+                data = self.reader.read(scenes)
+                raw_label = self.reader.read_label(scene, remap=False)
+            label = self.reader.remap(raw_label)
+            # Same pixels as the metrics of the other models: invalid (-1), unknown labels and NaN inputs are not counted
+            counted = (label.reshape(-1) != IGNORE_LABEL) & (raw_label.reshape(-1) != -1) & ~np.isnan(data.reshape(len(data), -1)).any(axis=0)
+
+            if self.features is not None:
+                data = self.features(data)
+            # (C, H, W) --> (H*W, C) strided view, predicted in place without a DMatrix copy
+            prediction = (booster.inplace_predict(data.reshape(len(data), -1).T) > 0.5).astype(np.uint8)
+            if output_dir is not None:
+                self.__write_prediction(prediction.reshape(label.shape), scene, output_dir)
+
+            label = label.reshape(-1).astype(np.int64)
+            return np.bincount(2 * label[counted] + prediction[counted], minlength=4).reshape(2, 2)
+
+        confusion = np.zeros((2, 2), dtype=np.int64)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for chip_confusion in pool.map(predict_chip, zip(split['x'], split['y'])):
+                confusion += chip_confusion
+        return confusion
+
+    def __write_prediction(self, prediction:np.ndarray, label_path:str, output_dir:str):
+        profile = {'driver': 'GTiff', 'width': prediction.shape[-1], 'height': prediction.shape[-2]}
+        if os.path.exists(label_path):
+            with rasterio.open(label_path) as src:
+                profile = {**src.profile, 'driver': 'GTiff'}
+        profile.update(count=1, dtype='uint8', nodata=None, compress='deflate')
+
+        name = os.path.splitext(os.path.basename(label_path))[0]
+        with rasterio.open(os.path.join(output_dir, f'{name}_prediction.tif'), 'w', **profile) as dst:
+            dst.write(prediction.reshape(1, *prediction.shape[-2:]))
+
+    def save_model(self, path):
+        if self.sampling is not None:
+            self.metadata['sampling'] = self.sampling_metadata()
+        if self.features is not None:
+            self.metadata['features'] = list(self.features.names)
+        booster = self.model.get_booster()
+        for key, value in self.metadata.items():
+            booster.set_attr(**{key: json.dumps(value)})
+        self.model.save_model(path)
+
     def load_model(self, path):
         # TODO I dont think scale_pos_weight is necessary here because this model will not be used for training
-        self.model = XGBClassifier(use_label_encoder=False, tree_method='gpu_hist')
+        self.model = self.classifier()
         self.model.load_model(path)
+        attributes = self.model.get_booster().attributes()
+        self.metadata = { key: json.loads(attributes[key]) for key in ['sampling', 'features'] if key in attributes }
+        if 'features' in self.metadata:
+            # The model predicts from the features it was trained on
+            self.features = PixelFeatures(tuple(self.metadata['features']))
+
+    def sampling_metadata(self) -> dict:
+        counts = np.array(list(self.sampled.values()), dtype=np.int64).reshape(-1, 4).sum(axis=0)
+        return {
+            'rates': list(self.sampling.rates),
+            'seed': self.sampling.seed,
+            'chips': len(self.sampled),
+            'labelled_pixels': counts[:2].tolist(),
+            'sampled_pixels': counts[2:].tolist(),
+            'invalid_pixels': len(self.sampled) * self.reader.chip_size**2 - int(counts[:2].sum()),
+        }
 
-    def __remap_labels(self, chip):
-        # Incoming label chip should be size (512x512, 1)
-        invalids = chip[:,0] == -1
-        chip[:,0][invalids] = 0
-        return chip
-    
     # Better solution is to use a map to read the file names and replace with the squeezed data?
     def __load_data(self, batch:dict, skip_missing_data=False, debug=False):
         '''
         Takes a dictionary with keys {'x': [FILENAMES], 'y': [FILENAMES] } and loads the TIF filenames into an array.
 
-        param X_train : 2D- ndarray with shape ( num_pix , num_feat ) with input features
-        param Y_train : 2D- ndarray with shape ( num_pix ,) with labels
+        The output arrays are allocated once for the whole batch and every chip is read straight into them,
+        chips that are skipped for missing data are compacted away at the end.
+
+        param X_train : 2D- ndarray with shape ( num_pix , num_feat ) with input features (float32)
+        param Y_train : 2D- ndarray with shape ( num_pix , 1 ) with labels (int32)
 
         '''
+        if self.features is not None:
+            return self.__load_feature_data(batch, skip_missing_data)
+        if self.sampling is not None:
+            return self.__load_sampled_data(batch, skip_missing_data)
+
         channels = 2
         scenes_to_skip = defaultdict(int) # 1 yes 0 no 
         
@@ -93,56 +588,44 @@ class Batched_XGBoost:
             channels = 6
 
         print(f"Expecting channel size: {channels}")
-        x = np.zeros(shape = (1, channels))
-        y =  np.zeros( (1,1) )
+        pixels = self.reader.chip_size**2
+        x = np.empty( (len(batch['x']) * pixels, channels), dtype=np.float32 )
+        y = np.empty( (len(batch['y']) * pixels, 1), dtype=np.int32 )
+        chip = np.empty( (channels, self.reader.chip_size, self.reader.chip_size), dtype=np.float32 ) # Scratch (C, H, W) buffer
 
         # Load data first
         # Potential scenes: Co-event, Pre-event, Coherence
         # Need to make sure data is not NaN.
+        kept = 0
         for idx, scenes in enumerate(batch['x']):
-            # Initialize ready data shape
-            full_data = np.zeros(shape=(512*512, 1)) 
-            skip_scene = False
+            if self.packed is not None and batch['y'][idx][0] in self.packed:
+                # Whole chip is one zero-copy slice of the packed store
+                data, _ = self.packed.read(batch['y'][idx][0])
+            else:
+                data = self.reader.read(scenes, out=chip) # C, W, H
+
+            if skip_missing_data and np.isnan(data).any():
+                scenes_to_skip[idx] = 1
+                continue
 
-            # Iterate through scenes and add them to the full_data variable
+            # Visualize plot
             if debug:
                 fig, ax = plt.subplots(2,2)
-                count = 0;
-                subplots = [ ax[0,0], ax[0,1], ax[1,0], ax[1,1] ]
-            
-            for scene in scenes:
-                data = rasterio.open(scene, 'r').read() # C, W, H
-                
-                # Visualize plot
-                if debug:
-                    to_plot = data
-                    subplots[count].imshow(data[0,:,:])
-                    count+= 1
-
-                channels, width, height = data.shape
-                data = np.reshape(data, (channels, width*height))
-                data = np.transpose(data, (1,0))    
-                full_data = np.append(full_data, data, axis=1)
-
-                if skip_missing_data:
-                    if np.isnan(data).any():
-                        scenes_to_skip[idx] = 1
-                        skip_scene = True # Variable to ensure we dont append to our final return object
-                        break # Stop looking at any other scenes for this region acquisition
-            
-            if debug:
+                for subplot, band in zip([ ax[0,0], ax[0,1], ax[1,0], ax[1,1] ], data):
+                    subplot.imshow(band)
                 plt.savefig(f"/workspaces/Thesis/DatasetHelpers/pipeline-debugging/samples/xgb-load/{scenes[0].split('/')[-1].split('.')[0]}")
-                
-            if not skip_scene:
-                # Ditch first zero generated channel
-                full_data = full_data[:,1:]
-                x = np.append(x, full_data, axis=0)
+
+            # (C, H, W) --> (H*W, C) rows of this chip
+            x[kept*pixels:(kept+1)*pixels] = data.reshape(channels, -1).T
+            kept += 1
+        x = x[:kept*pixels]
         
         print("Finished loading data", x.shape)
         print(scenes_to_skip.keys())
 
         # Batch comes in as (samples, file_urls)
         # So for S1, S2, S3 Respectively : (N,1), (N,2), (N,4)
+        kept = 0
         for idx, scenes in enumerate(batch['y']):
             
             # Skip if the data for this target had NA
@@ -150,23 +633,114 @@ class Batched_XGBoost:
                 if scenes_to_skip[idx]:
                     continue
             
-            # same as scene = scenes[0] because there will never be more than one target image.
-            for scene in scenes:
-                data = rasterio.open(scene, 'r').read()
-                channels, width, height = data.shape
-                data = np.reshape(data, (width*height, channels) )
-                data = np.int32(data)
-
+            # There will never be more than one target image.
+            scene = scenes[0]
+            if self.packed is not None and scene in self.packed:
+                _, data = self.packed.read(scene)
+                data = self.reader.remap(data)
+            else:
+                data = self.reader.read_label(scene)
 
-            data = self.__remap_labels(data)
-            y = np.append(y, data, axis=0)
+            y[kept*pixels:(kept+1)*pixels, 0] = data.reshape(-1)
+            kept += 1
+        y = y[:kept*pixels]
         
         print("Finished loading targets", y.shape)
 
+        x, y = drop_ignored(x, y)
+        print(x.shape, y.shape)
 
+        return x, y
 
-        print(x.shape, y.shape)
+    def __load_sampled_data(self, batch:dict, skip_missing_data=False):
+        '''
+        __load_data with the pixel sampling: only the sampled rows of every chip are gathered, then concatenated once.
+        '''
+        channels = CHANNELS[batch['x'].shape[1]]
+        chip = np.empty( (channels, self.reader.chip_size, self.reader.chip_size), dtype=np.float32 ) # Scratch (C, H, W) buffer
+        label = np.empty( (1, self.reader.chip_size, self.reader.chip_size), dtype=np.int16 )
+        xs, ys = [], []
+
+        for scenes, (scene, *_) in zip(batch['x'], batch['y']):
+            if self.packed is not None and scene in self.packed:
+                data, raw_label = self.packed.read(scene)
+            else:
+                data = self.reader.read(scenes, out=chip)
+                raw_label = self.reader.read_label(scene, out=label, remap=False)
+
+            if skip_missing_data and np.isnan(data).any():
+                continue
+
+            rows = self.sampling.select(data, raw_label, scene)
+            sampled_label = raw_label.reshape(-1)[rows]
+            xs.append(data.reshape(channels, -1)[:, rows].T)
+            ys.append(self.reader.remap(sampled_label))
+
+            water = int(np.count_nonzero(sampled_label == 1))
+            self.sampled[scene] = (int(np.count_nonzero(raw_label == 0)), int(np.count_nonzero(raw_label == 1)), len(rows) - water, water)
+
+        x = np.concatenate(xs) if xs else np.empty((0, channels), dtype=np.float32)
+        y = np.concatenate(ys).astype(np.int32)[:, np.newaxis] if ys else np.empty((0, 1), dtype=np.int32)
+        print(f"Sampled {len(y)} of {len(batch['y']) * self.reader.chip_size**2} pixels", x.shape, y.shape)
+        return x, y
+
+    def __load_feature_data(self, batch:dict, skip_missing_data=False):
+        '''
+        __load_data of the PixelFeatures of every pixel (and the pixel sampling). Chips are read and featurized in parallel threads,
+        each into its own scratch buffers, and written to their own rows of the batch.
+        '''
+        in_channels = CHANNELS[batch['x'].shape[1]]
+        channels = self.features.channels(in_channels)
+        size = self.reader.chip_size
+        pixels = size**2
+        dense = self.sampling is None
+        if dense:
+            x = np.empty( (len(batch['x']) * pixels, channels), dtype=np.float32 )
+            y = np.empty( (len(batch['y']) * pixels, 1), dtype=np.int32 )
+        scratch = threading.local()
+
+        def load_chip(idx):
+            if not hasattr(scratch, 'chip'):
+                scratch.chip = np.empty( (in_channels, size, size), dtype=np.float32 )
+                scratch.label = np.empty( (1, size, size), dtype=np.int16 )
+                scratch.features = np.empty( (channels, size, size), dtype=np.float32 )
+            scene = batch['y'][idx][0]
+            if self.packed is not None and scene in self.packed:
+                data, raw_label = self.packed.read(scene)
+            else:
+                data = self.reader.read(batch['x'][idx], out=scratch.chip)
+                raw_label = self.reader.read_label(scene, out=scratch.label, remap=False)
+
+            if skip_missing_data and np.isnan(data).any():
+                return None
+            features = self.features(data, out=scratch.features).reshape(channels, -1)
+
+            if dense:
+                x[idx*pixels:(idx+1)*pixels] = features.T
+                y[idx*pixels:(idx+1)*pixels, 0] = self.reader.remap(raw_label).reshape(-1)
+                return True
+
+            rows = self.sampling.select(data, raw_label, scene)
+            sampled_label = raw_label.reshape(-1)[rows]
+            water = int(np.count_nonzero(sampled_label == 1))
+            self.sampled[scene] = (int(np.count_nonzero(raw_label == 0)), int(np.count_nonzero(raw_label == 1)), len(rows) - water, water)
+            return features[:, rows].T, self.reader.remap(sampled_label)
+
+        with ThreadPoolExecutor(max_workers=self.workers or os.cpu_count()) as pool:
+            chips = list(pool.map(load_chip, range(len(batch['x']))))
+
+        kept = np.array([chip is not None for chip in chips], dtype=bool)
+        if dense:
+            if not kept.all():
+                rows = np.repeat(kept, pixels)
+                x, y = x[rows], y[rows]
+            x, y = drop_ignored(x, y)
+        else:
+            chips = [chip for chip in chips if chip is not None]
+            x = np.concatenate([chip[0] for chip in chips]) if chips else np.empty((0, channels), dtype=np.float32)
+            y = np.concatenate([chip[1] for chip in chips]).astype(np.int32)[:, np.newaxis] if chips else np.empty((0, 1), dtype=np.int32)
 
+        print(f"Loaded {channels} features of {np.count_nonzero(kept)} chips", x.shape, y.shape)
         return x, y
 
 def main(x):
@@ -26,6 +26,7 @@ flags.DEFINE_string('hand_coh_pre', '/workspaces/Thesis/10m_hand/coherence_10m/h
 flags.DEFINE_string('hand_s1_co', '/workspaces/Thesis/10m_hand/HandLabeled/S1Hand', '(h) filepath of Sentinel-1 coevent data')
 flags.DEFINE_string('hand_s1_pre', '/workspaces/Thesis/10m_hand/S1_Pre_Event_GRD_Hand_Labeled', '(h) filepath of Sentinel-1 prevent data')
 flags.DEFINE_string('hand_labels', '/workspaces/Thesis/10m_hand/HandLabeled/LabelHand', 'filepath of hand labelled data')
+flags.DEFINE_string('manifest', None, 'filepath of the chip manifest database. If set, the dataset is built from it instead of listing every folder')
 
 
 correct_cmap = matplotlib.colors.LinearSegmentedColormap.from_list("", ["white", "blue"])
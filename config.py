@@ -1,5 +1,6 @@
 from dataclasses import dataclass
 from Models.XGB import Batched_XGBoost
+from DatasetHelpers.Features import PixelFeatures
 from absl import app, flags
 
 class ConfigError(Exception):
@@ -32,4 +33,90 @@ def validate_config(FLAGS:flags.FLAGS):
     if FLAGS.savename == None:
         raise ConfigError("savename", "Save name cannot be None ")
 
+    pruning = FLAGS.max_nan_fraction < 1.0 or FLAGS.max_invalid_fraction < 1.0 or FLAGS.drop_all_zero
+    if pruning and FLAGS.manifest == None:
+        raise ConfigError("manifest", "Chip pruning needs the validity statistics stored in the manifest")
+
+    if FLAGS.graph_reader and FLAGS.packed_dir == None:
+        raise ConfigError("graph_reader", "The graph reader decodes from a packed store, --packed_dir must be set")
+
+    if FLAGS.speckle_filter == 'multitemporal' and FLAGS.scenario == 1:
+        raise ConfigError("speckle_filter", "The multitemporal filter needs the pre-event channels, use scenario 2 or 3")
+
+    if FLAGS.class_weights is not None and FLAGS.class_weights != ['balanced']:
+        try:
+            weights = [float(w) for w in FLAGS.class_weights]
+        except ValueError:
+            raise ConfigError("class_weights", "Either 'balanced' or one float per class")
+        if len(weights) != 2:
+            raise ConfigError("class_weights", "Expected a weight for each of the 2 classes")
+
+    if FLAGS.compact_dtypes and FLAGS.graph_weights:
+        raise ConfigError("compact_dtypes", "Class weights are either applied by the loss (--compact_dtypes) or on graph (--graph_weights), not both")
+
+    if FLAGS.float16_images and not (FLAGS.compact_dtypes or FLAGS.graph_weights):
+        raise ConfigError("float16_images", "float16 images are only shipped with compact labels, set --compact_dtypes or --graph_weights")
+
+    if FLAGS.train_patch_size is not None:
+        if FLAGS.model != 'unet':
+            raise ConfigError("train_patch_size", "Patch training is only supported by the unet model")
+        if FLAGS.train_patch_size % 16 != 0 or not 0 < FLAGS.train_patch_size <= 512:
+            raise ConfigError("train_patch_size", "Patches must be a multiple of 16 (4 unet poolings) and fit in a 512 chip")
+        if FLAGS.tfrecord_dir or FLAGS.graph_reader:
+            raise ConfigError("train_patch_size", "Patches are read from the GeoTIFFs or the packed store, not --tfrecord_dir or --graph_reader")
+
+    if FLAGS.prefetch != -1 and FLAGS.prefetch < 1:
+        raise ConfigError("prefetch", "Either -1 (AUTOTUNE) or a number of batches")
+
+    if FLAGS.shuffle_buffer is not None and FLAGS.shuffle_buffer < 0:
+        raise ConfigError("shuffle_buffer", "Cannot be negative, 0 disables shuffling")
+
+    for augmentation in FLAGS.augment:
+        if augmentation not in ['flip', 'rot90']:
+            raise ConfigError("augment", f"Unknown augmentation {augmentation}, expected 'flip' or 'rot90'")
+
+    if FLAGS.augment_gain_std < 0 or FLAGS.augment_noise_std < 0:
+        raise ConfigError("augment", "Standard deviations of the gain and noise jitter cannot be negative")
+
+    if FLAGS.xgb_batches < 1:
+        raise ConfigError("xgb_batches", "At least one batch")
+
+    if FLAGS.xgb_device != 'cpu' and not FLAGS.xgb_device.startswith('cuda'):
+        raise ConfigError("xgb_device", "Either 'cpu', 'cuda' or 'cuda:<ordinal>'")
+
+    if FLAGS.xgb_nthread is not None and FLAGS.xgb_nthread < 1:
+        raise ConfigError("xgb_nthread", "At least one thread")
+
+    if FLAGS.xgb_max_bin < 2:
+        raise ConfigError("xgb_max_bin", "At least two histogram bins")
+
+    if FLAGS.xgb_sample_rates is not None and FLAGS.xgb_sample_rates != ['balanced']:
+        try:
+            rates = [float(r) for r in FLAGS.xgb_sample_rates]
+        except ValueError:
+            raise ConfigError("xgb_sample_rates", "Either 'balanced' or one rate per class")
+        if len(rates) != 2 or not all(0 < r <= 1 for r in rates):
+            raise ConfigError("xgb_sample_rates", "Expected a rate in (0, 1] for each of the 2 classes")
+
+    if FLAGS.xgb_checkpoint_dir and FLAGS.xgb_training != 'incremental':
+        raise ConfigError("xgb_checkpoint_dir", "Only the incremental xgboost training is checkpointed per batch")
+
+    if FLAGS.xgb_resume and not FLAGS.xgb_checkpoint_dir:
+        raise ConfigError("xgb_resume", "Set --xgb_checkpoint_dir to resume from")
+
+    if FLAGS.xgb_ram_budget_gb is not None and FLAGS.xgb_ram_budget_gb <= 0:
+        raise ConfigError("xgb_ram_budget_gb", "The RAM budget must be positive")
+
+    if FLAGS.xgb_features:
+        try:
+            PixelFeatures(tuple(FLAGS.xgb_features)).channels(channels)
+        except ValueError as e:
+            raise ConfigError("xgb_features", str(e))
+
+    if FLAGS.xgb_cache_dir and FLAGS.xgb_training != 'streaming':
+        raise ConfigError("xgb_cache_dir", "External memory is only used by the streaming xgboost training")
+
+    if FLAGS.graph_reader and FLAGS.speckle_filter != 'lee':
+        raise ConfigError("speckle_filter", "The graph reader only implements the lee speckle filter")
+
     return 0
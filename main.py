@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 import os
 import logging
 import matplotlib
@@ -8,10 +8,15 @@ import tensorflow as tf
 from keras.metrics import MeanIoU
 
 from config import validate_config
-from DatasetHelpers.Dataset import convert_to_tfds, create_dataset
+from DatasetHelpers.Dataset import PipelineOptions, apply_class_weights, build_pipeline, convert_to_tfds, create_dataset, get_band_variance, get_class_weights, get_label_fractions
+from DatasetHelpers.PackedStore import PackedStore
+from DatasetHelpers.Augmentation import BatchAugmentation
+from DatasetHelpers.Cache import PreprocessCache
 
-from Models.XGB import Batched_XGBoost
+from Models.XGB import Batched_XGBoost, PixelSampling
+from DatasetHelpers.Features import PixelFeatures
 from Models.UNet import UNetCompiled
+from Models.Losses import MaskedMeanIoU, MaskedWeightedCrossentropy
 script_path = os.path.dirname(os.path.realpath(__file__))
 
 font = {
@@ -37,6 +42,31 @@ flags.DEFINE_string('hand_coh_pre', '/workspaces/Thesis/10m_hand/coherence_10m/h
 flags.DEFINE_string('hand_s1_co', '/workspaces/Thesis/10m_hand/HandLabeled/S1Hand', '(h) filepath of Sentinel-1 coevent data')
 flags.DEFINE_string('hand_s1_pre', '/workspaces/Thesis/10m_hand/S1_Pre_Event_GRD_Hand_Labeled', '(h) filepath of Sentinel-1 prevent data')
 flags.DEFINE_string('hand_labels', '/workspaces/Thesis/10m_hand/HandLabeled/LabelHand', 'filepath of hand labelled data')
+flags.DEFINE_string('manifest', None, 'filepath of the chip manifest database. If set, the dataset is built from it instead of listing every folder')
+flags.DEFINE_float('max_nan_fraction', 1.0, '(manifest) Drop chips with a larger fraction of NaN pixels')
+flags.DEFINE_float('max_invalid_fraction', 1.0, '(manifest) Drop chips with a larger fraction of invalid (-1) label pixels')
+flags.DEFINE_bool('drop_all_zero', False, '(manifest) Drop chips that are entirely zero / NaN')
+flags.DEFINE_string('packed_dir', None, 'Directory written by DatasetHelpers/PackedStore.py. If set, chips are read from its memory-mapped arrays')
+flags.DEFINE_string('tfrecord_dir', None, 'Directory written by preprocess.py (or DatasetHelpers/TFRecords.py). If set, the preprocessed shards are read instead')
+flags.DEFINE_string('cache_dir', None, 'Directory of the content-addressed preprocessing cache. Disabled if not set')
+flags.DEFINE_float('cache_size_gb', 20, 'Size cap of the preprocessing cache, least recently used entries are evicted')
+flags.DEFINE_enum('speckle_filter', 'lee', ['lee', 'refined_lee', 'multitemporal'], 'Speckle filter of the SAR channels. multitemporal filters the co + pre event stack jointly')
+flags.DEFINE_list('class_weights', None, "Loss weight per class, e.g. '0.62,2.56', or 'balanced' to compute them from the training labels (manifest statistics if --manifest is set). Defaults to the empirical weights")
+flags.DEFINE_bool('graph_weights', False, 'Ship compact uint8 labels through the input pipeline and build the weight maps on graph per batch. NaN masked pixels get a weight of 0')
+flags.DEFINE_bool('compact_dtypes', False, 'Ship only the image and a compact uint8 label through the input pipeline. The class weights and the NaN mask are applied by the loss on the device')
+flags.DEFINE_bool('float16_images', False, 'Ship compact images as float16, the model upcasts them. Needs --compact_dtypes or --graph_weights')
+flags.DEFINE_integer('train_patch_size', None, '(unet) Train on random train_patch_size x train_patch_size patches of the chips, only their windows are read. Multiple of 16. Validation keeps the whole chips')
+flags.DEFINE_integer('patches_per_chip', 4, '(unet) Random patches drawn from every training chip per epoch')
+flags.DEFINE_string('pipeline_cache', 'auto', "Cache of the input splits: 'memory', 'none', a directory to cache to files, or 'auto' (memory if the split fits in --ram_budget_gb)")
+flags.DEFINE_float('ram_budget_gb', 8, 'RAM for the in memory cache and the shuffle buffer of the input pipeline')
+flags.DEFINE_integer('shuffle_buffer', None, 'Shuffle buffer in samples. Defaults to the whole split when cached in memory, else a tenth of it. 0 disables shuffling')
+flags.DEFINE_integer('data_threads', None, 'Threads of the input pipeline. Defaults to the shared tf.data threadpool')
+flags.DEFINE_bool('deterministic', True, 'Keep the order of the input pipeline. Turn off to let parallel reads return out of order')
+flags.DEFINE_integer('prefetch', tf.data.AUTOTUNE, 'Batches prefetched by the input pipeline. Defaults to AUTOTUNE')
+flags.DEFINE_list('augment', [], "Random training augmentations applied per batch: 'flip', 'rot90'")
+flags.DEFINE_float('augment_gain_std', 0.0, 'Std of the random multiplicative gain of the SAR channels, per sample and channel. 0 disables it')
+flags.DEFINE_float('augment_noise_std', 0.0, 'Std of the random additive noise of the SAR channels, per pixel. 0 disables it')
+flags.DEFINE_bool('graph_reader', False, 'Read and preprocess the packed store (--packed_dir) with TensorFlow ops only, no tf.py_function')
 
 # Model specific flags
 flags.DEFINE_string("model", None, "'xgboost', 'unet', 'transunet', 'segformer'")
@@ -44,6 +74,22 @@ flags.DEFINE_bool("baseline", False, "T/F for baseline. If true, it does not app
 
 # XGB boost specific parameters
 flags.DEFINE_integer('xgb_batches', 4, 'batches to use for splitting xgboost training to fit in memory')
+flags.DEFINE_enum('xgb_training', 'incremental', ['incremental', 'streaming'], "'incremental': keep boosting the previous model batch by batch. 'streaming': one model over the histograms of all batches, the batches only bound memory (every batch is read again on each pass over the data)")
+flags.DEFINE_string('xgb_device', 'cuda', "xgboost backend: 'cuda', 'cuda:<ordinal>' or 'cpu'")
+flags.DEFINE_integer('xgb_nthread', None, 'CPU threads of xgboost. Defaults to all cores')
+flags.DEFINE_integer('xgb_max_bin', 256, 'Histogram bins per feature')
+flags.DEFINE_integer('xgb_max_depth', 6, 'Maximum depth of the trees')
+flags.DEFINE_integer('xgb_rounds', 100, 'Boosting rounds (trees), per batch with --xgb_training=incremental')
+flags.DEFINE_list('xgb_sample_rates', None, "Per chip pixel sampling of the xgboost training set: keep rate of the non-water and water pixels, e.g. '0.1,1', or 'balanced' to keep every water pixel and 1/XGB_POS_WEIGHT of the others. Invalid and NaN pixels are dropped. Every pixel is used if not set")
+flags.DEFINE_integer('xgb_sample_seed', 0, 'Seed of the xgboost pixel sampling')
+flags.DEFINE_string('xgb_checkpoint_dir', None, 'Directory to checkpoint the incremental xgboost training to after every batch. Disabled if not set')
+flags.DEFINE_bool('xgb_resume', False, 'Resume the incremental xgboost training from --xgb_checkpoint_dir, skipping the completed batches')
+flags.DEFINE_bool('xgb_prefetch', True, 'Load the next xgboost batch in the background while boosting on the current one (incremental training). At most two batches are held in memory')
+flags.DEFINE_float('xgb_ram_budget_gb', None, 'Size the xgboost batches to this RAM budget from the memory per chip instead of splitting in --xgb_batches')
+flags.DEFINE_string('xgb_memory_profile', None, 'JSON file of the measured memory per chip, updated by every incremental xgboost training and used by --xgb_ram_budget_gb. Keep one per machine, outside of the repository. Not kept if not set')
+flags.DEFINE_list('xgb_features', None, "Per pixel features of xgboost instead of the raw channels, e.g. 'raw,mean7,var7,vv_vh,co_pre'. See DatasetHelpers/Features.py")
+flags.DEFINE_integer('xgb_feature_workers', None, 'Threads loading and featurizing the chips of an xgboost batch. Defaults to the cpu count')
+flags.DEFINE_string('xgb_cache_dir', None, 'Directory to page the streamed xgboost training data out to (external memory). Defaults to keeping it in RAM')
 
 # NN training Hyperparameters
 flags.DEFINE_integer("batch_size", 1, "Batch size to use for training")
@@ -70,11 +116,35 @@ def main(x):
     
     # XGboost uses a different kind of dataloader than the Tensorflow models.
     if FLAGS.model == 'xgboost':
-        xgb = Batched_XGBoost()
+        xgb = Batched_XGBoost(device=FLAGS.xgb_device, nthread=FLAGS.xgb_nthread, max_bin=FLAGS.xgb_max_bin,
+                              max_depth=FLAGS.xgb_max_depth, num_boost_round=FLAGS.xgb_rounds)
+        if FLAGS.packed_dir:
+            xgb.packed = PackedStore(FLAGS.packed_dir)
+        if FLAGS.xgb_sample_rates == ['balanced']:
+            xgb.sampling = PixelSampling.balanced(seed=FLAGS.xgb_sample_seed)
+        elif FLAGS.xgb_sample_rates is not None:
+            xgb.sampling = PixelSampling(rates=tuple(float(r) for r in FLAGS.xgb_sample_rates), seed=FLAGS.xgb_sample_seed)
         dataset = create_dataset(FLAGS)
-        batches = dataset.generate_batches(FLAGS.xgb_batches)
-        xgb.train_in_batches(batches, skip_missing_data=False)
-        xgb.model.save_model(f"Results/Models/{FLAGS.savename}.json")
+        if FLAGS.xgb_features:
+            xgb.features = PixelFeatures(tuple(FLAGS.xgb_features))
+            xgb.workers = FLAGS.xgb_feature_workers
+        xgb.memory_profile = FLAGS.xgb_memory_profile
+        if FLAGS.xgb_ram_budget_gb:
+            # The incremental training holds two batches when prefetching
+            held = 2 if FLAGS.xgb_training == 'incremental' and FLAGS.xgb_prefetch else 1
+            # Sampled chips keep a number of pixels that depends on their water and invalid fractions
+            fractions = get_label_fractions(FLAGS, dataset) if xgb.sampling is not None else None
+            chip_bytes = xgb.chip_bytes(dataset.y_train, channel_size, fractions)
+            batches = dataset.generate_batches(ram_budget_gb=FLAGS.xgb_ram_budget_gb / held, chip_bytes=chip_bytes)
+            print(f"{len(batches)} batches of at most {FLAGS.xgb_ram_budget_gb / held:.2f} GiB")
+        else:
+            batches = dataset.generate_batches(FLAGS.xgb_batches)
+        if FLAGS.xgb_training == 'incremental':
+            xgb.train_in_batches(batches, skip_missing_data=False, checkpoint_dir=FLAGS.xgb_checkpoint_dir, resume=FLAGS.xgb_resume,
+                                 prefetch=FLAGS.xgb_prefetch)
+        else:
+            xgb.train_streaming(batches, skip_missing_data=False, cache_dir=FLAGS.xgb_cache_dir)
+        xgb.save_model(f"Results/Models/{FLAGS.savename}.json")
 
         
     
@@ -82,6 +152,12 @@ def main(x):
         # Generic tensorflow NN hyperparameter and dataset creation
         model=None
         dataset = create_dataset(FLAGS)
+        packed = PackedStore(FLAGS.packed_dir) if FLAGS.packed_dir else None
+        cache = PreprocessCache(FLAGS.cache_dir, max_bytes=int(FLAGS.cache_size_gb * 2**30)) if FLAGS.cache_dir else None
+        class_weights = get_class_weights(FLAGS, dataset)
+        print(f"Class weights: {class_weights}")
+        compact = FLAGS.graph_weights or FLAGS.compact_dtypes
+        image_dtype = tf.float16 if FLAGS.float16_images else tf.float32
         
         lr_schedule = tf.keras.optimizers.schedules.ExponentialDecay(
             FLAGS.lr,
@@ -100,37 +176,32 @@ def main(x):
         )
 
         if FLAGS.model == 'unet':
-            train_ds, val_ds, test_ds, hand_ds = convert_to_tfds(dataset, channel_size, 'HWC', baseline=FLAGS.baseline)
-            BATCH_SIZE = FLAGS.batch_size 
-            # Set up datasets (Set batch size or else everything will break)
-            train_ds = (
-                train_ds
-                .batch(BATCH_SIZE)
-                .prefetch(tf.data.AUTOTUNE)
-            )
-
-            val_ds = (
-                val_ds
-                .batch(BATCH_SIZE)
-                .prefetch(tf.data.AUTOTUNE)
-            )
-
+            # The Lee filter of a patch needs the variance of its whole chip
+            lee_patches = FLAGS.train_patch_size and not FLAGS.baseline and FLAGS.speckle_filter == 'lee'
+            band_variance = get_band_variance(FLAGS, dataset) if lee_patches else None
+            train_ds, val_ds, test_ds, hand_ds = convert_to_tfds(dataset, channel_size, 'HWC', baseline=FLAGS.baseline, packed=packed, tfrecord_dir=FLAGS.tfrecord_dir, cache=cache, graph=FLAGS.graph_reader, speckle_filter=FLAGS.speckle_filter, class_weights=class_weights, compact=compact, image_dtype=image_dtype, patch_size=FLAGS.train_patch_size, patches_per_chip=FLAGS.patches_per_chip, band_variance=band_variance)
 
-            model = UNetCompiled(input_size=(512, 512, channel_size), n_filters=64, n_classes=2)
+            # Fully convolutional: trained on patches, validated and used on whole chips
+            input_size = (None, None, channel_size) if FLAGS.train_patch_size else (512, 512, channel_size)
+            model = UNetCompiled(input_size=input_size, n_filters=64, n_classes=2)
             print(model.summary())
             
+            if FLAGS.compact_dtypes:
+                loss = MaskedWeightedCrossentropy(class_weights, from_logits=True)
+                metrics = [MaskedMeanIoU(num_classes=2, sparse_y_pred=False)]
+            else:
+                loss = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True)
+                metrics = [MeanIoU(num_classes=2, sparse_y_pred=False)]
+
             model.compile(
-                loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+                loss=loss,
                 optimizer=opt,
                 weighted_metrics=[],
-                metrics=[MeanIoU(num_classes=2, sparse_y_pred=False)]
+                metrics=metrics
             )
 
         if FLAGS.model == "transunet":
-            train_ds, val_ds, test_ds, hand_ds = convert_to_tfds(dataset, channel_size, 'HWC')
-            for img, tgt, wgt in train_ds.take(1):
-                print(img.shape, tgt.shape, wgt.shape)
-
+            train_ds, val_ds, test_ds, hand_ds = convert_to_tfds(dataset, channel_size, 'HWC', packed=packed, tfrecord_dir=FLAGS.tfrecord_dir, cache=cache, graph=FLAGS.graph_reader, speckle_filter=FLAGS.speckle_filter, class_weights=class_weights, compact=compact, image_dtype=image_dtype)
 
             grid_size = (512 // FLAGS.patch_size, 512 // FLAGS.patch_size )
             # Depending on our grid size our decoder structure will need to have more Conv2dRelu + upscaling layers to get back to the original 512x512 size.
@@ -161,34 +232,22 @@ def main(x):
             print(model.summary())
             
             # Logits false bc thats what the transunet github uses and I dont want to mess with it
+            if FLAGS.compact_dtypes:
+                loss = MaskedWeightedCrossentropy(class_weights, from_logits=False)
+                metrics = [MaskedMeanIoU(num_classes=2, sparse_y_pred=False)]
+            else:
+                loss = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=False)
+                metrics = [MeanIoU(num_classes=2, sparse_y_pred=False)]
+
             model.compile(
-                loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=False),
+                loss=loss,
                 optimizer=opt,
-                metrics=[MeanIoU(num_classes=2, sparse_y_pred=False)]
+                metrics=metrics
             )
 
         if FLAGS.model == 'segformer':
-            train_ds, val_ds, test_ds, hand_ds = convert_to_tfds(dataset, channel_size, 'CHW')
+            train_ds, val_ds, test_ds, hand_ds = convert_to_tfds(dataset, channel_size, 'CHW', packed=packed, tfrecord_dir=FLAGS.tfrecord_dir, cache=cache, graph=FLAGS.graph_reader, speckle_filter=FLAGS.speckle_filter, class_weights=class_weights, compact=compact, image_dtype=image_dtype)
             BATCH_SIZE = FLAGS.batch_size
-            
-            train_ds = (
-                train_ds
-                .cache()
-                .shuffle(BATCH_SIZE * 10)
-                .batch(BATCH_SIZE)
-                .prefetch(tf.data.AUTOTUNE)
-            )
-            val_ds = (
-                val_ds
-                .cache()
-                .shuffle(BATCH_SIZE * 10)
-                .batch(BATCH_SIZE)
-                .prefetch(tf.data.AUTOTUNE)
-            )
-
-            print(train_ds.element_spec)
-            for img, tgt, wgt in train_ds.take(1):
-                print(img.shape, tgt.shape, wgt.shape)
 
             # Huggingface models require datasets to be in Channel first format.
             segformer_config = SegformerConfig(
@@ -209,7 +268,47 @@ def main(x):
                 # metrics=[MeanIoU(num_classes=2, sparse_y_pred=False)]
             )
         
-        CLASS_W = {0: 0.6212519560516805, 1: 2.5618224079902174}  # Empirical 
+        # Per batch stages, after the cache
+        train_maps, val_maps = [], []
+        if FLAGS.augment or FLAGS.augment_gain_std or FLAGS.augment_noise_std:
+            # Vectorized over whole batches, the same flips / rotations are applied to the image and its labels
+            train_maps.append(BatchAugmentation(
+                flip='flip' in FLAGS.augment,
+                rot90='rot90' in FLAGS.augment,
+                gain_std=FLAGS.augment_gain_std,
+                noise_std=FLAGS.augment_noise_std,
+                format='CHW' if FLAGS.model == 'segformer' else 'HWC'
+            ))
+
+        if FLAGS.float16_images and FLAGS.model == 'segformer':
+            # The cache holds float16 images, the huggingface model only takes float32
+            upcast = lambda image, *labels: (tf.cast(image, tf.float32), *labels)
+            train_maps.append(upcast)
+            val_maps.append(upcast)
+
+        if FLAGS.graph_weights:
+            # Weight maps are only built for the batch being consumed
+            train_maps.append(apply_class_weights(class_weights))
+            val_maps.append(apply_class_weights(class_weights))
+
+        pipeline = PipelineOptions(
+            batch_size=FLAGS.batch_size,
+            cache=FLAGS.pipeline_cache,
+            ram_budget_gb=FLAGS.ram_budget_gb,
+            shuffle_buffer=FLAGS.shuffle_buffer,
+            threads=FLAGS.data_threads,
+            deterministic=FLAGS.deterministic,
+            prefetch=FLAGS.prefetch,
+        )
+        # Random patches are drawn again every epoch, they cannot be cached
+        train_pipeline = replace(pipeline, cache='none') if FLAGS.train_patch_size else pipeline
+        train_ds = build_pipeline(train_ds, train_pipeline, 'train', training=True, maps=train_maps)
+        val_ds = build_pipeline(val_ds, pipeline, 'val', training=False, maps=val_maps)
+
+        print(train_ds.element_spec)
+        for sample in train_ds.take(1):
+            print([x.shape for x in sample])
+
         results = model.fit(train_ds, epochs=FLAGS.epochs, validation_data=val_ds, validation_steps=32)
         
         if FLAGS.model == "segformer":
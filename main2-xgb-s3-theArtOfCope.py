@@ -7,9 +7,9 @@ and im all out of ideas ha  - ha - ha -ha
 import time
 import numpy as np
 import matplotlib
-import rasterio
 from xgboost import XGBClassifier
 from DatasetHelpers.Dataset import create_dataset
+from DatasetHelpers.ChipReader import ChipReader, IGNORE_LABEL
 from absl import app, flags
 
 import os
@@ -32,6 +32,9 @@ flags.DEFINE_string('hand_s1_co', '/workspaces/Thesis/10m_hand/HandLabeled/S1Han
 flags.DEFINE_string('hand_s1_pre', '/workspaces/Thesis/10m_hand/S1_Pre_Event_GRD_Hand_Labeled', '(h) filepath of Sentinel-1 prevent data')
 flags.DEFINE_string('hand_labels', '/workspaces/Thesis/10m_hand/HandLabeled/LabelHand', 'filepath of hand labelled data')
 flags.DEFINE_integer('batches', 4, 'Batches')
+flags.DEFINE_string('device', 'cuda', "xgboost backend: 'cuda' or 'cpu'")
+flags.DEFINE_integer('nthread', None, 'CPU threads of xgboost. Defaults to all cores')
+flags.DEFINE_integer('max_bin', 256, 'Histogram bins per feature')
 
 #Define model metadata
 flags.DEFINE_string("savename", "xgb-s3-theArtOfCope-get_booster", "Name to use to save the model")
@@ -47,47 +50,35 @@ def main(x):
     
     # Do that training
     def load_data(batch:dict, scenario:int):
-        x = np.zeros(shape = (1, scenario*2))
-        y =  np.zeros((1,1))
+        reader = ChipReader({-1: 0, 0: 0, 1: 1}) # Set all -1 to 0
+        pixels = reader.chip_size**2
+
+        # Allocated once, every chip is read straight into its rows
+        x = np.empty(shape = (len(batch['x']) * pixels, scenario*2), dtype=np.float32)
+        y = np.empty(shape = (len(batch['y']) * pixels, 1), dtype=np.int32)
+        chip = np.empty(shape = (scenario*2, reader.chip_size, reader.chip_size), dtype=np.float32)
 
         for idx, scenes in enumerate(batch['x']):
-            full_data = np.zeros(shape=(512*512, 1))
-            for scene in scenes:
-                data = rasterio.open(scene, 'r').read() # C, W, H
-                # S3 --> co-VV, co-VH, pre-VV, pre-VH, co-coh, pre-coh
-                channels, width, height = data.shape
-                data = np.reshape(data, (channels, width*height))
-                data = np.transpose(data, (1,0))
-                
-                full_data = np.append(full_data, data, axis=1)
-                # print("Current data:", data.shape)
-                # print("Full data:", full_data.shape)
-            
-            # Remove zero channel from initialization
-            full_data = full_data[:, 1:]
-            x = np.append(x, full_data, axis=0)
+            # S3 --> co-VV, co-VH, pre-VV, pre-VH, co-coh, pre-coh
+            reader.read(scenes, out=chip) # C, W, H
+            x[idx*pixels:(idx+1)*pixels] = chip.reshape(scenario*2, -1).T
         
         for idx, scenes in enumerate(batch['y']):
-            
             # same as scene = scenes[0] because there will never be more than one target image.
-            for scene in scenes:
-                data = rasterio.open(scene, 'r').read()
-                channels, width, height = data.shape
-                data = np.reshape(data, (width*height, channels) )
-                data = np.int32(data)
-            
-            y = np.append(y, data, axis=0)
-            
+            y[idx*pixels:(idx+1)*pixels, 0] = reader.read_label(scenes[0]).reshape(-1)
+
+        # Labels outside of the remapping are IGNORE_LABEL, not a class
+        kept = y[:, 0] != IGNORE_LABEL
+        if not kept.all():
+            x, y = x[kept], y[kept]
         
         print(x.shape, y.shape)
-        invalids = y[:,0] == -1
-        y[:,0][invalids] = 0 # Set all -1 to 0 
         return x,y
 
     full_model = None
     
     for i in range(batches):
-        model = XGBClassifier(use_label_encoder=False, tree_method = "hist", device = "cuda")
+        model = XGBClassifier(tree_method = "hist", device = FLAGS.device, n_jobs = FLAGS.nthread, max_bin = FLAGS.max_bin)
         model.verbosity = 0
 
         t1 = time.time()
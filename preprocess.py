@@ -0,0 +1,65 @@
+"""
+Offline preprocessing of the whole dataset.
+
+Runs the read_sample pipeline (NaN imputation, speckle filter, label remap, mask) over every chip of the four splits
+with a pool of processes and writes the outputs as TFRecord shards (DatasetHelpers/TFRecords.py).
+Re-running the same command resumes an interrupted run. Train with the result by pointing main.py at it:
+
+    python preprocess.py --scenario 2 --preprocessed_dir /workspaces/Thesis/preprocessed/s2
+    python main.py --scenario 2 --model unet --tfrecord_dir /workspaces/Thesis/preprocessed/s2 ...
+"""
+import os
+from absl import app, flags
+
+from DatasetHelpers.Dataset import create_dataset
+from DatasetHelpers.PackedStore import PackedStore
+from DatasetHelpers.TFRecords import export_tfrecords
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer("scenario", 1, "Training data scenario. \n\t 1: Only co_event \n\t 2: coevent & preevent \n\t 3: coevent & preevent & coherence")
+flags.DEFINE_string('s1_co', '/workspaces/Thesis/10m_data/s1_co_event_grd', 'filepath of Sentinel-1 coevent data')
+flags.DEFINE_string('s1_pre', '/workspaces/Thesis/10m_data/s1_pre_event_grd', 'filepath of Sentinel-1 prevent data')
+flags.DEFINE_string('s2_weak', '/workspaces/Thesis/10m_data/s2_labels', 'filepath of S2-weak labelled data')
+flags.DEFINE_string('coh_co', '/workspaces/Thesis/10m_data/coherence/co_event', 'filepath of coherence coevent data')
+flags.DEFINE_string('coh_pre', '/workspaces/Thesis/10m_data/coherence/pre_event', 'filepath of coherence prevent data')
+
+flags.DEFINE_string('hand_coh_co', '/workspaces/Thesis/10m_hand/coherence_10m/hand_labeled/co_event', '(h) filepath of coevent data')
+flags.DEFINE_string('hand_coh_pre', '/workspaces/Thesis/10m_hand/coherence_10m/hand_labeled/pre_event', '(h) filepath of preevent data')
+flags.DEFINE_string('hand_s1_co', '/workspaces/Thesis/10m_hand/HandLabeled/S1Hand', '(h) filepath of Sentinel-1 coevent data')
+flags.DEFINE_string('hand_s1_pre', '/workspaces/Thesis/10m_hand/S1_Pre_Event_GRD_Hand_Labeled', '(h) filepath of Sentinel-1 prevent data')
+flags.DEFINE_string('hand_labels', '/workspaces/Thesis/10m_hand/HandLabeled/LabelHand', 'filepath of hand labelled data')
+flags.DEFINE_string('manifest', None, 'filepath of the chip manifest database. If set, the dataset is built from it instead of listing every folder')
+flags.DEFINE_float('max_nan_fraction', 1.0, '(manifest) Drop chips with a larger fraction of NaN pixels')
+flags.DEFINE_float('max_invalid_fraction', 1.0, '(manifest) Drop chips with a larger fraction of invalid (-1) label pixels')
+flags.DEFINE_bool('drop_all_zero', False, '(manifest) Drop chips that are entirely zero / NaN')
+flags.DEFINE_string('packed_dir', None, 'Directory written by DatasetHelpers/PackedStore.py. If set, chips are read from its memory-mapped arrays')
+
+flags.DEFINE_bool("baseline", False, "T/F for baseline. If true, it does not apply the new processing pipeline")
+flags.DEFINE_enum('speckle_filter', 'lee', ['lee', 'refined_lee', 'multitemporal'], 'Speckle filter of the SAR channels. multitemporal filters the co + pre event stack jointly')
+
+flags.DEFINE_string('preprocessed_dir', None, 'Directory to write the preprocessed dataset to. Pass it to main.py as --tfrecord_dir')
+flags.DEFINE_integer('shards', 32, 'Shards per split. Progress is reported and resumed per shard')
+flags.DEFINE_integer('processes', os.cpu_count(), 'Worker processes')
+flags.mark_flag_as_required('preprocessed_dir')
+flags.register_multi_flags_validator(['speckle_filter', 'scenario'], lambda f: not (f['speckle_filter'] == 'multitemporal' and f['scenario'] == 1),
+                                     message='The multitemporal filter needs the pre-event channels, use scenario 2 or 3')
+
+def main(x):
+    channel_size = {1: 2, 2: 4, 3: 6}[FLAGS.scenario]
+    dataset = create_dataset(FLAGS)
+    packed = PackedStore(FLAGS.packed_dir) if FLAGS.packed_dir else None
+
+    export_tfrecords(
+        dataset,
+        channel_size,
+        FLAGS.preprocessed_dir,
+        shards=FLAGS.shards,
+        baseline=FLAGS.baseline,
+        packed=packed,
+        workers=FLAGS.processes,
+        speckle_filter=FLAGS.speckle_filter
+    )
+
+if __name__ == "__main__":
+    app.run(main)
@@ -1,9 +1,12 @@
 import os
-import rasterio
+import sys
 import numpy as np
 from tqdm import tqdm, trange
 from absl import app, flags
 
+sys.path.append('../Thesis')
+from DatasetHelpers.ChipReader import ChipReader
+
 S2 = '/workspaces/Thesis/10m_data/s2_labels'
 S1_co = '/workspaces/Thesis/10m_data/s1_co_event_grd'
 S1_pre = '/workspaces/Thesis/10m_data/s1_pre_event_grd'
@@ -16,6 +19,8 @@ FLAGS = flags.FLAGS
 flags.DEFINE_bool("stats_label", False, "Give statistics of label dataset pixels")
 flags.DEFINE_bool("stats_data", False, "Give statistics of dataset pixels")
 
+reader = ChipReader()
+
 def count_labels(directory:str):
     water = 0
     non_water = 0
@@ -24,10 +29,11 @@ def count_labels(directory:str):
         if is_tif_file(file) is False:
             continue
 
-        data = rasterio.open(directory+'/'+file, 'r').read()
-        water += len(data[data==1])
-        non_water += len(data[data==0])
-        invalid += len(data[data==-1])
+        # Raw labels, -1 is kept to be counted
+        data = reader.read_label(directory+'/'+file, remap=False)
+        water += np.count_nonzero(data==1)
+        non_water += np.count_nonzero(data==0)
+        invalid += np.count_nonzero(data==-1)
 
     return water, non_water, invalid
 
@@ -45,7 +51,7 @@ def count_valid_data(directory:str):
         file = file_list[i]
         if is_tif_file(file) is False:
             continue
-        max = np.max(rasterio.open(directory+'/'+file).read())
+        max = np.max(reader.read([directory+'/'+file]))
         # max_hist.append(max)
         if max==0:
             invalid += 1
@@ -0,0 +1,83 @@
+'''
+Synthetic GeoTIFF fixtures of the dataset, shared by the benchmarks.
+
+The fixtures reproduce the folder layout and file name suffixes create_dataset expects for all ten source folders
+(the default path flags of main.py, rooted at a temporary directory instead of /workspaces/Thesis).
+'''
+import json
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import rasterio
+
+REGIONS = ['Bolivia', 'Ghana', 'India', 'Mekong', 'Nigeria', 'Pakistan', 'Paraguay', 'Somalia', 'Spain', 'USA']
+HOLDOUT_REGION = 'Sri-Lanka'
+
+# Default folder of every source, relative to /workspaces/Thesis (same defaults as the path flags of main.py)
+SOURCE_DIRS = {
+    's1_co': '10m_data/s1_co_event_grd',
+    's1_pre': '10m_data/s1_pre_event_grd',
+    's2_weak': '10m_data/s2_labels',
+    'coh_co': '10m_data/coherence/co_event',
+    'coh_pre': '10m_data/coherence/pre_event',
+    'hand_coh_co': '10m_hand/coherence_10m/hand_labeled/co_event',
+    'hand_coh_pre': '10m_hand/coherence_10m/hand_labeled/pre_event',
+    'hand_s1_co': '10m_hand/HandLabeled/S1Hand',
+    'hand_s1_pre': '10m_hand/S1_Pre_Event_GRD_Hand_Labeled',
+    'hand_labels': '10m_hand/HandLabeled/LabelHand',
+}
+LABEL_SOURCES = ['s2_weak', 'hand_labels']
+COHERENCE_SOURCES = ['coh_co', 'coh_pre', 'hand_coh_co', 'hand_coh_pre']
+
+def synthetic_chip(source:str, rng:np.random.Generator) -> np.ndarray:
+    if source in LABEL_SOURCES:
+        # Water blob, invalid (-1) border strip
+        label = np.zeros((1, 512, 512), dtype=np.int16)
+        row, col = rng.integers(0, 384, size=2)
+        label[:, row:row+128, col:col+128] = 1
+        label[:, :, :rng.integers(0, 16)] = -1
+        return label
+
+    if source in COHERENCE_SOURCES:
+        return rng.uniform(0, 1, size=(1, 512, 512)).astype(np.float32)
+
+    # VV, VH backscatter in dB, with a NaN strip like the swath borders
+    chip = (10 * np.log10(rng.gamma(shape=4.0, scale=0.025, size=(2, 512, 512)))).astype(np.float32)
+    chip[:, :rng.integers(0, 8), :] = np.nan
+    return chip
+
+def make_fixtures(root:str, chips:int, regions:int, hand_chips:int) -> dict:
+    """Writes the synthetic dataset under root. Nothing is written if root already holds the same configuration.
+
+    Returns:
+        dict: { source : folder }, to be used as the path flags
+    """
+    config = {'chips': chips, 'regions': regions, 'hand_chips': hand_chips}
+    file_dirs = { source: f'{root}/{folder}' for source, folder in SOURCE_DIRS.items() }
+    if os.path.exists(f'{root}/fixtures.json'):
+        with open(f'{root}/fixtures.json') as f:
+            if json.load(f) == config:
+                return file_dirs
+
+    from DatasetHelpers.Dataset import FILE_SUFFIXES
+    rng = np.random.default_rng(0)
+    main_chips = [ f'{region}_{i}' for region in REGIONS[:regions] + [HOLDOUT_REGION] for i in range(chips) ]
+    hand = [ f'{REGIONS[i % len(REGIONS)]}_{100000 + i}' for i in range(hand_chips) ]
+
+    for source, folder in file_dirs.items():
+        os.makedirs(folder, exist_ok=True)
+        for chip in (hand if source.startswith('hand_') else main_chips):
+            data = synthetic_chip(source, rng)
+            profile = {'driver': 'GTiff', 'width': 512, 'height': 512, 'count': data.shape[0], 'dtype': data.dtype.name}
+            with rasterio.open(f'{folder}/{chip}{FILE_SUFFIXES[source]}', 'w', **profile) as dst:
+                dst.write(data)
+
+    with open(f'{root}/fixtures.json', 'w') as f:
+        json.dump(config, f)
+    return file_dirs
+
+class FixtureFlags(SimpleNamespace):
+    # Stands in for the parsed absl flags that create_dataset reads
+    def get_flag_value(self, name, default):
+        return getattr(self, name, default)
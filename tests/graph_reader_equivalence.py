@@ -0,0 +1,74 @@
+'''
+Equivalence test of GraphReader.read_packed_split against the numpy read_sample of the same packed store,
+on the synthetic GeoTIFF fixtures of tests/fixtures.py.
+
+A block of every packed label is overwritten with a value outside of the label remapping, both readers must
+label it IGNORE_LABEL (compact) or give it a weight of 0.
+
+    python tests/graph_reader_equivalence.py --scenario 3
+'''
+import json
+import sys
+
+import numpy as np
+from absl import app, flags
+
+sys.path.append('../Thesis')
+from fixtures import FixtureFlags, make_fixtures
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string("root", "/tmp/graph_reader_equivalence", "Directory of the synthetic dataset and its packed store")
+flags.DEFINE_integer("chips", 2, "Chips per region of the main dataset")
+flags.DEFINE_integer("scenario", 3, "Training data scenario, sets the channels (2, 4, 6)")
+flags.DEFINE_float("atol", 1e-3, "Absolute tolerance of the images (float32 rounding of the box filters)")
+
+OUT_OF_RANGE = 7 # Not a key of the label remapping
+
+def corrupt_labels(packed_dir:str):
+    for split in ['train', 'val', 'holdout', 'hand']:
+        labels = np.load(f'{packed_dir}/{split}_y.npy', mmap_mode='r+')
+        labels[:, :, 0:16, 0:32] = OUT_OF_RANGE
+        labels.flush()
+
+def compare_split(store, split:str, channels:int, format:str, baseline:bool, compact:bool):
+    from DatasetHelpers.Dataset import construct_read_sample_function, label_remapping, CLASS_W, LEE_SIZE
+    from DatasetHelpers.GraphReader import read_packed_split
+
+    with open(f'{store.root}/index.json') as f:
+        index = json.load(f)['splits'][split]
+    read_sample = construct_read_sample_function(channels, format=format, baseline=baseline, packed=store, compact=compact, numpy=True)
+    graph = read_packed_split(store.root, split, channels, format, baseline=baseline, label_remapping=label_remapping,
+                              class_weights=CLASS_W, lee_size=LEE_SIZE, compact=compact)
+
+    for scenes, targets, element in zip(index['x'], index['y'], graph.as_numpy_iterator()):
+        expected = read_sample(np.array([path.encode('utf-8') for path in (*scenes, *targets)]))
+        np.testing.assert_allclose(element[0], expected[0], rtol=1e-3, atol=FLAGS.atol)
+        for got, want in zip(element[1:], expected[1:]):
+            np.testing.assert_array_equal(got, np.ma.getdata(want))
+
+        label = element[1]
+        if compact:
+            assert (label[0:16, 0:32] == 255).all(), "Out of range labels must be IGNORE_LABEL"
+        else:
+            assert (element[2][0:16, 0:32] == 0).all(), "Out of range labels must weigh 0"
+
+def main(x):
+    from DatasetHelpers.Dataset import create_dataset
+    from DatasetHelpers.PackedStore import PackedStore, pack_dataset
+
+    file_dirs = make_fixtures(FLAGS.root, FLAGS.chips, 1, hand_chips=2)
+    ds = create_dataset(FixtureFlags(scenario=FLAGS.scenario, **file_dirs))
+    channels = {1: 2, 2: 4, 3: 6}[FLAGS.scenario]
+    pack_dataset(ds, f'{FLAGS.root}/packed')
+    corrupt_labels(f'{FLAGS.root}/packed')
+    store = PackedStore(f'{FLAGS.root}/packed')
+
+    for format in ['HWC', 'CHW']:
+        for baseline in [False, True]:
+            for compact in [False, True]:
+                for split in ['train', 'hand']:
+                    compare_split(store, split, channels, format, baseline, compact)
+                print(f"{format} baseline={baseline} compact={compact}: read_packed_split matches read_sample")
+
+if __name__ == "__main__":
+    app.run(main)
@@ -0,0 +1,134 @@
+'''
+Throughput and peak memory benchmark of the input pipeline stages, on synthetic GeoTIFF fixtures.
+
+The fixtures reproduce the folder layout and file name suffixes create_dataset expects for all ten source folders
+(the default path flags of main.py, rooted at --root instead of /workspaces/Thesis), so the real multi-GB dataset is not needed.
+Every (stage, scenario) runs in a fresh process to measure its own peak RSS. Results are written as JSON.
+
+    python tests/input_pipeline_benchmark.py --root /tmp/bench --chips 64 --output Results/input_pipeline_benchmark.json
+
+Stages:
+    read_sample        numpy read_sample of construct_read_sample_function over the training split
+    lee_filter         Preprocessing.lee_filter per chip of the SAR channels of the training split (reading excluded)
+    lee_filter_batch   lee_filter_batch of the same SAR channels, all chips at once
+    convert_to_tfds    iterating the unbatched training split of convert_to_tfds
+    xgb_load_data      Batched_XGBoost.__load_data of the training split
+'''
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+from absl import app, flags
+
+sys.path.append('../Thesis')
+from fixtures import FixtureFlags, make_fixtures
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string("root", "/tmp/input_pipeline_benchmark", "Directory of the synthetic dataset. It is only generated once per configuration")
+flags.DEFINE_integer("chips", 32, "Chips per region of the main dataset")
+flags.DEFINE_integer("regions", 3, "Regions of the main dataset, the Sri-Lanka holdout region is added on top")
+flags.DEFINE_integer("hand_chips", 8, "Chips of the hand labelled dataset")
+flags.DEFINE_list("scenarios", ['1', '2', '3'], "Scenarios to benchmark")
+flags.DEFINE_list("stages", ['read_sample', 'lee_filter', 'lee_filter_batch', 'convert_to_tfds', 'xgb_load_data'], "Stages to benchmark")
+flags.DEFINE_integer("repeats", 1, "Timed runs per stage, the best one is reported")
+flags.DEFINE_string("output", None, "JSON file to write the results to. They are always printed")
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # kB on Linux
+
+def best_time(fn, repeats:int) -> float:
+    times = []
+    for _ in range(repeats):
+        t1 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t1)
+    return min(times)
+
+def run_stage(stage:str, scenario:int, file_dirs:dict, repeats:int) -> dict:
+    """Runs one stage in the current (fresh) process. Returns its measurements.
+    """
+    from DatasetHelpers.ChipReader import ChipReader
+    from DatasetHelpers.Dataset import construct_read_sample_function, convert_to_tfds, create_dataset
+    from DatasetHelpers.Preprocessing import lee_filter, lee_filter_batch
+    from Models.XGB import Batched_XGBoost
+
+    channels = {1: 2, 2: 4, 3: 6}[scenario]
+    ds = create_dataset(FixtureFlags(scenario=scenario, **file_dirs))
+    samples = [ np.array([path.encode('utf-8') for path in (*x, *y)]) for x, y in zip(ds.x_train, ds.y_train) ]
+    import_rss = peak_rss_mb()
+
+    if stage == 'read_sample':
+        read_sample = construct_read_sample_function(channels, numpy=True)
+        run = lambda: [read_sample(sample) for sample in samples]
+    elif stage in ('lee_filter', 'lee_filter_batch'):
+        stack = ChipReader().read_many(list(ds.x_train))[:, 0:4]
+        stack = np.nan_to_num(stack, nan=0.0)
+        if stage == 'lee_filter':
+            run = lambda: [lee_filter(chip) for chip in stack]
+        else:
+            out = np.empty_like(stack)
+            run = lambda: lee_filter_batch(stack, out=out)
+    elif stage == 'convert_to_tfds':
+        train_ds = convert_to_tfds(ds, channels, 'HWC')[0]
+        run = lambda: [None for _ in train_ds]
+    elif stage == 'xgb_load_data':
+        xgb = Batched_XGBoost()
+        batch = {'x': ds.x_train, 'y': ds.y_train}
+        def run():
+            with contextlib.redirect_stdout(io.StringIO()):
+                xgb._Batched_XGBoost__load_data(batch)
+    else:
+        raise ValueError(f'Unknown stage {stage}')
+
+    seconds = best_time(run, repeats)
+    return {
+        'stage': stage,
+        'scenario': scenario,
+        'channels': channels,
+        'samples': len(samples),
+        'seconds': seconds,
+        'samples_per_s': len(samples) / seconds,
+        'import_rss_mb': import_rss,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def main(x):
+    file_dirs = make_fixtures(FLAGS.root, FLAGS.chips, FLAGS.regions, FLAGS.hand_chips)
+
+    results = []
+    # spawn: every stage starts from a fresh interpreter, so ru_maxrss is the peak of that stage only
+    context = multiprocessing.get_context('spawn')
+    for scenario in [int(s) for s in FLAGS.scenarios]:
+        for stage in FLAGS.stages:
+            with context.Pool(1) as pool:
+                result = pool.apply(run_stage, (stage, scenario, file_dirs, FLAGS.repeats))
+            print(f"scenario {scenario} {stage:<16}: {result['samples_per_s']:8.1f} samples/s \t peak RSS {result['peak_rss_mb']:.0f} MB")
+            results.append(result)
+
+    report = {
+        'config': {
+            'chips': FLAGS.chips,
+            'regions': FLAGS.regions,
+            'hand_chips': FLAGS.hand_chips,
+            'repeats': FLAGS.repeats,
+            'cpu_count': os.cpu_count(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+        },
+        'results': results,
+    }
+    print(json.dumps(report, indent=2))
+    if FLAGS.output:
+        os.makedirs(os.path.dirname(FLAGS.output) or '.', exist_ok=True)
+        with open(FLAGS.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    app.run(main)
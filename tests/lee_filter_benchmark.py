@@ -0,0 +1,145 @@
+'''
+Equivalence test and benchmark of Preprocessing.lee_filter_batch against Preprocessing.lee_filter, and of
+Preprocessing.refined_lee_filter_batch against the direct refined_lee_filter below.
+The other speckle filters of the pipeline (multitemporal) are timed on the same stack.
+
+With --model_step, every filter is also reported as a share of one UNet training step (as compiled by main.py) on
+the same chips: a filter above 100% starves the model unless the tf.data maps run it on more cores.
+
+    python tests/lee_filter_benchmark.py --chips 32 --channels 4 --size 7 --model_step
+'''
+import sys
+import time
+import cv2 as cv
+import numpy as np
+from absl import app, flags
+
+sys.path.append('../Thesis')
+from DatasetHelpers.Preprocessing import lee_filter, lee_filter_batch, refined_lee_filter_batch, _directional_kernels, SPECKLE_FILTERS
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer("chips", 32, "Chips in the benchmark stack")
+flags.DEFINE_integer("channels", 4, "Channels per chip")
+flags.DEFINE_integer("size", 7, "Lee filter kernel size")
+flags.DEFINE_integer("workers", None, "Threads of lee_filter_batch. Defaults to the cpu count")
+flags.DEFINE_integer("repeats", 3, "Timed runs, the best one is reported")
+flags.DEFINE_bool("model_step", False, "Time a UNet train_on_batch step per chip to compare the filters with")
+flags.DEFINE_integer("step_batch", 2, "Batch size of the timed UNet steps")
+
+def synthetic_stack(chips:int, channels:int, seed:int=0) -> np.ndarray:
+    # Gamma distributed intensities look like speckled SAR backscatter
+    rng = np.random.default_rng(seed)
+    stack = rng.gamma(shape=4.0, scale=0.025, size=(chips, channels, 512, 512)).astype(np.float32)
+    stack[:, :, 100:200, 100:200] *= 8 # Bright block to have edges
+    return stack
+
+def test_equivalence(size:int, workers:int=None):
+    stack = synthetic_stack(4, 3, seed=1)
+    expected = np.stack([lee_filter(chip, size=size) for chip in stack])
+
+    np.testing.assert_allclose(lee_filter_batch(stack, size=size, workers=workers), expected, rtol=1e-4, atol=1e-6)
+    np.testing.assert_allclose(lee_filter_batch(stack, size=size, workers=1), expected, rtol=1e-4, atol=1e-6)
+
+    # In place on a channel slice, like read_sample does
+    in_place = stack.copy()
+    lee_filter_batch(in_place[:, 0:2], size=size, out=in_place[:, 0:2], workers=workers)
+    np.testing.assert_allclose(in_place[:, 0:2], expected[:, 0:2], rtol=1e-4, atol=1e-6)
+    np.testing.assert_array_equal(in_place[:, 2:], stack[:, 2:])
+    print("lee_filter_batch matches lee_filter")
+
+def refined_lee_filter(image:np.ndarray, size:int = 7) -> np.ndarray:
+    """Direct refined Lee filter of a (C, H, W) chip: the 9 sub windows of the 3x3 grid, the noise level from the
+    5 smallest of their coefficients of variation, and all 8 half windows filtered with _directional_kernels.
+    """
+    EPSILON = 1e-9
+    B = cv.BORDER_REFLECT_101
+    sub = (size // 3) | 1
+    step = (size - sub) // 2
+    filtered = np.empty(image.shape, dtype=np.float32)
+    for c in range(image.shape[0]):
+        src = image[c].astype(np.float32)
+        H, W = src.shape
+        sub_means = cv.boxFilter(src, cv.CV_32F, (sub, sub), borderType=B)
+        sub_cv = (cv.boxFilter(src**2, cv.CV_32F, (sub, sub), borderType=B) - sub_means**2) / (sub_means**2 + EPSILON)
+
+        def grid(x):
+            padded = cv.copyMakeBorder(x, step, step, step, step, B)
+            return np.stack([ padded[dy:dy+H, dx:dx+W] for dy in (0, step, 2*step) for dx in (0, step, 2*step) ])
+        means = grid(sub_means)
+        noise = np.sort(grid(sub_cv), axis=0)[:5].mean(axis=0)
+
+        gradients = np.stack([ np.abs(means[a] - means[b]) for a, b in [(3, 5), (1, 7), (0, 8), (2, 6)] ])
+        orientation = np.argmax(gradients, axis=0)
+        a, b = np.array([3, 1, 0, 2])[orientation], np.array([5, 7, 8, 6])[orientation]
+        pick = lambda k: np.take_along_axis(means, k[None], axis=0)[0]
+        direction = 2 * orientation + (np.abs(pick(b) - means[4]) < np.abs(pick(a) - means[4]))
+
+        half_means = np.stack([ cv.filter2D(src, cv.CV_32F, k, borderType=B) for k in _directional_kernels(size) ])
+        half_sqr = np.stack([ cv.filter2D(src**2, cv.CV_32F, k, borderType=B) for k in _directional_kernels(size) ])
+        dir_means = np.take_along_axis(half_means, direction[None], axis=0)[0]
+        dir_var = np.take_along_axis(half_sqr, direction[None], axis=0)[0] - dir_means**2
+
+        var_x = (dir_var - dir_means**2 * noise) / (1 + noise)
+        weights = np.clip(var_x / (dir_var + EPSILON), 0, 1)
+        filtered[c] = dir_means + weights * (src - dir_means)
+    return filtered
+
+def test_refined_equivalence(size:int, workers:int=None):
+    stack = synthetic_stack(2, 2, seed=2)
+    # Stays close to the float32 rounding of the 8 filter2D references wherever the selected half is the same one
+    expected = np.stack([refined_lee_filter(chip, size=size) for chip in stack])
+    got = refined_lee_filter_batch(stack, size=size, workers=workers)
+    close = np.isclose(got, expected, rtol=1e-4, atol=1e-5)
+    assert close.mean() > 0.999, f"refined_lee_filter_batch differs from refined_lee_filter on {100 * (1 - close.mean()):.3f}% of the pixels"
+    np.testing.assert_array_equal(refined_lee_filter_batch(stack, size=size, workers=1), got)
+    print(f"refined_lee_filter_batch matches refined_lee_filter ({100 * (1 - close.mean()):.4f}% of the pixels on a tie)")
+
+def best_time(fn, repeats:int) -> float:
+    times = []
+    for _ in range(repeats):
+        t1 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t1)
+    return min(times)
+
+def model_step_time(channels:int, batch_size:int, repeats:int) -> float:
+    """Seconds per chip of a UNet train_on_batch step, compiled as main.py does without --compact_dtypes."""
+    import tensorflow as tf
+    from Models.UNet import UNetCompiled
+
+    model = UNetCompiled(input_size=(512, 512, channels), n_filters=64, n_classes=2)
+    model.compile(loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True), optimizer=tf.keras.optimizers.Adam(learning_rate=0.001))
+    images = synthetic_stack(batch_size, channels).transpose(0, 2, 3, 1)
+    labels = np.zeros((batch_size, 512, 512), dtype=np.int32)
+    model.train_on_batch(images, labels) # Traces the step
+    return best_time(lambda: model.train_on_batch(images, labels), repeats) / batch_size
+
+def main(x):
+    test_equivalence(FLAGS.size, FLAGS.workers)
+    test_refined_equivalence(FLAGS.size, FLAGS.workers)
+
+    stack = synthetic_stack(FLAGS.chips, FLAGS.channels)
+    out = np.empty_like(stack)
+
+    step = model_step_time(FLAGS.channels, FLAGS.step_batch, FLAGS.repeats) if FLAGS.model_step else None
+    share = lambda elapsed: f" \t {100 * elapsed / FLAGS.chips / step:.1f}% of a unet step" if step else ""
+
+    current = best_time(lambda: [lee_filter(chip, size=FLAGS.size) for chip in stack], FLAGS.repeats)
+    batched = best_time(lambda: lee_filter_batch(stack, size=FLAGS.size, out=out, workers=FLAGS.workers), FLAGS.repeats)
+    single = best_time(lambda: lee_filter_batch(stack, size=FLAGS.size, out=out, workers=1), FLAGS.repeats)
+
+    print(f"Stack {stack.shape}, kernel {FLAGS.size}")
+    print(f"lee_filter              : {current:.3f} s \t {FLAGS.chips/current:.1f} chips/s")
+    print(f"lee_filter_batch (1)    : {single:.3f} s \t {FLAGS.chips/single:.1f} chips/s \t x{current/single:.1f}")
+    print(f"lee_filter_batch (pool) : {batched:.3f} s \t {FLAGS.chips/batched:.1f} chips/s \t x{current/batched:.1f}{share(batched)}")
+
+    for name, speckle_filter in SPECKLE_FILTERS.items():
+        if name == 'lee':
+            continue
+        elapsed = best_time(lambda: speckle_filter(stack, size=FLAGS.size, out=out, workers=FLAGS.workers), FLAGS.repeats)
+        print(f"{name + ' (pool)':<24}: {elapsed:.3f} s \t {FLAGS.chips/elapsed:.1f} chips/s{share(elapsed)}")
+    if step:
+        print(f"{'unet step':<24}: {step:.3f} s per chip \t {1/step:.1f} chips/s (batch {FLAGS.step_batch})")
+
+if __name__ == "__main__":
+    app.run(main)
@@ -0,0 +1,122 @@
+'''
+Training throughput of the xgboost backend configurations (device, threads, histogram bins, training mode)
+on the synthetic GeoTIFF fixtures of tests/fixtures.py.
+
+The training split is loaded once with Batched_XGBoost.__load_data, so only xgboost is timed:
+-   streaming:   building the QuantileDMatrix from the in memory blocks (quantile sketch + binning), then training
+-   incremental: fitting an XGBClassifier per block, boosting on top of the previous one (the binning is part of fit)
+Throughput is reported in million pixel-rounds per second: pixels * rounds / training seconds. Results are written as JSON.
+
+    python tests/xgb_backend_benchmark.py --chips 16 --nthreads 1,4,8 --max_bins 64,256 --output Results/xgb_backend_benchmark.json
+'''
+import contextlib
+import io
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+
+import xgboost
+from absl import app, flags
+
+sys.path.append('../Thesis')
+from fixtures import FixtureFlags, make_fixtures
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string("root", "/tmp/input_pipeline_benchmark", "Directory of the synthetic dataset. It is only generated once per configuration")
+flags.DEFINE_integer("chips", 16, "Chips per region of the main dataset")
+flags.DEFINE_integer("regions", 3, "Regions of the main dataset, the Sri-Lanka holdout region is added on top")
+flags.DEFINE_integer("scenario", 3, "Training data scenario, sets the features per pixel (2, 4, 6)")
+flags.DEFINE_list("devices", ['cpu'], "xgboost devices to benchmark, e.g. cpu,cuda")
+flags.DEFINE_list("nthreads", [str(os.cpu_count())], "CPU thread counts to benchmark")
+flags.DEFINE_list("max_bins", ['64', '256'], "Histogram bins per feature to benchmark")
+flags.DEFINE_list("training", ['streaming', 'incremental'], "Training modes to benchmark")
+flags.DEFINE_integer("xgb_batches", 4, "Blocks the training split is loaded in")
+flags.DEFINE_integer("rounds", 20, "Boosting rounds per configuration")
+flags.DEFINE_integer("max_depth", 6, "Maximum depth of the trees")
+flags.DEFINE_integer("repeats", 1, "Timed runs per configuration, the best one is reported")
+flags.DEFINE_string("output", None, "JSON file to write the results to. They are always printed")
+
+def load_blocks(xgb, batches:dict) -> list:
+    with contextlib.redirect_stdout(io.StringIO()):
+        return [ xgb._Batched_XGBoost__load_data(batches[batch_idx]) for batch_idx in batches.keys() ]
+
+def run_config(xgb, blocks:list, training:str) -> dict:
+    """Trains once on the loaded blocks. Returns the seconds spent binning the data and training.
+    """
+    from Models.XGB import ChipBlockIterator
+
+    if training == 'streaming':
+        t1 = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            dtrain = xgboost.QuantileDMatrix(ChipBlockIterator(lambda block: block, blocks), max_bin=xgb.max_bin, nthread=xgb.nthread)
+        binning = time.perf_counter() - t1
+        t1 = time.perf_counter()
+        xgboost.train(xgb.booster_params(), dtrain, num_boost_round=xgb.num_boost_round)
+        return {'binning_s': binning, 'training_s': time.perf_counter() - t1}
+
+    t1 = time.perf_counter()
+    model = None
+    for x, y in blocks:
+        block_model = xgb.classifier()
+        block_model.fit(x, y, xgb_model=model)
+        model = block_model
+    return {'binning_s': None, 'training_s': time.perf_counter() - t1}
+
+def main(x):
+    from DatasetHelpers.Dataset import create_dataset
+    from Models.XGB import Batched_XGBoost
+
+    file_dirs = make_fixtures(FLAGS.root, FLAGS.chips, FLAGS.regions, hand_chips=8)
+    dataset = create_dataset(FixtureFlags(scenario=FLAGS.scenario, **file_dirs))
+    batches = dataset.generate_batches(FLAGS.xgb_batches)
+    blocks = load_blocks(Batched_XGBoost(), batches)
+    pixels = sum(len(y) for _, y in blocks)
+    features = blocks[0][0].shape[1]
+    print(f"{pixels} pixels, {features} features in {len(blocks)} blocks")
+
+    results = []
+    for device, nthread, max_bin, training in itertools.product(FLAGS.devices, FLAGS.nthreads, FLAGS.max_bins, FLAGS.training):
+        xgb = Batched_XGBoost(device=device, nthread=int(nthread), max_bin=int(max_bin), max_depth=FLAGS.max_depth, num_boost_round=FLAGS.rounds)
+        runs = [ run_config(xgb, blocks, training) for _ in range(FLAGS.repeats) ]
+        best = min(runs, key=lambda run: run['training_s'])
+        result = {
+            'device': device,
+            'nthread': int(nthread),
+            'max_bin': int(max_bin),
+            'training': training,
+            **best,
+            'mpixel_rounds_per_s': pixels * FLAGS.rounds / best['training_s'] / 1e6,
+        }
+        binning = f"binning {best['binning_s']:6.2f} s" if best['binning_s'] is not None else ' ' * 15
+        print(f"{device:<6} nthread {nthread:>3} max_bin {max_bin:>4} {training:<12}: {binning} \t training {best['training_s']:6.2f} s \t {result['mpixel_rounds_per_s']:6.2f} Mpixel-rounds/s")
+        results.append(result)
+
+    report = {
+        'config': {
+            'chips': FLAGS.chips,
+            'regions': FLAGS.regions,
+            'scenario': FLAGS.scenario,
+            'pixels': pixels,
+            'features': features,
+            'blocks': len(blocks),
+            'rounds': FLAGS.rounds,
+            'max_depth': FLAGS.max_depth,
+            'repeats': FLAGS.repeats,
+            'xgboost': xgboost.__version__,
+            'cpu_count': os.cpu_count(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+        },
+        'results': results,
+    }
+    print(json.dumps(report, indent=2))
+    if FLAGS.output:
+        os.makedirs(os.path.dirname(FLAGS.output) or '.', exist_ok=True)
+        with open(FLAGS.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    app.run(main)
@@ -0,0 +1,58 @@
+'''
+Measures the bytes per row xgboost allocates on top of the training arrays and its bin index, the
+XGB_ROW_OVERHEAD and XGB_COLUMN_OVERHEAD of Models/XGB.py (float32 labels, quantile sketch, gradient pairs,
+predictions, row partitions).
+
+Every column count is fit in a fresh process, like Batched_XGBoost.train_in_batches fits a batch: XGBClassifier
+with the hist tree method. The peak RSS above the arrays, minus the bin index, is divided by the rows and a line
+is fitted over the column counts.
+
+    python tests/xgb_row_overhead.py --rows 4000000 --columns 2,6,16,32
+'''
+import multiprocessing
+import resource
+import sys
+
+import numpy as np
+from absl import app, flags
+
+sys.path.append('../Thesis')
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer("rows", 4_000_000, "Rows of the training arrays, about 15 chips")
+flags.DEFINE_list("columns", ['2', '6', '16', '32'], "Feature columns to measure")
+flags.DEFINE_integer("max_bin", 256, "Histogram bins per feature")
+flags.DEFINE_integer("max_depth", 6, "Tree depth")
+flags.DEFINE_integer("rounds", 10, "Boosting rounds")
+
+def peak_rss_bytes() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # kB on Linux
+
+def measure(rows:int, columns:int, max_bin:int, max_depth:int, rounds:int) -> float:
+    """Bytes per row above the arrays and the bin index, in the current (fresh) process."""
+    from xgboost import XGBClassifier
+
+    rng = np.random.default_rng(0)
+    x = rng.random((rows, columns), dtype=np.float32)
+    y = (rng.random((rows, 1)) < 0.15).astype(np.int32)
+    base = peak_rss_bytes()
+
+    XGBClassifier(n_estimators=rounds, tree_method='hist', max_bin=max_bin, max_depth=max_depth, n_jobs=1).fit(x, y)
+    bin_bytes = 1 if max_bin <= 256 else 2
+    return (peak_rss_bytes() - base) / rows - bin_bytes * columns
+
+def main(x):
+    columns = [int(c) for c in FLAGS.columns]
+    overhead = []
+    # spawn: every measurement starts from a fresh interpreter, so ru_maxrss is the peak of that fit only
+    context = multiprocessing.get_context('spawn')
+    for c in columns:
+        with context.Pool(1) as pool:
+            overhead.append(pool.apply(measure, (FLAGS.rows, c, FLAGS.max_bin, FLAGS.max_depth, FLAGS.rounds)))
+        print(f"{c:>3} columns: {overhead[-1]:.1f} bytes per row")
+
+    per_column, per_row = np.polyfit(columns, overhead, 1)
+    print(f"XGB_ROW_OVERHEAD = {per_row:.1f}, XGB_COLUMN_OVERHEAD = {per_column:.2f}")
+
+if __name__ == "__main__":
+    app.run(main)